@@ -0,0 +1,46 @@
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+from benchmarks.synthetic import iter_pages
+from datums_warehouse.broker.cache import TradesCache
+from datums_warehouse.broker.trades import TRADE
+
+
+def make_cache(file, size_gb, page_size):
+    with TradesCache(file) as cache:
+        for trades in iter_pages(int(size_gb * 1e9 / TRADE.itemsize), page_size, seed=42):
+            cache.update(trades, int(trades['time'][-1]))
+
+
+def time_stream(file, workers):
+    with TradesCache(file) as cache:
+        begin = time.perf_counter()
+        trades = sum(len(t) for t in cache.stream(0, np.iinfo(np.int64).max, workers=workers))
+        return trades, time.perf_counter() - begin
+
+
+@click.command()
+@click.option('--directory', type=click.Path(file_okay=False), default='bench_cache')
+@click.option('--size-gb', type=float, default=5.0)
+@click.option('--page-size', type=int, default=1000)
+@click.option('--workers', type=int, multiple=True, default=[1, 2, 4, 8])
+def cache_read(directory, size_gb, page_size, workers):
+    """Measure TradesCache read throughput of a synthetic cache with different numbers of decoding threads"""
+    file = Path(directory) / f"{size_gb}gb" / "kraken_cache"
+    if not file.exists():
+        file.parent.mkdir(parents=True, exist_ok=True)
+        click.echo(f"generating synthetic cache {file} ...")
+        make_cache(file, size_gb, page_size)
+
+    raw_mb = file.stat().st_size / 1e6
+    for w in workers:
+        trades, seconds = time_stream(file, w)
+        click.echo(f"workers={w:2d}: {trades} trades in {seconds:.2f}s, "
+                   f"{trades / seconds / 1e6:.2f} M trades/s, {raw_mb / seconds:.1f} MB/s compressed")
+
+
+if __name__ == "__main__":
+    cache_read()
@@ -0,0 +1,38 @@
+import time
+
+import click
+
+from benchmarks.synthetic import iter_pages
+from datums_warehouse.broker.codecs import available_codecs, get_codec
+from datums_warehouse.broker.trades import TRADE
+
+
+def measure(codec, pages, repeat):
+    raw_bytes = sum(p.nbytes for p in pages)
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        compressed = [codec.compress(p) for p in pages]
+    compress_s = (time.perf_counter() - begin) / repeat
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        for c in compressed:
+            codec.decompress(c, TRADE)
+    decompress_s = (time.perf_counter() - begin) / repeat
+    return raw_bytes / sum(len(c) for c in compressed), raw_bytes / compress_s / 1e6, raw_bytes / decompress_s / 1e6
+
+
+@click.command()
+@click.option('--trades', type=int, default=2000000)
+@click.option('--page-size', type=int, default=1000)
+@click.option('--repeat', type=int, default=3)
+def codecs(trades, page_size, repeat):
+    """Compare compression ratio and throughput of the available TradesCache codecs on synthetic trade pages"""
+    pages = list(iter_pages(trades, page_size, seed=42))
+    click.echo(f"{'codec':<14}{'ratio':>8}{'compress MB/s':>16}{'decompress MB/s':>18}")
+    for name in available_codecs():
+        ratio, compress, decompress = measure(get_codec(name), pages, repeat)
+        click.echo(f"{name:<14}{ratio:>8.2f}{compress:>16.1f}{decompress:>18.1f}")
+
+
+if __name__ == "__main__":
+    codecs()
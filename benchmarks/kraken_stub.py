@@ -0,0 +1,95 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import click
+
+from datums_warehouse.broker.replay import ReplayExchange
+from datums_warehouse.broker.trades import NANO_SECONDS, BUY, MARKET
+
+
+def kraken_page(pair, trades, last):
+    rows = [[f"{p:.1f}", f"{v:.8f}", t / NANO_SECONDS, 'b' if s == BUY else 's', 'm' if k == MARKET else 'l', '']
+            for t, p, v, s, k in zip(trades['time'].tolist(), trades['price'].tolist(), trades['volume'].tolist(),
+                                     trades['side'].tolist(), trades['type'].tolist())]
+    return {'error': [], 'result': {pair: rows, 'last': str(last)}}
+
+
+class KrakenStubServer:
+    def __init__(self, replays, page_size=1000, latency=0.0, port=0):
+        self._exchanges = {pair: ReplayExchange(pair, None, file, page_size) for pair, file in replays.items()}
+        self._latency = latency
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, name="kraken stub", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def join(self):
+        self._thread.join()
+
+    def respond(self, path, params):
+        if self._latency:
+            time.sleep(self._latency)
+        if path == '/0/public/Time':
+            now = max(e.now() for e in self._exchanges.values())
+            return {'error': [], 'result': {'unixtime': now}}
+        if path == '/0/public/Trades':
+            pair = params.get('pair', [''])[0]
+            if pair not in self._exchanges:
+                return {'error': [f"EQuery:Unknown asset pair {pair}"]}
+            trades, last = self._exchanges[pair].page(int(params.get('since', ['0'])[0]))
+            return kraken_page(pair, trades, last)
+        return None
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                res = stub.respond(url.path, parse_qs(url.query))
+                if res is None:
+                    self.send_error(404)
+                    return
+                body = json.dumps(res).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@click.command()
+@click.argument('replays', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--page-size', type=int, default=1000)
+@click.option('--latency', type=float, default=0.0)
+@click.option('--port', type=int, default=8042)
+def kraken_stub(replays, page_size, latency, port):
+    """Serve replay files as Kraken trade pages, the pair of each replay is taken from its file name"""
+    with KrakenStubServer({Path(r).stem: r for r in replays}, page_size, latency, port) as stub:
+        click.echo(f"serving {', '.join(Path(r).stem for r in replays)} at {stub.url}")
+        stub.join()
+
+
+if __name__ == "__main__":
+    kraken_stub()
@@ -0,0 +1,46 @@
+import json
+import time
+
+import click
+
+from datums_warehouse.broker.kraken import json_loads, get_trades
+from datums_warehouse.broker.trades import as_trades
+from tests.adapters.test_kraken_trading_adapter import RAW_TRADES, OTHER, FRAGMENTED_TRADES
+
+FIXTURES = dict(raw_trades=RAW_TRADES, other=OTHER, fragmented_trades=FRAGMENTED_TRADES)
+
+
+def list_of_lists(res):
+    pair = next(k for k in res['result'].keys() if k != 'last')
+    return as_trades([[float(p), float(v), float(t)] for p, v, t, _, _, _ in res['result'][pair]])
+
+
+def measure(fn, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - begin) / repeat * 1e6
+
+
+@click.command()
+@click.option('--repeat', type=int, default=500)
+def parse(repeat):
+    """Compare decoding and parsing of recorded Kraken trade responses into trade records with the previous
+    list based parsing"""
+    click.echo(f"json parser: {json_loads.__module__}")
+    click.echo(f"{'fixture':<20}{'stage':<24}{'us/page':>10}")
+    for name, text in FIXTURES.items():
+        content = text.encode()
+        res = json_loads(content)
+        stages = {'json.loads': lambda: json.loads(content),
+                  'fast loads': lambda: json_loads(content),
+                  'list of lists': lambda: list_of_lists(res),
+                  'columnar': lambda: get_trades(res),
+                  'total before': lambda: list_of_lists(json.loads(content)),
+                  'total now': lambda: get_trades(json_loads(content))}
+        for stage, fn in stages.items():
+            click.echo(f"{name:<20}{stage:<24}{measure(fn, repeat):>10.1f}")
+
+
+if __name__ == "__main__":
+    parse()
@@ -0,0 +1,144 @@
+import configparser
+import logging
+import resource
+import shutil
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+
+import click
+import numpy as np
+
+import datums_warehouse.broker.source as source
+from benchmarks.kraken_stub import KrakenStubServer
+from benchmarks.synthetic import iter_pages
+from datums_warehouse.broker.adapters import KrakenAdapter
+from datums_warehouse.broker.cache import TradesCache
+from datums_warehouse.broker.kraken import KrakenExchange
+from datums_warehouse.broker.replay import ReplayExchange, write_replay
+from datums_warehouse.broker.storage import Storage
+from datums_warehouse.scripts.update import update_pairs
+
+START = 1500000000
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+
+
+class StageTimes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, items, seconds):
+        with self._lock:
+            calls, total_items, total_seconds = self.stages.get(stage, (0, 0, 0.0))
+            self.stages[stage] = (calls + 1, total_items + items, total_seconds + seconds)
+
+    @contextmanager
+    def instrument(self, owner, attr, stage, count):
+        original = getattr(owner, attr)
+
+        def timed(*args, **kwargs):
+            start, result = time.perf_counter(), None
+            try:
+                result = original(*args, **kwargs)
+                return result
+            finally:
+                self.record(stage, count(args, result), time.perf_counter() - start)
+
+        setattr(owner, attr, timed)
+        try:
+            yield
+        finally:
+            setattr(owner, attr, original)
+
+
+def _rows(csv):
+    return csv.count("\n")
+
+
+@contextmanager
+def instrumented_pipeline(times, exchange):
+    with ExitStack() as stack:
+        stack.enter_context(times.instrument(exchange, 'page', 'fetch', lambda a, r: len(r[0]) if r else 0))
+        stack.enter_context(times.instrument(TradesCache, 'update', 'cache write', lambda a, r: len(a[1])))
+        stack.enter_context(times.instrument(TradesCache, 'get', 'cache read', lambda a, r: 0 if r is None else len(r)))
+        stack.enter_context(times.instrument(KrakenAdapter, '__call__', 'aggregate', lambda a, r: len(a[1])))
+        stack.enter_context(times.instrument(source, 'validate', 'validate', lambda a, r: _rows(a[0].csv)))
+        stack.enter_context(times.instrument(Storage, 'store', 'store', lambda a, r: _rows(a[1].csv)))
+        yield
+
+
+def make_replays(directory, pairs, years, spacing, seed=42):
+    directory.mkdir(parents=True, exist_ok=True)
+    total = int(years * SECONDS_PER_YEAR / spacing)
+    replays = {}
+    for i in range(pairs):
+        file = directory / f"PAIR{i}.npy"
+        if not file.exists():
+            click.echo(f"generating {total} synthetic trades for {file} ...")
+            trades = np.concatenate(list(iter_pages(total, 100000, START, seed + i)))
+            write_replay(file, trades)
+        replays[file.stem] = file
+    return replays
+
+
+def make_config(storage, replays, intervals, source_type, page_size, latency, url=None, shards=1):
+    config = configparser.ConfigParser()
+    for pair, file in replays.items():
+        for itv in intervals:
+            packet = dict(storage=str(storage), interval=str(itv), pair=pair, start=str(START),
+                          backfill_shards=str(shards))
+            if source_type == 'stub':
+                packet.update(source='Kraken', source_url=url, source_frequency='0')
+            else:
+                packet.update(source='Replay', source_file=str(file), source_page_size=str(page_size),
+                              source_latency=str(latency))
+            config[f"{pair}_{itv}"] = packet
+    return config
+
+
+def report(times, wall, trades):
+    click.echo(f"{'stage':<12} {'calls':>8} {'items':>12} {'busy s':>9} {'items/s':>12}")
+    for stage, (calls, items, seconds) in times.stages.items():
+        rate = items / seconds if seconds > 0 else float('inf')
+        click.echo(f"{stage:<12} {calls:>8} {items:>12} {seconds:>9.2f} {rate:>12.0f}")
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    click.echo(f"end to end: {trades} trades in {wall:.2f}s, {trades / wall:.0f} trades/s, peak RSS {peak_mb:.0f} MB")
+
+
+@click.command()
+@click.option('--directory', type=click.Path(file_okay=False), default='bench_pipeline')
+@click.option('--pairs', type=int, default=2)
+@click.option('--intervals', type=int, multiple=True, default=[1, 5, 60])
+@click.option('--years', type=float, default=0.05)
+@click.option('--spacing', type=float, default=2.0, help="mean seconds between synthetic trades")
+@click.option('--page-size', type=int, default=1000)
+@click.option('--source', 'source_type', type=click.Choice(['replay', 'stub']), default='replay')
+@click.option('--latency', type=float, default=0.0, help="seconds each page request takes")
+@click.option('--shards', type=int, default=1, help="concurrent shards of the historical backfill")
+@click.option('--log-level', type=str, default='error')
+def pipeline(directory, pairs, intervals, years, spacing, page_size, source_type, latency, shards, log_level):
+    """Time fetch, cache, aggregate, validate and store of a full backfill from synthetic replays"""
+    logging.basicConfig(level=getattr(logging, log_level.upper()))
+    directory = Path(directory)
+    replays = make_replays(directory / f"replays_{years}y_{spacing}s", pairs, years, spacing)
+    storage = directory / "storage"
+    shutil.rmtree(storage, ignore_errors=True)
+
+    times = StageTimes()
+    with ExitStack() as stack:
+        url = None
+        if source_type == 'stub':
+            url = stack.enter_context(KrakenStubServer(replays, page_size, latency)).url
+        config = make_config(storage, replays, intervals, source_type, page_size, latency, url, shards)
+        stack.enter_context(instrumented_pipeline(times, KrakenExchange if url else ReplayExchange))
+        start = time.perf_counter()
+        update_pairs(config, [p for p in config if p != config.default_section])
+        wall = time.perf_counter() - start
+
+    report(times, wall, times.stages.get('fetch', (0, 0))[1])
+
+
+if __name__ == "__main__":
+    pipeline()
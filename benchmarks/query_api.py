@@ -0,0 +1,217 @@
+import base64
+import configparser
+import json
+import random
+import resource
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+import requests
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from datums_warehouse import create_app
+from datums_warehouse.broker.datums import CsvDatums
+from datums_warehouse.broker.storage import Storage
+
+START = 1500000000
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+DAY = 24 * 60 * 60
+USER, PASSWORD = "bench", "bench"
+
+
+def make_bars(years, interval=1, start=START, seed=None):
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(start, start + int(years * SECONDS_PER_YEAR), interval * 60)
+    close = (7500.0 * np.exp(np.cumsum(rng.normal(0, 1e-3, len(timestamps))))).round(1)
+    spread = np.abs(rng.normal(0, 2.0, len(timestamps))).round(1)
+    volume = rng.lognormal(0, 1, len(timestamps)).round(8)
+    return pd.DataFrame({'timestamp': timestamps, 'open': close, 'high': close + spread, 'low': close - spread,
+                         'close': close, 'vwap': close, 'volume': volume,
+                         'count': rng.integers(1, 100, len(timestamps))})
+
+
+def make_packets(directory, pairs, years, interval=1):
+    storage = directory / "csv"
+    config = configparser.ConfigParser()
+    for i in range(pairs):
+        pair = f"PAIR{i}"
+        if not Storage(storage / pair).exists(interval):
+            click.echo(f"generating {years} years of {interval} minute bars for {pair} ...")
+            bars = make_bars(years, interval, seed=i)
+            Storage(storage / pair).store(CsvDatums(interval, bars.to_csv(index=False)))
+        config[f"{pair}/{interval}"] = dict(storage=str(storage), interval=str(interval), pair=pair)
+    cfg_file = directory / "warehouse.ini"
+    with open(cfg_file, mode='w') as f:
+        config.write(f)
+    credentials = directory / "warehouse.passwd"
+    credentials.write_text(f"{USER}:{generate_password_hash(PASSWORD)}\n")
+    return cfg_file, credentials
+
+
+def make_queries(pairs, years, interval, mix, num, seed=0):
+    rng = random.Random(seed)
+    end = START + int(years * SECONDS_PER_YEAR) - interval * 60
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=num)
+    queries = []
+    for kind in kinds:
+        url = f"/api/v1.0/csv/PAIR{rng.randrange(pairs)}/{interval}"
+        if kind == 'recent':
+            url += f"/{end - DAY}"
+        elif kind == 'narrow':
+            since = rng.randrange(START, end - 60 * 60)
+            url += f"/{since}/{since + 60 * 60}"
+        elif kind == 'shaped':
+            url += "?fields=timestamp,close,volume&resample=60"
+        queries.append((kind, url))
+    return queries
+
+
+class TestClientDriver:
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def get(self, url, headers):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self._app.test_client()
+        res = self._local.client.get(url, headers=headers)
+        return res.status_code, len(res.data)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerDriver:
+    def __init__(self, app):
+        self._server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="query server", daemon=True)
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._thread.join()
+
+    def get(self, url, headers):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        res = self._local.session.get(f"http://127.0.0.1:{self._server.server_port}{url}", headers=headers)
+        return res.status_code, len(res.content)
+
+
+def run_queries(driver, queries, clients):
+    headers = {"Authorization": "Basic " + base64.b64encode(f"{USER}:{PASSWORD}".encode()).decode()}
+
+    def timed(query):
+        kind, url = query
+        start = time.perf_counter()
+        status, size = driver.get(url, headers)
+        return kind, status, size, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(timed, queries))
+    return results, time.perf_counter() - start
+
+
+def summarize(results, wall):
+    summary = {}
+    for kind in sorted({r[0] for r in results}) + ['all']:
+        selected = [r for r in results if kind == 'all' or r[0] == kind]
+        latencies = np.array([r[3] for r in selected]) * 1000
+        summary[kind] = dict(requests=len(selected), errors=sum(r[1] != 200 for r in selected),
+                             p50_ms=float(np.percentile(latencies, 50)), p90_ms=float(np.percentile(latencies, 90)),
+                             p99_ms=float(np.percentile(latencies, 99)), max_ms=float(latencies.max()),
+                             mb=sum(r[2] for r in selected) / 1e6)
+    summary['all'].update(wall_s=wall, requests_per_s=len(results) / wall,
+                          peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return summary
+
+
+def report(summary, baseline=None):
+    click.echo(f"{'kind':<8} {'requests':>8} {'errors':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} "
+               f"{'MB':>8}")
+    for kind, s in summary.items():
+        click.echo(f"{kind:<8} {s['requests']:>8} {s['errors']:>6} {s['p50_ms']:>9.1f} {s['p90_ms']:>9.1f} "
+                   f"{s['p99_ms']:>9.1f} {s['max_ms']:>9.1f} {s['mb']:>8.1f}")
+    total = summary['all']
+    click.echo(f"{total['requests_per_s']:.1f} requests/s, peak RSS {total['peak_rss_mb']:.0f} MB")
+    if baseline:
+        for kind in [k for k in summary if k in baseline]:
+            click.echo(f"{kind:<8} p50 x{summary[kind]['p50_ms'] / baseline[kind]['p50_ms']:.2f}, "
+                       f"p99 x{summary[kind]['p99_ms'] / baseline[kind]['p99_ms']:.2f} of baseline")
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_mix(_, __, value):
+    try:
+        return {k: float(w) for k, w in (part.split('=') for part in value.split(','))}
+    except ValueError:
+        raise click.BadParameter("expected comma separated kind=weight pairs, e.g. full=1,recent=6,narrow=3")
+
+
+@click.command()
+@click.option('--directory', type=click.Path(file_okay=False), default='bench_query')
+@click.option('--pairs', type=int, default=2)
+@click.option('--years', type=float, default=2.0)
+@click.option('--interval', type=int, default=1)
+@click.option('--mix', type=str, default='full=1,recent=6,narrow=3', callback=parse_mix)
+@click.option('--requests', 'num_requests', type=int, default=100)
+@click.option('--clients', type=int, multiple=True, default=[1, 4])
+@click.option('--driver', type=click.Choice(['test-client', 'server']), multiple=True,
+              default=['test-client', 'server'])
+@click.option('--results', type=click.Path(file_okay=False), default='bench_results')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None)
+def query_api(directory, pairs, years, interval, mix, num_requests, clients, driver, results, baseline):
+    """Drive the csv query API with concurrent clients over realistic packet sizes and record latencies"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    cfg_file, credentials = make_packets(directory, pairs, years, interval)
+    app = create_app({'CREDENTIALS': str(credentials), 'WAREHOUSE': str(cfg_file), 'SECRET_KEY': "bench"})
+    queries = make_queries(pairs, years, interval, mix, num_requests)
+    baseline = json.loads(Path(baseline).read_text()) if baseline else {}
+
+    commit = current_commit()
+    record = dict(commit=commit, pairs=pairs, years=years, interval=interval, mix=mix, requests=num_requests, runs={})
+    for name in driver:
+        for c in clients:
+            make_driver = TestClientDriver if name == 'test-client' else ServerDriver
+            with make_driver(app) as d:
+                summary = summarize(*run_queries(d, queries, c))
+            run = f"{name}/{c}"
+            click.echo(f"--- {run} clients ---")
+            report(summary, baseline.get('runs', {}).get(run))
+            record['runs'][run] = summary
+
+    out = Path(results) / f"query_api_{commit}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(record, indent=2))
+    click.echo(f"results saved to {out}")
+
+
+if __name__ == "__main__":
+    query_api()
@@ -0,0 +1,40 @@
+import statistics
+import subprocess
+import sys
+
+import click
+
+IMPORT_BUDGET_S = 2.0
+BUDGETED = ['app', 'update-cli']
+STARTUPS = {
+    'app': "from datums_warehouse import create_app\ncreate_app({'TESTING': True})",
+    'app-preload': "from datums_warehouse import create_app\ncreate_app({'TESTING': True, 'PRELOAD': True})",
+    'update-cli': "import datums_warehouse.db\nimport datums_warehouse.scripts.update",
+}
+
+
+def measure(code):
+    script = f"import time\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)"
+    out = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    return float(out.splitlines()[-1])
+
+
+@click.command()
+@click.option('--repeat', type=int, default=5)
+@click.option('--budget', type=float, default=IMPORT_BUDGET_S,
+              help="median seconds the lazily importing startups may take before the benchmark fails")
+def startup(repeat, budget):
+    """Measure the import time of the app and update cli in fresh interpreters"""
+    click.echo(f"{'startup':<14}{'median s':>10}{'max s':>10}")
+    over = []
+    for name, code in STARTUPS.items():
+        seconds = [measure(code) for _ in range(repeat)]
+        click.echo(f"{name:<14}{statistics.median(seconds):>10.3f}{max(seconds):>10.3f}")
+        if name in BUDGETED and statistics.median(seconds) > budget:
+            over.append(name)
+    if over:
+        raise click.ClickException(f"startup of {', '.join(over)} exceeds the import budget of {budget} s")
+
+
+if __name__ == "__main__":
+    startup()
@@ -0,0 +1,24 @@
+import numpy as np
+
+from datums_warehouse.broker.trades import TRADE, BUY, SELL, MARKET, LIMIT, seconds_to_ns
+
+
+def make_trades(n, start=1500000000.0, price=7500.0, seed=None):
+    rng = np.random.default_rng(seed)
+    trades = np.empty(n, dtype=TRADE)
+    trades['time'] = seconds_to_ns(start + np.cumsum(rng.exponential(2.0, n)).round(4))
+    trades['price'] = (price * np.exp(np.cumsum(rng.normal(0, 1e-4, n)))).round(1)
+    trades['volume'] = rng.lognormal(-3, 1.5, n).round(8)
+    trades['side'] = rng.choice([BUY, SELL], n)
+    trades['type'] = rng.choice([MARKET, LIMIT], n, p=[0.8, 0.2])
+    return trades
+
+
+def iter_pages(total, page_size=1000, start=1500000000.0, seed=None):
+    rng = np.random.default_rng(seed)
+    price = 7500.0
+    while total > 0:
+        trades = make_trades(min(page_size, total), start, price, rng.integers(2 ** 32))
+        yield trades
+        start, price = trades['time'][-1] / 1e9, trades['price'][-1]
+        total -= len(trades)
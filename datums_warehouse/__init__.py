@@ -1,12 +1,17 @@
 import logging
-from flask import Flask
 
-from datums_warehouse import query_csv
 from datums_warehouse._version import __version__
+from datums_warehouse.lazy import lazy_import, preload
+
+flask = lazy_import('flask')
+query_csv = lazy_import('datums_warehouse.query_csv')
+query_stats = lazy_import('datums_warehouse.query_stats')
+metrics = lazy_import('datums_warehouse.metrics')
+storage = lazy_import('datums_warehouse.broker.storage')
 
 
 def create_app(test_config=None):
-    app = Flask(__name__, instance_relative_config=True)
+    app = flask.Flask(__name__, instance_relative_config=True)
 
     if test_config is None:
         app.config.from_envvar('DATUMS_WAREHOUSE_CONFIG', silent=True)
@@ -22,5 +27,13 @@ def create_app(test_config=None):
     logging.basicConfig(**log_cfg)
 
     app.register_blueprint(query_csv.bp)
+    app.register_blueprint(query_stats.bp)
+    app.register_blueprint(metrics.bp)
+
+    if 'SEGMENT_CACHE_MB' in app.config:
+        storage.SEGMENT_CACHE.resize(int(app.config['SEGMENT_CACHE_MB']) * 2 ** 20)
+
+    if app.config.get('PRELOAD', False):
+        preload()
 
     return app
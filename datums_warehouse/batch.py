@@ -0,0 +1,29 @@
+import json
+import struct
+
+BATCH_MIMETYPE = "application/x-datums-batch"
+_FRAME = struct.Struct('>II')
+
+
+def encode_frame(header, body=""):
+    head = json.dumps(header).encode()
+    body = body.encode()
+    return _FRAME.pack(len(head), len(body)) + head + body
+
+
+def iter_frames(stream):
+    while True:
+        prefix = stream.read(_FRAME.size)
+        if len(prefix) == 0:
+            return
+        if len(prefix) < _FRAME.size:
+            raise TruncatedBatchError(f"batch frame prefix is cut off after {len(prefix)} bytes")
+        head_len, body_len = _FRAME.unpack(prefix)
+        head, body = stream.read(head_len), stream.read(body_len)
+        if len(head) < head_len or len(body) < body_len:
+            raise TruncatedBatchError(f"batch frame is cut off, expected {head_len + body_len} bytes")
+        yield json.loads(head), body.decode()
+
+
+class TruncatedBatchError(IOError):
+    pass
@@ -1,4 +1,15 @@
+import json
+import os
+from io import StringIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
 from datums_warehouse.broker.datums import floor_to_interval
+from datums_warehouse.broker.trades import NANO_SECONDS, as_trades
+
+OHLC_HEADER = "timestamp,open,high,low,close,vwap,volume,count"
 
 
 def truncate(x, digits):
@@ -6,47 +17,184 @@ def truncate(x, digits):
 
 
 class KrakenAdapter:
-    _HEADER = "timestamp,open,high,low,close,vwap,volume,count"
+    _HEADER = OHLC_HEADER
 
-    def __init__(self, interval):
+    def __init__(self, interval, state=None):
         self._interval = interval * 60
+        self.state = state or AggregationState()
 
     def __call__(self, trades):
-        return "\n".join(self._make_csv_lines(trades))
+        return "\n".join(self._make_csv_lines(as_trades(trades)))
 
     def _make_csv_lines(self, trades):
         csv = [self._HEADER]
         if len(trades) == 0:
             return csv
 
-        for itv in self._chunked_by_interval(trades):
-            ps, vs, ts = self._transpose([[float(p), float(v), int(t)] for p, v, t in itv])
-            csv.append(self._make_line(ps, ts, vs))
+        buckets = self._aggregate(trades)
+        carried = self.state.bucket
+        if carried is not None and (buckets[0].start - carried.start) < self._interval:
+            carried.merge(buckets.pop(0))
+        if carried is not None:
+            buckets.insert(0, carried)
+
+        for bucket in buckets[:-1]:
+            csv.append(bucket.line())
+            self.state.last_emitted = bucket.start
+        self.state.bucket = buckets[-1]
+        self.state.advance(trades)
         return csv
 
-    def _chunked_by_interval(self, trades):
-        prev_itv = None
-        buffer = []
-        for trade in trades:
-            ts = floor_to_interval(int(trade[2]), self._interval)
-            if prev_itv is None:
-                prev_itv = floor_to_interval(ts, self._interval)
-            if (ts - prev_itv) >= self._interval:
-                prev_itv = ts
-                if len(buffer) > 0:
-                    yield list(buffer)
-                    buffer.clear()
-
-            buffer.append(trade)
-
-    @staticmethod
-    def _transpose(trs):
-        return map(list, zip(*trs))
-
-    def _make_line(self, ps, ts, vs):
-        ttl_v = sum(vs)
-        vwap = truncate(sum((p * v for p, v in zip(ps, vs))) / ttl_v, 1)
-        ttl_v = round(ttl_v, 8)
-        t = floor_to_interval(min(ts), self._interval)
-        line = f"{t},{ps[0]},{max(ps)},{min(ps)},{ps[-1]},{vwap},{ttl_v},{len(ts)}"
-        return line
+    def _aggregate(self, trades):
+        seconds = trades['time'] // NANO_SECONDS
+        starts = seconds - seconds % self._interval
+        first = np.concatenate([[0], np.flatnonzero(starts[1:] != starts[:-1]) + 1])
+        last = np.concatenate([first[1:], [len(trades)]]) - 1
+        prices, volumes = trades['price'], trades['volume']
+        columns = zip(starts[first].tolist(), prices[first].tolist(), np.maximum.reduceat(prices, first).tolist(),
+                      np.minimum.reduceat(prices, first).tolist(), prices[last].tolist(),
+                      np.add.reduceat(prices * volumes, first).tolist(), np.add.reduceat(volumes, first).tolist(),
+                      (last - first + 1).tolist())
+        return [OpenBucket(*values) for values in columns]
+
+
+class OpenBucket:
+    def __init__(self, start, open, high, low, close, pv, volume, count):
+        self.start = start
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.pv = pv
+        self.volume = volume
+        self.count = count
+
+    def merge(self, other):
+        self.high = max(self.high, other.high)
+        self.low = min(self.low, other.low)
+        self.close = other.close
+        self.pv += other.pv
+        self.volume += other.volume
+        self.count += other.count
+
+    def line(self):
+        vwap = truncate(self.pv / self.volume, 1)
+        volume = round(self.volume, 8)
+        return f"{self.start},{self.open},{self.high},{self.low},{self.close},{vwap},{volume},{self.count}"
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+class AggregationState:
+    _VERSION = 2
+
+    def __init__(self, bucket=None, last_emitted=None, cursor=None):
+        self.bucket = bucket
+        self.last_emitted = last_emitted
+        self.cursor = cursor
+
+    def continues(self, since):
+        return self.bucket is not None and self.last_emitted is not None and \
+            self.last_emitted < since <= self.bucket.start
+
+    def cursor_time(self):
+        return self.cursor[0]
+
+    def unseen(self, trades):
+        trades = as_trades(trades)
+        t, consumed = self.cursor
+        at_cursor = np.searchsorted(trades['time'], t, side='right')
+        return trades[min(consumed, at_cursor):]
+
+    def advance(self, trades):
+        times = trades['time']
+        t = int(times[-1])
+        same = len(times) - int(np.searchsorted(times, t, side='left'))
+        if same == len(times) and self.cursor is not None and self.cursor[0] == t:
+            same += self.cursor[1]
+        self.cursor = (t, same)
+
+    def save(self, file):
+        tmp = Path(file).with_suffix('.tmp')
+        tmp.write_text(json.dumps(dict(version=self._VERSION, bucket=self.bucket and self.bucket.to_dict(),
+                                       last_emitted=self.last_emitted, cursor=self.cursor)))
+        os.replace(tmp, file)
+
+    @classmethod
+    def load(cls, file):
+        if not Path(file).exists():
+            return cls()
+        values = json.loads(Path(file).read_text())
+        if values.get('version') != cls._VERSION:
+            return cls()
+        bucket = values['bucket'] and OpenBucket.from_dict(values['bucket'])
+        return cls(bucket, values['last_emitted'], values['cursor'] and tuple(values['cursor']))
+
+
+class BarsAdapter:
+    _HEADER = OHLC_HEADER
+
+    def __init__(self, interval, source_interval):
+        if interval <= source_interval or interval % source_interval != 0:
+            raise InvalidDerivationError(f"interval {interval} can't be derived from interval {source_interval}")
+        self._interval = interval * 60
+        self._source_interval = source_interval * 60
+
+    def __call__(self, csv, fields=None):
+        fields = fields or self._HEADER.split(',')
+        header = ",".join(fields)
+        if len(csv.strip()) == 0:
+            return header
+
+        bars = pd.read_csv(StringIO(csv))
+        missing = [c for c in self.inputs_of(fields) if c not in bars.columns]
+        if missing:
+            raise InvalidDerivationError(f"bars lack the columns {', '.join(missing)} needed for resampling")
+        if not bars.empty:
+            bars = bars[bars.timestamp < self._end_of_complete_buckets(bars.timestamp.iloc[-1])]
+        if bars.empty:
+            return header
+
+        return self._resample(bars, fields).to_csv(index=False).rstrip("\n")
+
+    @classmethod
+    def inputs_of(cls, fields):
+        unknown = [f for f in fields if f not in _AGGREGATIONS]
+        if unknown:
+            raise InvalidDerivationError(f"fields {', '.join(unknown)} can't be derived from bars")
+        return list(dict.fromkeys(['timestamp'] + [c for f in fields for c in _INPUTS.get(f, (f,))]))
+
+    def _end_of_complete_buckets(self, last_ts):
+        last_bucket = floor_to_interval(last_ts, self._interval)
+        if last_ts >= last_bucket + self._interval - self._source_interval:
+            return last_bucket + self._interval
+        return last_bucket
+
+    def _resample(self, bars, fields):
+        bars = bars.assign(bucket=bars.timestamp - bars.timestamp % self._interval)
+        if 'vwap' in fields:
+            bars = bars.assign(pv=bars.vwap * bars.volume)
+        grouped = bars.groupby('bucket', sort=True)
+        return pd.DataFrame({f: _AGGREGATIONS[f](grouped) for f in fields})
+
+
+_AGGREGATIONS = {
+    'timestamp': lambda g: g.size().index.values,
+    'open': lambda g: g.open.first().values,
+    'high': lambda g: g.high.max().values,
+    'low': lambda g: g.low.min().values,
+    'close': lambda g: g.close.last().values,
+    'vwap': lambda g: np.trunc(g.pv.sum().values / g.volume.sum().values * 10) / 10,
+    'volume': lambda g: g.volume.sum().round(8).values,
+    'count': lambda g: g['count'].sum().values,
+}
+_INPUTS = {'vwap': ('vwap', 'volume')}
+
+
+class InvalidDerivationError(ValueError):
+    pass
@@ -1,67 +1,235 @@
+import fcntl
 import io
-import math
+import logging
+import mmap
+import os
 import struct
 import zlib
+from bisect import bisect_left
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 
-from more_itertools import flatten
+import numpy as np
 
+from datums_warehouse.broker.codecs import default_codec, codec_of, LEGACY_CODEC
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.trades import TRADE, LAYOUTS, LEGACY_TRADE, NANO_SECONDS, as_trades, empty_trades, \
+    layout_of, upgrade_layout
 
-class TradesCache:
-    _TRADE = struct.Struct('<ddd')
-    _HEADER = struct.Struct('<II')
+logger = logging.getLogger(__name__)
+
+LEGACY_CACHE = "kraken_cache"
+
+Block = namedtuple('Block', ['start', 'offset', 'size', 'last', 'cursor', 'crc', 'codec', 'layout'])
 
-    def __init__(self, file):
+
+class TradesCache:
+    _LEGACY_HEADER = struct.Struct('<II')
+    _CHECKSUMMED_HEADER = struct.Struct('<4sIIQI')
+    _CHECKSUMMED_MAGIC = b'DWB1'
+    _CODEC_HEADER = struct.Struct('<4sIIQIB')
+    _CODEC_MAGIC = b'DWB2'
+    _HEADER = struct.Struct('<4sIQQIBB')
+    _MAGIC = b'DWB3'
+
+    def __init__(self, file, codec=None):
         self._file = Path(file)
-        self._last_file = self._file.with_name('cache_last')
+        self._codec = codec or default_codec()
+        self._last_file = self._file.with_name(f"{self._file.name}_last")
+        self._lock_file = self._file.with_name(f"{self._file.name}_lock")
+        self._lock = None
+        self._blocks = []
+        self._lasts = []
+        self._cursor = 0
+        self._flushed = 0
+        self._map = None
 
     def __enter__(self):
+        self._lock = open(self._lock_file, mode='a')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self._recover()
+        self._lasts = [b.last for b in self._blocks]
+        self._flushed = self._read_cursor()
+        self._cursor = max([b.cursor for b in self._blocks[-1:] if b.cursor is not None] + [self._flushed])
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self._flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+        self._lock = None
+
+    def _recover(self):
+        self._blocks = []
+        if not self._file.exists():
+            return
+
+        with open(self._file, mode='r+b') as file:
+            end = file.seek(0, io.SEEK_END)
+            file.seek(0)
+            for block in self._read_headers(file):
+                if block.offset + block.size > end:
+                    break
+                self._blocks.append(block)
+                file.seek(block.size, io.SEEK_CUR)
+
+            if self._blocks and not self._is_intact(file, self._blocks[-1]):
+                self._blocks.pop()
+
+            valid_end = self._blocks[-1].offset + self._blocks[-1].size if self._blocks else 0
+            if valid_end < end:
+                logger.warning(f"truncating partial trades cache {self._file} from {end} to {valid_end} bytes")
+                file.truncate(valid_end)
+
+    @staticmethod
+    def _is_intact(file, block):
+        if block.crc is None:
+            return True
+        file.seek(block.offset)
+        return zlib.crc32(file.read(block.size)) == block.crc
 
     def update(self, trades, last):
+        trades = as_trades(trades)
         if len(trades) > 0:
+            raw = self._codec.compress(trades)
             with open(self._file, mode='ab') as file:
-                raw = struct.pack(f'<{len(trades) * 3}d', *flatten(trades))
-                raw = zlib.compress(raw)
-                file.write(self._HEADER.pack(len(raw), int(math.ceil(trades[-1][2]))))
-                file.write(raw)
-
-        with open(self._last_file, mode='w') as file:
-            file.write(str(last))
+                block = Block(file.tell(), file.tell() + self._HEADER.size, len(raw), int(trades['time'][-1]),
+                              last, zlib.crc32(raw), self._codec, TRADE)
+                file.write(self._HEADER.pack(self._MAGIC, block.size, block.last, block.cursor, block.crc,
+                                             self._codec.tag, layout_of(TRADE)) + raw)
+                file.flush()
+                os.fsync(file.fileno())
+            self._blocks.append(block)
+            self._lasts.append(block.last)
+            METRICS.inc('cache_bytes_written_total', self._HEADER.size + len(raw))
+
+        self._cursor = last
+        if len(trades) == 0:
+            self._flush()
+
+    def _flush(self):
+        if self._cursor != self._flushed:
+            _write_atomic(self._last_file, str(self._cursor))
+            self._flushed = self._cursor
+
+    def _read_cursor(self):
+        last_file = legacy_sibling(self._last_file, 'cache_last')
+        if not last_file.exists():
+            return 0
+        with open(last_file, mode='r') as file:
+            return int(file.read())
 
     def get(self, since, until):
-        if not self._file.exists():
-            return []
-
-        with open(self._file, mode='rb') as file:
-            return [trade for trade in self._read_trades(file, since) if since <= trade[2] <= until]
-
-    def _read_trades(self, file, since):
-        for size, last in self._read_headers(file):
-            if last < since:
-                file.seek(size, io.SEEK_CUR)
-            else:
-                raw = zlib.decompress(file.read(size))
-                for cnk in _chunked(raw, self._TRADE.size):
-                    yield list(self._TRADE.unpack(cnk))
+        trades = list(self.stream(since, until))
+        if len(trades) == 0:
+            return empty_trades()
+        return np.concatenate(trades)
+
+    def stream(self, since, until, workers=None, read_ahead=None):
+        if not self._blocks:
+            return
+
+        view = self._view()
+        workers = workers or os.cpu_count() or 1
+        read_ahead = read_ahead or 2 * workers
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            blocks = iter(self._blocks[bisect_left(self._lasts, since):])
+            pending = deque(pool.submit(self._decode, b, view, since, until) for b in islice(blocks, read_ahead))
+            try:
+                while pending:
+                    trades, is_past_until = pending.popleft().result()
+                    for b in islice(blocks, 1):
+                        pending.append(pool.submit(self._decode, b, view, since, until))
+                    if len(trades) > 0:
+                        yield trades
+                    if is_past_until:
+                        return
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _view(self):
+        end = self._blocks[-1].offset + self._blocks[-1].size
+        if self._map is None or len(self._map) < end:
+            with open(self._file, mode='rb') as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _decode(self, block, view, since, until):
+        with memoryview(view)[block.offset:block.offset + block.size] as buf:
+            if block.crc is not None and zlib.crc32(buf) != block.crc:
+                raise CorruptedCacheError(f"checksum mismatch of block at {block.start} in {self._file}")
+            with METRICS.time('stage_seconds', stage='decompress'):
+                trades = upgrade_layout(block.codec.decompress(buf, block.layout))
+        METRICS.inc('cache_bytes_read_total', block.size)
+        METRICS.inc('cache_bytes_decompressed_total', trades.nbytes)
+        times = trades['time']
+        return trades[(since <= times) & (times <= until)], len(times) > 0 and times[-1] > until
 
     def _read_headers(self, file):
-        buf = file.read(self._HEADER.size)
-        while buf:
-            yield self._HEADER.unpack(buf)
-            buf = file.read(self._HEADER.size)
+        buf = file.read(len(self._MAGIC))
+        while len(buf) == len(self._MAGIC):
+            start = file.tell() - len(buf)
+            header = self._header_for(buf)
+            buf += file.read(header.size - len(buf))
+            if len(buf) < header.size:
+                return
+            yield Block(start, file.tell(), *self._unpack(header, buf))
+            buf = file.read(len(self._MAGIC))
+
+    def _header_for(self, magic):
+        if magic == self._MAGIC:
+            return self._HEADER
+        if magic == self._CODEC_MAGIC:
+            return self._CODEC_HEADER
+        if magic == self._CHECKSUMMED_MAGIC:
+            return self._CHECKSUMMED_HEADER
+        return self._LEGACY_HEADER
+
+    def _unpack(self, header, buf):
+        if header is self._HEADER:
+            _, size, last, cursor, crc, tag, layout = header.unpack(buf)
+            return size, last, cursor, crc, codec_of(tag), LAYOUTS[layout]
+        if header is self._CODEC_HEADER:
+            _, size, last, cursor, crc, tag = header.unpack(buf)
+            return size, last * NANO_SECONDS, cursor, crc, codec_of(tag), LEGACY_TRADE
+        if header is self._CHECKSUMMED_HEADER:
+            _, size, last, cursor, crc = header.unpack(buf)
+            return size, last * NANO_SECONDS, cursor, crc, LEGACY_CODEC, LEGACY_TRADE
+        size, last = header.unpack(buf)
+        return size, last * NANO_SECONDS, None, None, LEGACY_CODEC, LEGACY_TRADE
 
     def last_timestamp(self):
-        if not self._last_file.exists():
-            return 0
+        return self._cursor
 
-        with open(self._last_file, mode='r') as file:
-            return int(file.read())
+    def first_timestamp(self):
+        if not self._blocks:
+            return None
+        trades, _ = self._decode(self._blocks[0], self._view(), 0, self._blocks[0].last)
+        return int(trades['time'][0]) if len(trades) else None
+
+
+def legacy_sibling(file, legacy_name):
+    if not file.exists() and file.name.startswith(f"{LEGACY_CACHE}_"):
+        legacy = file.with_name(legacy_name)
+        if legacy.exists():
+            return legacy
+    return file
+
+
+def _write_atomic(file, text):
+    tmp = file.with_name(file.name + '.tmp')
+    with open(tmp, mode='w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, file)
 
 
-def _chunked(buffer, n):
-    for i in range(0, len(buffer), n):
-        yield buffer[i:i + n]
+class CorruptedCacheError(IOError):
+    pass
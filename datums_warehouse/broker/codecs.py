@@ -0,0 +1,128 @@
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+TIME_FIELD = 'time'
+
+
+def shuffle(records):
+    parts = []
+    for name in records.dtype.names:
+        values = np.ascontiguousarray(records[name])
+        if name == TIME_FIELD:
+            values = _delta(values)
+        parts.append(values.view(np.uint8).reshape(len(values), -1).T.tobytes())
+    return b''.join(parts)
+
+
+def unshuffle(buf, dtype):
+    num = len(buf) // dtype.itemsize
+    records = np.empty(num, dtype=dtype)
+    offset = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        shuffled = np.frombuffer(buf, dtype=np.uint8, count=num * field.itemsize, offset=offset)
+        values = shuffled.reshape(field.itemsize, num).T.copy().view(field).ravel()
+        records[name] = _undelta(values) if name == TIME_FIELD else values
+        offset += num * field.itemsize
+    return records
+
+
+def _delta(values):
+    bits = values.view(f'<i{values.itemsize}')
+    deltas = bits.copy()
+    deltas[1:] = np.diff(bits)
+    return deltas
+
+
+def _undelta(deltas):
+    return np.cumsum(deltas.view(f'<i{deltas.itemsize}')).view(deltas.dtype)
+
+
+class Codec:
+    def __init__(self, tag, name, compress, decompress, shuffled=False):
+        self.tag = tag
+        self.name = name
+        self._compress = compress
+        self._decompress = decompress
+        self._shuffled = shuffled
+
+    def __repr__(self):
+        return f"Codec(tag={self.tag}, name={self.name})"
+
+    def compress(self, records):
+        return self._compress(shuffle(records) if self._shuffled else records.tobytes())
+
+    def decompress(self, buf, dtype):
+        raw = self._decompress(buf)
+        return unshuffle(raw, dtype) if self._shuffled else np.frombuffer(raw, dtype=dtype)
+
+
+def _unavailable(name):
+    def raise_missing(_):
+        raise MissingCodecError(f"the {name} codec requires the {name} package to be installed")
+
+    return raise_missing
+
+
+def _zstd_compress(raw):
+    return zstandard.ZstdCompressor(level=3).compress(raw)
+
+
+def _zstd_decompress(buf):
+    return zstandard.ZstdDecompressor().decompress(buf)
+
+
+def _make_codecs():
+    zstd = (_zstd_compress, _zstd_decompress) if zstandard else (_unavailable('zstandard'),) * 2
+    lz = (lz4.frame.compress, lz4.frame.decompress) if lz4 else (_unavailable('lz4'),) * 2
+    codecs = [Codec(0, 'zlib', zlib.compress, zlib.decompress),
+              Codec(1, 'shuffle-zlib', zlib.compress, zlib.decompress, shuffled=True),
+              Codec(2, 'zstd', *zstd),
+              Codec(3, 'shuffle-zstd', *zstd, shuffled=True),
+              Codec(4, 'lz4', *lz),
+              Codec(5, 'shuffle-lz4', *lz, shuffled=True)]
+    return {c.tag: c for c in codecs}
+
+
+CODECS = _make_codecs()
+LEGACY_CODEC = CODECS[0]
+
+
+def available_codecs():
+    return [c.name for c in CODECS.values() if ('zstd' not in c.name or zstandard) and ('lz4' not in c.name or lz4)]
+
+
+def default_codec():
+    if zstandard:
+        return get_codec('shuffle-zstd')
+    if lz4:
+        return get_codec('shuffle-lz4')
+    return get_codec('shuffle-zlib')
+
+
+def get_codec(name):
+    for codec in CODECS.values():
+        if codec.name == name:
+            return codec
+    raise MissingCodecError(f"unknown codec {name}, choose one of {', '.join(available_codecs())}")
+
+
+def codec_of(tag):
+    if tag not in CODECS:
+        raise MissingCodecError(f"unknown codec tag {tag}")
+    return CODECS[tag]
+
+
+class MissingCodecError(ValueError):
+    pass
@@ -0,0 +1,49 @@
+"""
+Exchanges are discovered through the ``datums_warehouse.sources`` entry point group. A plugin is a class
+taking the pair and a pooled HTTP session which provides:
+
+    name        used for the trades cache file of the exchange
+    frequency   minimum number of seconds between two page requests
+    now()       current exchange time in seconds
+    page(since) a page of trades since the cursor as TRADE records and the cursor of the next page (in ns)
+
+Fetching, rate limiting, caching, aggregation and validation are shared by all exchanges.
+"""
+from importlib import import_module
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # pragma: no cover
+    entry_points = None
+
+ENTRY_POINT_GROUP = 'datums_warehouse.sources'
+_BUILTIN = {
+    'Kraken': 'datums_warehouse.broker.kraken:KrakenExchange',
+    'Replay': 'datums_warehouse.broker.replay:ReplayExchange',
+}
+
+
+def available_exchanges():
+    return sorted(set(_BUILTIN) | set(_discover()))
+
+
+def load_exchange(name):
+    plugins = _discover()
+    if name in plugins:
+        return plugins[name].load()
+    if name in _BUILTIN:
+        module, attr = _BUILTIN[name].split(':')
+        return getattr(import_module(module), attr)
+    raise UnknownExchangeError(f"unknown source {name}, choose one of {', '.join(available_exchanges())}")
+
+
+def _discover():
+    if entry_points is None:  # pragma: no cover
+        return {}
+    eps = entry_points()
+    group = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, 'select') else eps.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep for ep in group}
+
+
+class UnknownExchangeError(NotImplementedError):
+    pass
@@ -0,0 +1,78 @@
+import logging
+
+from more_itertools import first
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from datums_warehouse.broker.trades import parse_kraken
+
+LEDGER_FREQUENCY = 2
+KRAKEN_URL = "https://api.kraken.com"
+logger = logging.getLogger(__name__)
+
+
+class KrakenServerTime:
+    _TIME_PATH = "/0/public/Time"
+
+    def __init__(self, http, url=KRAKEN_URL):
+        self._http = http
+        self._url = url
+
+    def now(self):
+        res = self._http.get(self._url + self._TIME_PATH).json()
+        return res['result']['unixtime']
+
+
+class KrakenExchange:
+    name = 'Kraken'
+    frequency = LEDGER_FREQUENCY
+    _TRADE_PATH = "/0/public/Trades"
+    _RESULT_KEY = "result"
+    _ERROR_KEY = "error"
+
+    def __init__(self, pair, http, url=KRAKEN_URL, frequency=LEDGER_FREQUENCY):
+        self.pair = pair
+        self.frequency = float(frequency)
+        self._http = http
+        self._url = url.rstrip('/')
+
+    def now(self):
+        return KrakenServerTime(self._http, self._url).now()
+
+    def page(self, since):
+        url = self._url + self._TRADE_PATH
+        logger.info(f" >>> querying {url}, pair={self.pair}, since={since}")
+        res = json_loads(self._http.get(url, params=dict(pair=self.pair, since=since)).content)
+        self._validate(res)
+        return get_trades(res), get_last(res)
+
+    def _validate(self, res):
+        if self._ERROR_KEY not in res:
+            raise InvalidFormatError(f"The Kraken API response is not in an expected format:\n {res}")
+        if len(res[self._ERROR_KEY]) != 0:
+            raise ResponseError(f"The Kraken API returned an error:\n {res}")
+        if self._RESULT_KEY not in res:
+            raise InvalidFormatError(f"The Kraken API response is not in an expected format:\n {res}")
+
+
+def get_last(trades):
+    return int(trades['result']['last'])
+
+
+def get_trades(res):
+    return parse_kraken(res['result'][get_pair(res)])
+
+
+def get_pair(trades):
+    return first([k for k in trades['result'].keys() if k != 'last'])
+
+
+class InvalidFormatError(TypeError):
+    pass
+
+
+class ResponseError(ValueError):
+    pass
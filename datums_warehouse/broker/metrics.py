@@ -0,0 +1,167 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+PREFIX = "datums_"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._gauges = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            count, total = self._timers.get(key, (0, 0.0))
+            self._timers[key] = (count + 1, total + seconds)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+            self._gauges.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(counters=[[n, l, v] for (n, l), v in self._counters.items()],
+                        timers=[[n, l, c, s] for (n, l), (c, s) in self._timers.items()],
+                        gauges=[[n, l, v] for (n, l), v in self._gauges.items()])
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, count, seconds in snapshot['timers']:
+                key = (name, tuple(map(tuple, labels)))
+                prv_count, prv_seconds = self._timers.get(key, (0, 0.0))
+                self._timers[key] = (prv_count + count, prv_seconds + seconds)
+            for name, labels, value in snapshot['gauges']:
+                self._gauges[(name, tuple(map(tuple, labels)))] = value
+
+    def summary(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timers = dict(self._timers)
+            gauges = dict(self._gauges)
+        return dict(counters={_flat_name(n, l): v for (n, l), v in sorted(counters.items())},
+                    gauges={_flat_name(n, l): v for (n, l), v in sorted(gauges.items())},
+                    timers={_flat_name(n, l): dict(count=c, seconds=round(s, 6))
+                            for (n, l), (c, s) in sorted(timers.items())})
+
+    def prometheus(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(self._timers.items())
+            gauges = sorted(self._gauges.items())
+        lines = []
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            for name, family in _families(samples):
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                lines.extend(f"{PREFIX}{name}{_labels(l)} {_number(v)}" for l, v in family)
+        for name, samples in _families(timers):
+            lines.append(f"# TYPE {PREFIX}{name} summary")
+            for l, (count, total) in samples:
+                lines.append(f"{PREFIX}{name}_count{_labels(l)} {count}")
+                lines.append(f"{PREFIX}{name}_sum{_labels(l)} {_number(total)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsFile:
+    def __init__(self, directory, role, per_process=False, metrics=None, every=5.0, clock=time.monotonic):
+        self._directory = Path(directory)
+        self._role = role
+        self._per_process = per_process
+        self._metrics = metrics or METRICS
+        self._every = every
+        self._clock = clock
+        self._flushed = None
+
+    @property
+    def file(self):
+        return self._directory / (f"{self._role}-{os.getpid()}.json" if self._per_process else f"{self._role}.json")
+
+    def flush(self):
+        self._directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self._directory, prefix=f"{self._role}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode='w') as f:
+                json.dump(self._metrics.snapshot(), f)
+            os.replace(tmp, self.file)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self._flushed = self._clock()
+
+    def maybe_flush(self):
+        if self._flushed is None or self._clock() - self._flushed >= self._every:
+            self.flush()
+
+
+def collect(directory):
+    collected = Metrics()
+    for file in sorted(Path(directory).glob("*.json"), key=lambda f: f.stat().st_mtime_ns):
+        try:
+            collected.merge(json.loads(file.read_text()))
+        except (FileNotFoundError, ValueError):
+            continue
+    return collected
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _families(samples):
+    families = {}
+    for (name, labels), value in samples:
+        families.setdefault(name, []).append((labels, value))
+    return families.items()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _flat_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+METRICS = Metrics()
@@ -0,0 +1,94 @@
+import cProfile
+import logging
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_ACTIVE = threading.Lock()
+_START = threading.Thread.start
+
+
+def profile_file(directory, *parts):
+    name = "_".join(re.sub(r'[^A-Za-z0-9.-]+', '-', str(p)) for p in parts)
+    micros = int(time.perf_counter() * 10 ** 6) % 10 ** 6
+    return Path(directory) / f"{name}_{time.strftime('%Y%m%dT%H%M%S')}_{micros:06d}.prof"
+
+
+@contextmanager
+def profiled(file):
+    if not _ACTIVE.acquire(blocking=False):
+        logger.warning(f"profiling {file} is skipped: another profile is being taken")
+        yield
+        return
+
+    try:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            logger.warning(f"profiling {file} is skipped: {e}")
+            yield
+            return
+
+        # threads started by the profiled call, or by its threads, are profiled until their run() returns;
+        # those still running when the call returns are left out of the profile
+        workers = _ThreadProfiles(threading.current_thread())
+        threading.Thread.start = workers.start_hook()
+        try:
+            yield
+        finally:
+            threading.Thread.start = _START
+            profiler.disable()
+            stats = workers.merged_into(pstats.Stats(profiler))
+            Path(file).parent.mkdir(parents=True, exist_ok=True)
+            stats.dump_stats(str(file))
+            logger.info(f"profile written to {file}")
+    finally:
+        _ACTIVE.release()
+
+
+class _ThreadProfiles:
+    def __init__(self, root):
+        self._lock = threading.Lock()
+        self._threads = {root}
+        self._profilers = []
+
+    def start_hook(self):
+        def start(thread):
+            if threading.current_thread() in self._threads:
+                self._profile(thread)
+            _START(thread)
+
+        return start
+
+    def _profile(self, thread):
+        run = thread.run
+
+        def profiled_run():
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # python 3.12+ allows a single profiler per process
+                return run()
+            try:
+                return run()
+            finally:
+                profiler.disable()
+                with self._lock:
+                    self._profilers.append(profiler)
+
+        with self._lock:
+            self._threads.add(thread)
+        thread.run = profiled_run
+
+    def merged_into(self, stats):
+        with self._lock:
+            for profiler in self._profilers:
+                stats.add(profiler)
+            self._threads.clear()
+        return stats
@@ -0,0 +1,65 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from datums_warehouse.broker.trades import TRADE, NANO_SECONDS, empty_trades, upgrade_layout
+
+REPLAY_COLUMNS = ['time', 'price', 'volume', 'side', 'type']
+
+
+class ReplayExchange:
+    name = 'Replay'
+    frequency = 0
+
+    def __init__(self, pair, http, file=None, page_size=1000, latency=0):
+        self.pair = pair
+        self._file = Path(file or f"{pair}.csv")
+        self._page_size = int(page_size)
+        self._latency = float(latency)
+        self._trades = None
+
+    def now(self):
+        trades = self._load()
+        return int(trades['time'][-1]) // NANO_SECONDS + 1 if len(trades) else 0
+
+    def page(self, since):
+        if self._latency:
+            time.sleep(self._latency)
+        trades = self._load()
+        times = trades['time']
+        lo = np.searchsorted(times, since, side='left')
+        if lo == len(trades):
+            return empty_trades(), since
+        hi = np.searchsorted(times, times[min(lo + self._page_size, len(trades)) - 1], side='right')
+        return trades[lo:hi], int(times[hi - 1]) + 1
+
+    def _load(self):
+        if self._trades is None:
+            self._trades = read_replay(self._file)
+        return self._trades
+
+
+def read_replay(file):
+    if Path(file).suffix == '.npy':
+        return upgrade_layout(np.load(file, mmap_mode='r'))
+    df = pd.read_csv(file)
+    missing = [c for c in REPLAY_COLUMNS[:3] if c not in df.columns]
+    if missing:
+        raise InvalidReplayError(f"replay file {file} is missing the columns: {', '.join(missing)}")
+    trades = np.zeros(len(df), dtype=TRADE)
+    for name in [c for c in REPLAY_COLUMNS if c in df.columns]:
+        trades[name] = df[name].to_numpy()
+    return trades[np.argsort(trades['time'], kind='stable')]
+
+
+def write_replay(file, trades):
+    if Path(file).suffix == '.npy':
+        np.save(file, trades)
+        return
+    pd.DataFrame({name: trades[name] for name in REPLAY_COLUMNS}).to_csv(file, index=False)
+
+
+class InvalidReplayError(ValueError):
+    pass
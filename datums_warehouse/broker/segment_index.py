@@ -0,0 +1,133 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from itertools import accumulate
+
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+INDEX_FILE = "index.json"
+INDEX_LOCK = "index.lock"
+INDEX_MARK_ROWS = 10000
+
+
+def entry_of(name, timestamps):
+    return dict(file=name, first=int(timestamps[0]), last=int(timestamps[-1]), rows=len(timestamps),
+                marks=[int(t) for t in timestamps[::INDEX_MARK_ROWS]])
+
+
+def rows_between(entry, since, until):
+    marks = entry['marks']
+    start = 0 if since is None else max(bisect_right(marks, since) - 1, 0) * INDEX_MARK_ROWS
+    stop = entry['rows'] if until is None else min(bisect_right(marks, until) * INDEX_MARK_ROWS, entry['rows'])
+    return start, stop
+
+
+def overlap(entries):
+    reach = list(accumulate((e['last'] for e in entries), max))
+    return any(e['first'] <= r for e, r in zip(entries[1:], reach))
+
+
+class Segments:
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda e: (e['first'], e['last']))
+        self._firsts = [e['first'] for e in self.entries]
+        self._reach = list(accumulate((e['last'] for e in self.entries), max))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def last(self):
+        return self._reach[-1]
+
+    def between(self, since=None, until=None):
+        lo = 0 if since is None else bisect_left(self._reach, since)
+        hi = len(self.entries) if until is None else bisect_right(self._firsts, until)
+        return [e for e in self.entries[lo:hi] if since is None or e['last'] >= since]
+
+
+class SegmentIndex:
+    def __init__(self, directory):
+        self._directory = directory
+        self._file = directory / INDEX_FILE
+        self._lock = threading.Lock()
+        self._intervals = None
+        self._stamp = None
+        self._scanned = {}
+
+    def of(self, interval):
+        with self._lock:
+            return self._load().get(int(interval), Segments([]))
+
+    def update(self, added):
+        with self._lock, self._exclusive():
+            entries = self._reconciled(skip=added.keys())
+            entries.update({name: entry_of(name, timestamps) for name, timestamps in added.items()})
+            self._save(entries)
+
+    @contextmanager
+    def _exclusive(self):
+        with open(self._directory / INDEX_LOCK, mode='a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not self._directory.exists():
+            return {}
+        stamp = os.stat(self._directory).st_mtime_ns
+        if self._intervals is None or stamp != self._stamp:
+            self._remember(self._reconciled(), stamp)
+        return self._intervals
+
+    def _reconciled(self, skip=()):
+        stored = self._read()
+        present = {f.name: f for f in self._directory.glob("*__*.gz")}
+        entries = {name: e for name, e in stored.items() if name in present}
+        for name in present.keys() - entries.keys() - set(skip):
+            entries[name] = self._scan(present[name])
+        return entries
+
+    def _scan(self, file):
+        key = (file.name, os.stat(file).st_mtime_ns)
+        if key not in self._scanned:
+            self._scanned[key] = entry_of(file.name, pd.read_csv(file, usecols=['timestamp']).timestamp.values)
+            METRICS.inc('segments_indexed_total')
+        return self._scanned[key]
+
+    def _read(self):
+        try:
+            return {e['file']: e for e in json.loads(self._file.read_text())['segments']}
+        except (FileNotFoundError, ValueError, KeyError):
+            return {}
+
+    def _save(self, entries):
+        fd, tmp = tempfile.mkstemp(dir=self._directory, prefix=f"{INDEX_FILE}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode='w') as f:
+                os.fchmod(f.fileno(), 0o644)
+                f.write(json.dumps(dict(segments=sorted(entries.values(), key=lambda e: e['file']))))
+            os.replace(tmp, self._file)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self._remember(entries, os.stat(self._directory).st_mtime_ns)
+
+    def _remember(self, entries, stamp):
+        intervals = {}
+        for name, entry in entries.items():
+            intervals.setdefault(int(name.split('__', 1)[0]), []).append(entry)
+        self._intervals = {itv: Segments(es) for itv, es in intervals.items()}
+        self._stamp = stamp
@@ -1,17 +1,27 @@
 import logging
+import queue
 import random
+import shutil
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import requests
-from more_itertools import first
 
-from datums_warehouse.broker.adapters import KrakenAdapter
-from datums_warehouse.broker.cache import TradesCache
+from datums_warehouse.broker.adapters import KrakenAdapter, BarsAdapter, AggregationState, OHLC_HEADER
+from datums_warehouse.broker.cache import TradesCache, legacy_sibling
 from datums_warehouse.broker.datums import CsvDatums, floor_to_interval
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.trades import NANO_SECONDS, empty_trades
 from datums_warehouse.broker.validation import validate, DataError
 
-LEDGER_FREQUENCY = 2
+PREFETCH_PAGES = 4
+SHARD_MIN_SECONDS = 24 * 60 * 60
+END_OF_TIME = 2 ** 63 - 1
+REPAIR_MERGE_BARS = 60
 logger = logging.getLogger(__name__)
 
 
@@ -19,101 +29,278 @@ def to_nano_sec(t):
     return int(t * 1e9)
 
 
-class KrakenServerTime:
-    _TIME_URL = "https://api.kraken.com/0/public/Time"
+def make_session():
+    return requests.Session()
 
-    def now(self):
-        res = requests.get(self._TIME_URL).json()
-        return res['result']['unixtime']
 
+class RateLimiter:
+    def __init__(self, frequency):
+        self._frequency = frequency
+        self._lock = threading.Lock()
 
-class KrakenTrades:
-    _TRADE_URL = "https://api.kraken.com/0/public/Trades"
-    _RESULT_KEY = "result"
-    _ERROR_KEY = "error"
+    def wait(self):
+        if self._frequency:
+            with self._lock, METRICS.time('stage_seconds', stage='sleep'):
+                time.sleep(self._frequency + random.uniform(0, 1))
 
-    def __init__(self, cache_dir, pair, max_results):
-        self._pair = pair
-        self._cache_file = Path(cache_dir) / self._pair / "kraken_cache"
+
+class ExchangeTrades:
+    def __init__(self, exchange, cache_dir, max_results, shards=1):
+        self._exchange = exchange
+        self._cache_file = Path(cache_dir) / exchange.pair / f"{exchange.name.lower()}_cache"
+        self._segments_dir = self._cache_file.with_name(f"{self._cache_file.name}_segments")
+        self._repairs_dir = self._cache_file.with_name(f"{self._cache_file.name}_repairs")
         self._max_results = max_results
+        self._shards = int(shards)
+        self._limiter = RateLimiter(exchange.frequency)
         self._cache_file.parent.mkdir(parents=True, exist_ok=True)
 
-    def get(self, since, until):
-        len_results = 0
+    @property
+    def cache_file(self):
+        return self._cache_file
+
+    def get(self, since, until, max_seconds=None):
         with TradesCache(self._cache_file) as cache:
-            while self._needs_to_update(cache, until) and len_results < self._max_results:
-                trades = self._update_cache_with_trades(cache, from_ts=cache.last_timestamp() or to_nano_sec(since))
-                num_trades = len(trades)
-                if num_trades == 0:
-                    logging.info(f"exhausted trades at: {cache.last_timestamp()}")
-                    break
+            if self._needs_to_update(cache, until):
+                METRICS.inc('cache_misses_total')
+                deadline = None if max_seconds is None else time.monotonic() + max_seconds
+                windows = self._plan(cache.last_timestamp() or since, until)
+                if windows:
+                    self._fetch_sharded(cache, windows, deadline)
                 else:
-                    len_results += num_trades
-                    logger.info(f" <<< received total: {len_results}")
+                    self._fetch_into(cache, since, until, deadline)
+            else:
+                METRICS.inc('cache_hits_total')
+            with METRICS.time('stage_seconds', stage='cache_read'):
+                return cache.get(since, until)
 
-            return cache.get(since, until)
+    def _fetch_into(self, cache, since, until, deadline=None):
+        pages = queue.Queue(maxsize=PREFETCH_PAGES)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_pages,
+                                   args=(pages, stop, cache.last_timestamp(), since, until, deadline),
+                                   name=f"fetch: {self._exchange.pair}", daemon=True)
+        fetcher.start()
+        try:
+            for page in iter(pages.get, None):
+                if isinstance(page, Exception):
+                    raise page
+                with METRICS.time('stage_seconds', stage='cache_write'):
+                    cache.update(*page)
+        finally:
+            stop.set()
+            fetcher.join()
 
-    def _update_cache_with_trades(self, cache, from_ts):
-        time.sleep(LEDGER_FREQUENCY + random.uniform(0, 1))
-        res = self._query_remote_trades(from_ts)
-        trades = get_trades(res)
-        cache.update(trades, get_last(res))
-        return trades
+    def _fetch_pages(self, pages, stop, last, since, until, deadline):
+        len_results = 0
+        try:
+            while last < until and len_results < self._max_results and not stop.is_set():
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.info(f"fetch budget of {self._exchange.pair} used up at: {last}")
+                    break
+                self._limiter.wait()
+                with METRICS.time('stage_seconds', stage='fetch'):
+                    trades, last = self._exchange.page(last or since)
+                METRICS.inc('pages_fetched_total')
+                METRICS.inc('trades_fetched_total', len(trades))
+                _put(pages, stop, (trades, last))
+                if len(trades) == 0:
+                    logger.info(f"exhausted trades at: {last}")
+                    break
+                len_results += len(trades)
+                logger.info(f" <<< received total: {len_results}")
+        except Exception as e:
+            _put(pages, stop, e)
+        finally:
+            _put(pages, stop, None)
+
+    def window(self, since, until):
+        with TradesCache(self._cache_file) as cache:
+            first = cache.first_timestamp()
+            if first is not None and first <= since and until < cache.last_timestamp():
+                METRICS.inc('cache_hits_total')
+                return cache.get(since, until)
+
+        METRICS.inc('cache_misses_total')
+        file = self._repairs_dir / f"{since}_{until}" / self._cache_file.name
+        file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with TradesCache(file) as repair:
+                self._fetch_into(repair, since, until)
+                return repair.get(since, until)
+        finally:
+            shutil.rmtree(file.parent)
 
     @staticmethod
     def _needs_to_update(cache, until):
-        return cache.last_timestamp() < to_nano_sec(until)
+        return cache.last_timestamp() < until
 
-    def _query_remote_trades(self, since):
-        logger.info(f" >>> querying {self._TRADE_URL}, pair={self._pair}, since={since}")
-        res = requests.get(self._TRADE_URL, params=dict(pair=self._pair, since=since)).json()
-        self._validate(res)
-        return res
+    def _plan(self, start, until):
+        if self._shards <= 1:
+            return []
+        windows = []
+        for lo, hi in self._segments():
+            if lo < start:
+                shutil.rmtree(self._segment_file(lo, hi).parent)
+                continue
+            windows.extend(_split(start, lo, self._shards) + [(lo, hi)])
+            start = hi
+        windows.extend(_split(start, until, self._shards))
+        return windows if len(windows) > 1 else []
 
-    def _validate(self, res):
-        if self._ERROR_KEY not in res:
-            raise InvalidFormatError(f"The Kraken API response is not in an expected format:\n {res}")
-        if len(res[self._ERROR_KEY]) != 0:
-            raise ResponseError(f"The Kraken API returned an error:\n {res}")
-        if self._RESULT_KEY not in res:
-            raise InvalidFormatError(f"The Kraken API response is not in an expected format:\n {res}")
+    def _segments(self):
+        if not self._segments_dir.exists():
+            return []
+        return sorted(tuple(map(int, d.name.split('_'))) for d in self._segments_dir.iterdir() if d.is_dir())
 
+    def _segment_file(self, lo, hi):
+        return self._segments_dir / f"{lo}_{hi}" / self._cache_file.name
 
-def get_last(trades):
-    return int(trades['result']['last'])
+    def _fetch_sharded(self, cache, windows, deadline):
+        logger.info(f"backfilling {self._exchange.pair} in {len(windows)} shards")
+        with ThreadPoolExecutor(max_workers=self._shards, thread_name_prefix=f"shard: {self._exchange.pair}") as pool:
+            futures = [pool.submit(self._fetch_segment, lo, hi, deadline) for lo, hi in windows]
+        with METRICS.time('stage_seconds', stage='stitch'):
+            self._stitch(cache, windows)
+        for future in futures:
+            future.result()
 
+    def _fetch_segment(self, lo, hi, deadline):
+        file = self._segment_file(lo, hi)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with TradesCache(file) as segment:
+            if segment.last_timestamp() < hi:
+                self._fetch_into(segment, lo, hi, deadline)
+        METRICS.inc('shards_fetched_total')
 
-def get_trades(res):
-    pair = get_pair(res)
-    pair_data = res['result'][pair]
-    return [[float(p), float(v), float(t)] for p, v, t, _, _, _ in pair_data]
+    def _stitch(self, cache, windows):
+        written = empty_trades()
+        for i, (lo, hi) in enumerate(windows):
+            file = self._segment_file(lo, hi)
+            if not file.exists():
+                return
+            is_final, seam = i == len(windows) - 1, written
+            with TradesCache(file) as segment:
+                cursor = segment.last_timestamp()
+                is_complete = cursor >= hi
+                for trades in segment.stream(lo, END_OF_TIME if is_final or not is_complete else hi):
+                    trades = _drop_seen(trades, seam)
+                    if len(trades) > 0:
+                        cache.update(trades, int(trades['time'][-1]) + 1)
+                        written = trades
+            shutil.rmtree(file.parent)
+            if is_final or not is_complete:
+                cache.update(empty_trades(), max(cursor, cache.last_timestamp()))
+                return
 
 
-def get_pair(trades):
-    return first([k for k in trades['result'].keys() if k != 'last'])
+def _split(lo, hi, shards):
+    if hi <= lo:
+        return []
+    count = int(max(1, min(shards, (hi - lo) // (SHARD_MIN_SECONDS * NANO_SECONDS))))
+    edges = [lo + (hi - lo) * i // count for i in range(count + 1)]
+    return list(zip(edges[:-1], edges[1:]))
 
 
-class KrakenSource:
-    def __init__(self, trades_storage, pair, interval, max_results=1e6):
-        self._trades = KrakenTrades(trades_storage, pair, max_results)
-        self._interval = interval
-        self._adapter = KrakenAdapter(self._interval)
-        self._server_time = KrakenServerTime()
+def _drop_seen(trades, seen):
+    if len(seen) == 0 or len(trades) == 0:
+        return trades
+    edge = seen['time'][-1]
+    counts = Counter(r.tobytes() for r in seen[seen['time'] == edge])
+    keep = np.ones(len(trades), dtype=bool)
+    for i in np.flatnonzero(trades['time'] == edge):
+        key = trades[i].tobytes()
+        if counts[key] > 0:
+            counts[key] -= 1
+            keep[i] = False
+    return trades[keep]
 
-    def query(self, since, exclude_outliers=None, z_score_threshold=10):
-        last_itv = floor_to_interval(self._server_time.now(), self._interval * 60)
-        trades = self._trades.get(since, last_itv)
-        datums = CsvDatums(self._interval, self._adapter(trades))
+
+def _put(pages, stop, page):
+    while not stop.is_set():
         try:
-            validate(datums, exclude_outliers, z_score_threshold)
-        except DataError as e:
-            logger.warning(f"invalid data found:\n{str(e)}")
-        return datums
+            pages.put(page, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+class TradesSource:
+    def __init__(self, exchange, trades_storage, interval, max_results=1e6, shards=1):
+        self._exchange = exchange
+        self._trades = ExchangeTrades(exchange, trades_storage, max_results, shards)
+        self._interval = interval
+        cache_file = self._trades.cache_file
+        self._state_file = cache_file.with_name(f"{cache_file.name}_aggregation_{interval}")
+
+    def query(self, since, exclude_outliers=None, z_score_threshold=10, max_seconds=None):
+        last_itv = floor_to_interval(self._exchange.now(), self._interval * 60)
+        state = AggregationState.load(legacy_sibling(self._state_file, f"aggregation_{self._interval}"))
+        if state.continues(since):
+            trades = state.unseen(self._trades.get(state.cursor_time(), to_nano_sec(last_itv), max_seconds))
+        else:
+            state = AggregationState()
+            trades = self._trades.get(to_nano_sec(since), to_nano_sec(last_itv), max_seconds)
+        adapter = KrakenAdapter(self._interval, state)
+        with METRICS.time('stage_seconds', stage='aggregate'):
+            datums = CsvDatums(self._interval, adapter(trades))
+        METRICS.inc('trades_aggregated_total', len(trades))
+        adapter.state.save(self._state_file)
+        return _validated(datums, exclude_outliers, z_score_threshold)
 
+    def repair(self, gaps):
+        step = self._interval * 60
+        bars = []
+        for window in _coalesce(gaps, REPAIR_MERGE_BARS * step):
+            trades = self._trades.window(to_nano_sec(window[0][0]), to_nano_sec(window[-1][1] + 2 * step) - 1)
+            with METRICS.time('stage_seconds', stage='aggregate'):
+                csv = KrakenAdapter(self._interval)(trades)
+            for first, last in window:
+                bars.extend(_bars_within(csv, first, last))
+        return CsvDatums(self._interval, "\n".join([OHLC_HEADER] + bars))
 
-class InvalidFormatError(TypeError):
-    pass
 
+class DerivedSource:
+    def __init__(self, storage, source_interval, interval):
+        self._storage = storage
+        self._source_interval = source_interval
+        self._interval = interval
+        self._adapter = BarsAdapter(self._interval, self._source_interval)
+
+    def query(self, since, exclude_outliers=None, z_score_threshold=10, max_seconds=None):
+        bars = ""
+        if self._storage.exists(self._source_interval):
+            bars = self._storage.get(self._source_interval, floor_to_interval(since, self._interval * 60)).csv
+        return _validated(CsvDatums(self._interval, self._adapter(bars)), exclude_outliers, z_score_threshold)
 
-class ResponseError(ValueError):
-    pass
+    def repair(self, gaps):
+        bars = []
+        end_offset = (self._interval - self._source_interval) * 60
+        for first, last in gaps:
+            if self._storage.exists(self._source_interval):
+                csv = self._storage.get(self._source_interval, first, last + end_offset).csv
+                bars.extend(_bars_within(self._adapter(csv), first, last))
+        return CsvDatums(self._interval, "\n".join([OHLC_HEADER] + bars))
+
+
+def _coalesce(gaps, distance):
+    windows = []
+    for gap in sorted(gaps):
+        if windows and gap[0] - windows[-1][-1][1] <= distance:
+            windows[-1].append(gap)
+        else:
+            windows.append([gap])
+    return windows
+
+
+def _bars_within(csv, first, last):
+    return [line for line in csv.split("\n")[1:] if first <= int(line.split(',', 1)[0]) <= last]
+
+
+def _validated(datums, exclude_outliers, z_score_threshold):
+    try:
+        with METRICS.time('stage_seconds', stage='validate'):
+            validate(datums, exclude_outliers, z_score_threshold)
+    except DataError as e:
+        logger.warning(f"invalid data found:\n{str(e)}")
+    return datums
@@ -1,29 +1,134 @@
 import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import closing
 from io import StringIO
 from pathlib import Path
 
-import pandas as pd
 from more_itertools import first
 
 from datums_warehouse.broker.datums import CsvDatums
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.segment_index import SegmentIndex, overlap, rows_between
+from datums_warehouse.broker.summary import DAY_SECONDS, SUMMARY_INPUTS, NotSummarizableError, combine, \
+    summarize_days
+from datums_warehouse.broker.validation import find_gaps
+from datums_warehouse.lazy import lazy_import
 
+pd = lazy_import('pandas')
+
+SEGMENT_CACHE_BYTES = 256 * 2 ** 20
+READ_CHUNK_ROWS = 50000
+CELL_BYTES = 8
 logger = logging.getLogger(__name__)
 
 
+class SegmentCache:
+    def __init__(self, max_bytes=SEGMENT_CACHE_BYTES):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._frames = OrderedDict()
+        self._keys = {}
+        self._bytes = 0
+
+    def read(self, file, columns=None):
+        key, df = self._lookup(file, columns)
+        if df is not None:
+            return df
+        METRICS.inc('segment_cache_misses_total')
+        df = pd.read_csv(file, usecols=_usecols(columns))
+        self._put(key, df)
+        return _project(df, columns)
+
+    def cached(self, file, columns=None):
+        return self._lookup(file, columns)[1]
+
+    def fits(self, size):
+        return size <= self._max_bytes
+
+    def _lookup(self, file, columns):
+        stat = os.stat(file)
+        identity = (str(file), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        key = identity + (None if columns is None else frozenset(columns),)
+        with self._lock:
+            for k in (key, identity + (None,)):
+                if k in self._frames:
+                    self._frames.move_to_end(k)
+                    METRICS.inc('segment_cache_hits_total')
+                    return key, _project(self._frames[k][0], columns)
+        return key, None
+
+    def _put(self, key, df):
+        size = int(df.memory_usage(index=True).sum())
+        with self._lock:
+            self._evict(key)
+            if size > self._max_bytes:
+                return
+            self._frames[key] = (df, size)
+            self._keys.setdefault(key[0], set()).add(key)
+            self._bytes += size
+            self._shrink()
+
+    def discard(self, file):
+        with self._lock:
+            for key in self._keys.pop(str(file), set()):
+                self._bytes -= self._frames.pop(key)[1]
+
+    def _evict(self, key):
+        if key in self._frames:
+            self._bytes -= self._frames.pop(key)[1]
+            self._keys[key[0]].discard(key)
+
+    def _shrink(self):
+        while self._bytes > self._max_bytes:
+            self._evict(next(iter(self._frames)))
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._shrink()
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._keys.clear()
+            self._bytes = 0
+
+    @property
+    def size(self):
+        return self._bytes
+
+
+def _project(df, columns):
+    if columns is None:
+        return df
+    missing = [c for c in columns if c not in df.columns]
+    if missing:
+        raise UnknownFieldError(f"unknown fields requested: {', '.join(missing)}")
+    return df[[c for c in df.columns if c in columns]]
+
+
+SEGMENT_CACHE = SegmentCache()
+
+
 class Storage:
     def __init__(self, directory):
         self._directory = Path(directory)
+        self._index = SegmentIndex(self._directory)
 
     def exists(self, interval):
         if not self._directory.exists():
             return False
-        return first(self._all_of(interval), None) is not None
+        return first(self._directory.glob(f"{interval}__*.gz"), None) is not None
 
     def store(self, datums):
         self._directory.mkdir(parents=True, exist_ok=True)
         df = self._read_csv(datums.csv)
+        METRICS.inc('bars_written_total', len(df), interval=datums.interval)
         df, prv = self._maybe_prepend_existing(df, datums.interval)
-        self._write_csv(df, datums.interval, prv)
+        self._write_csv(df, datums.interval, [] if prv is None else [prv])
 
     @staticmethod
     def _read_csv(csv):
@@ -35,65 +140,231 @@ class Storage:
         return df
 
     def _maybe_prepend_existing(self, new_df, itv):
-        for prv, file in self._all_of(itv):
-            if self._can_concatenate(new_df, prv, itv):
+        for seg_first, seg_last, file in self._ranges(itv):
+            if self._can_concatenate(new_df.timestamp.iloc[0], seg_first, seg_last, itv):
+                prv = SEGMENT_CACHE.read(file)
                 new_df = pd.concat([prv, new_df]).drop_duplicates(subset='timestamp', keep='last') \
                     .reset_index(drop=True)
                 return new_df, file
         return new_df, None
 
-    def _all_of(self, interval):
-        for file in self._directory.glob(f"{interval}__*.gz"):
-            yield pd.read_csv(file), file
-
     @staticmethod
-    def _can_concatenate(new_df, prv_df, itv):
-        fst = new_df.timestamp.iloc[0]
-        lst = prv_df.timestamp.iloc[-1]
-        frq_connect = fst <= lst or (fst - lst) == itv
-        is_after = fst > prv_df.timestamp.iloc[0]
+    def _can_concatenate(fst, prv_first, prv_last, itv):
+        frq_connect = fst <= prv_last or (fst - prv_last) == itv
+        is_after = fst > prv_first
         return frq_connect and is_after
 
-    def _write_csv(self, df, itv, prv):
-        first = df.timestamp.iloc[0]
-        last = df.timestamp.iloc[-1]
-        file = self._directory / f"{itv}__{first}_{last}.gz"
-        df.to_csv(file, index=False, compression="infer")
-        if prv is None:
+    def _write_csv(self, df, itv, replaced):
+        seg_first = df.timestamp.iloc[0]
+        seg_last = df.timestamp.iloc[-1]
+        file = self._directory / f"{itv}__{seg_first}_{seg_last}.gz"
+        _replace(file, lambda tmp: df.to_csv(tmp, index=False, compression="gzip"))
+        SEGMENT_CACHE.discard(file)
+        _write_summary(df, file)
+        if not replaced:
             logger.info(f"creating new csv storage: {file}")
-        elif file != prv:
-            prv.unlink()
+        for prv in replaced:
+            if prv != file:
+                _remove(prv)
+        self._index.update({file.name: df.timestamp.values})
+
+    def _ranges(self, interval):
+        return [(e['first'], e['last'], self._directory / e['file']) for e in self._index.of(interval).entries]
+
+    def find_gaps(self, interval):
+        step = interval * 60
+        gaps = []
+        prv_last = None
+        entries = self._index.of(interval).entries
+        if overlap(entries):
+            return find_gaps(self._read_stitched(entries, ['timestamp'], None, None).timestamp.values, interval)
+        for seg_first, seg_last, file in self._ranges(interval):
+            if prv_last is not None and seg_first - prv_last > step:
+                gaps.append((prv_last + step, seg_first - step))
+            gaps.extend(find_gaps(pd.read_csv(file, usecols=['timestamp']).timestamp.values, interval))
+            prv_last = seg_last if prv_last is None else max(prv_last, seg_last)
+        return gaps
+
+    def splice(self, datums):
+        df = self._read_csv(datums.csv)
+        step = datums.interval * 60
+        lo, hi = df.timestamp.iloc[0] - step, df.timestamp.iloc[-1] + step
+        touching = [file for seg_first, seg_last, file in self._ranges(datums.interval)
+                    if seg_first <= hi and seg_last >= lo]
+        existing = [SEGMENT_CACHE.read(file) for file in touching]
+        merged = pd.concat(existing + [df]).drop_duplicates(subset='timestamp', keep='first') \
+            .sort_values('timestamp').reset_index(drop=True)
+        spliced = len(merged) - sum(len(e) for e in existing)
+        METRICS.inc('bars_repaired_total', spliced, interval=datums.interval)
+        self._write_csv(merged, datums.interval, touching)
+        return spliced
+
+    def stats(self, interval, since, until):
+        entries = self._index.of(interval).between(since, until)
+        if overlap(entries):
+            try:
+                bars = self._read_stitched(entries, SUMMARY_INPUTS, since, until)
+            except UnknownFieldError as e:
+                raise NotSummarizableError(f"segments of interval {interval} hold no bars that can be summarized") \
+                    from e
+            METRICS.inc('summary_edge_bars_total', len(bars))
+            return combine([summarize_days(bars)])
+        blocks = []
+        for entry in entries:
+            file = self._directory / entry['file']
+            lo, hi = max(since, entry['first']), min(until, entry['last'])
+            day_lo, day_hi = -(-lo // DAY_SECONDS) * DAY_SECONDS, (hi + 1) // DAY_SECONDS * DAY_SECONDS
+            edges = [(lo, hi)]
+            if day_lo < day_hi:
+                days = _summary_of(file)
+                blocks.append(days[(days.day >= day_lo) & (days.day < day_hi)])
+                METRICS.inc('summary_blocks_used_total', len(blocks[-1]))
+                edges = [(lo, day_lo - 1), (day_hi, hi)]
+            bars = _edge_bars(file, entry, [(a, b) for a, b in edges if a <= b])
+            METRICS.inc('summary_edge_bars_total', len(bars))
+            blocks.append(summarize_days(bars))
+        return combine(blocks)
 
     def last_time_of(self, interval):
-        _, last_time = self._get_last_of(interval, until=None)
-        return last_time
+        segments = self._index.of(interval)
+        if len(segments) == 0:
+            raise MissingDatumError(f"no datums of interval {interval} are stored in {self._directory}")
+        return segments.last
 
-    def _get_last_of(self, interval, until):
-        def only_df(tp):
-            return tp[0]
+    def get(self, interval, since=None, until=None, fields=None, limit=None):
+        columns = None if fields is None else ['timestamp'] + list(dict.fromkeys(fields))
+        df = self._get_in_range(interval, since, until, columns, limit)
+        return CsvDatums(interval, (df if fields is None else df[columns[1:]]).to_csv(index=False))
 
-        def starts_before_until(df):
-            return until is None or df.timestamp.iloc[0] <= until
+    def _get_in_range(self, interval, since, until, columns=None, limit=None):
+        segments = self._index.of(interval)
+        if len(segments) == 0:
+            raise MissingDatumError(f"no datums of interval {interval} are stored in {self._directory}")
+        entries = segments.between(since, until)
+        if not entries:
+            return pd.read_csv(self._directory / segments.entries[-1]['file'], usecols=_usecols(columns), nrows=0)
+        if overlap(entries):
+            return self._read_stitched(entries, columns, since, until).iloc[:limit]
+        pages, rows = [], 0
+        for entry in entries:
+            pages.append(self._read_segment(entry, columns, since, until, None if limit is None else limit - rows))
+            rows += len(pages[-1])
+            if limit is not None and rows >= limit:
+                break
+        METRICS.inc('segments_read_total', len(pages))
+        return pages[0] if len(pages) == 1 else pd.concat(pages, ignore_index=True)
 
-        def last_ts(df):
-            return df.timestamp.iloc[-1]
+    def _read_stitched(self, entries, columns, since, until):
+        broadest_last = sorted(entries, key=lambda e: e['last'] - e['first'])
+        frames = [SEGMENT_CACHE.read(self._directory / e['file'], columns) for e in broadest_last]
+        return _stitched(frames, since, until)
 
-        all_including_until = filter(starts_before_until, map(only_df, self._all_of(interval)))
-        last_df = max(all_including_until, key=last_ts)
-        return last_df, last_df.timestamp.iloc[-1]
+    def _read_segment(self, entry, columns, since, until, limit):
+        file = self._directory / entry['file']
+        if limit is None or SEGMENT_CACHE.fits(entry['rows'] * len(columns or SUMMARY_INPUTS) * CELL_BYTES):
+            return _within(SEGMENT_CACHE.read(file, columns), since, until).iloc[:limit]
+        cached = SEGMENT_CACHE.cached(file, columns)
+        if cached is not None:
+            return _within(cached, since, until).iloc[:limit]
+        return _scan(file, rows_between(entry, since, until), columns, since, until, limit)
 
-    def get(self, interval, since=None, until=None):
-        df = self._get_in_range(interval, since, until)
-        return CsvDatums(interval, df.to_csv(index=False))
 
-    def _get_in_range(self, interval, since, until):
-        selected_df, _ = self._get_last_of(interval, until)
-        if since and since > selected_df.timestamp.iloc[0]:
-            selected_df = selected_df[selected_df.timestamp >= since]
-        if until and until < selected_df.timestamp.iloc[-1]:
-            selected_df = selected_df[selected_df.timestamp <= until]
-        return selected_df
+def _within(df, since, until):
+    lo = 0 if since is None else df.timestamp.searchsorted(since, side='left')
+    hi = len(df) if until is None else df.timestamp.searchsorted(until, side='right')
+    return df.iloc[lo:hi]
+
+
+def _stitched(frames, since, until):
+    df = pd.concat(frames).drop_duplicates(subset='timestamp', keep='last').sort_values('timestamp')
+    return _within(df.reset_index(drop=True), since, until)
+
+
+def _usecols(columns):
+    wanted = None if columns is None else frozenset(columns)
+    return None if wanted is None else lambda c: c in wanted
+
+
+def _replace(file, write):
+    fd, tmp = tempfile.mkstemp(dir=file.parent, prefix=f"{file.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, file)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _summary_file(file):
+    return file.with_name(f"{file.name[:-len('.gz')]}.summary")
+
+
+def _write_summary(df, file):
+    try:
+        days = summarize_days(df)
+    except NotSummarizableError:
+        return
+    _replace(_summary_file(file), lambda tmp: days.to_csv(tmp, index=False))
+
+
+def _summary_of(file):
+    summary = _summary_file(file)
+    if summary.exists():
+        return pd.read_csv(summary)
+    try:
+        return summarize_days(SEGMENT_CACHE.read(file))
+    except NotSummarizableError as e:
+        raise NotSummarizableError(f"segment {file.name} holds no bars that can be summarized") from e
+
+
+def _edge_bars(file, entry, edges):
+    try:
+        cached = SEGMENT_CACHE.cached(file, SUMMARY_INPUTS)
+        if cached is not None:
+            return pd.concat([_within(cached, a, b) for a, b in edges]) if edges else cached.iloc[:0]
+        pages = [_scan(file, rows_between(entry, a, b), SUMMARY_INPUTS, a, b, None) for a, b in edges]
+    except UnknownFieldError as e:
+        raise NotSummarizableError(f"segment {file.name} holds no bars that can be summarized") from e
+    return pd.concat(pages) if pages else pd.DataFrame(columns=SUMMARY_INPUTS, dtype='int64')
+
+
+def _remove(file):
+    SEGMENT_CACHE.discard(file)
+    file.unlink()
+    try:
+        _summary_file(file).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _scan(file, rows, columns, since, until, limit):
+    start, stop = rows
+    pages, taken = [], 0
+    with closing(pd.read_csv(file, usecols=_usecols(columns), skiprows=range(1, start + 1), nrows=stop - start,
+                             chunksize=READ_CHUNK_ROWS)) as chunks:
+        for chunk in chunks:
+            METRICS.inc('segment_chunks_read_total')
+            is_past_until = until is not None and chunk.timestamp.iloc[-1] > until
+            rest = None if limit is None else limit - taken
+            pages.append(_within(_project(chunk, columns), since, until).iloc[:rest])
+            taken += len(pages[-1])
+            if (limit is not None and taken >= limit) or is_past_until:
+                break
+    return pd.concat(pages) if pages else pd.read_csv(file, usecols=_usecols(columns), nrows=0)
 
 
 class InvalidDatumError(ValueError):
     pass
+
+
+class UnknownFieldError(ValueError):
+    pass
+
+
+class MissingDatumError(IOError):
+    pass
@@ -0,0 +1,49 @@
+from datums_warehouse.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+DAY_SECONDS = 24 * 60 * 60
+SUMMARY_INPUTS = ['timestamp', 'open', 'high', 'low', 'close', 'vwap', 'volume', 'count']
+
+
+def summarize_days(bars):
+    missing = [c for c in SUMMARY_INPUTS if c not in bars.columns]
+    if missing:
+        raise NotSummarizableError(f"bars lack the columns {', '.join(missing)} needed for summaries")
+    days = bars.assign(day=bars.timestamp - bars.timestamp % DAY_SECONDS, pv=bars.vwap * bars.volume,
+                       close_sq=bars.close ** 2).groupby('day', sort=True)
+    volume = days.volume.sum()
+    return pd.DataFrame({
+        'day': volume.index.values,
+        'first': days.timestamp.min().values,
+        'last': days.timestamp.max().values,
+        'open': days.open.first().values,
+        'high': days.high.max().values,
+        'low': days.low.min().values,
+        'close': days.close.last().values,
+        'volume': volume.values,
+        'pv': days.pv.sum().values,
+        'count': days['count'].sum().values,
+        'bars': days.size().values,
+        'close_sum': days.close.sum().values,
+        'close_sq': days.close_sq.sum().values,
+    })
+
+
+def combine(blocks):
+    blocks = [b for b in blocks if len(b) > 0]
+    if not blocks:
+        return None
+    blocks = pd.concat(blocks).sort_values('first')
+    bars, volume = int(blocks.bars.sum()), float(blocks.volume.sum())
+    mean = float(blocks.close_sum.sum()) / bars
+    return dict(first=int(blocks['first'].iloc[0]), last=int(blocks['last'].iloc[-1]),
+                open=float(blocks.open.iloc[0]), high=float(blocks.high.max()), low=float(blocks.low.min()),
+                close=float(blocks.close.iloc[-1]), vwap=float(blocks.pv.sum()) / volume if volume else None,
+                volume=volume, count=int(blocks['count'].sum()), bars=bars, mean=mean,
+                std=float(np.sqrt(max(float(blocks.close_sq.sum()) / bars - mean ** 2, 0))))
+
+
+class NotSummarizableError(ValueError):
+    pass
@@ -0,0 +1,68 @@
+from itertools import repeat
+from operator import itemgetter
+
+import numpy as np
+
+TRADE = np.dtype([('time', '<i8'), ('price', '<f8'), ('volume', '<f8'), ('side', 'i1'), ('type', 'i1')])
+LEGACY_TRADE = np.dtype([('price', '<f8'), ('volume', '<f8'), ('time', '<f8')])
+LAYOUTS = {0: LEGACY_TRADE, 1: TRADE}
+
+BUY, SELL = 1, -1
+MARKET, LIMIT = 1, 2
+NANO_SECONDS = 10 ** 9
+
+
+def seconds_to_ns(seconds):
+    micro = np.round(np.asarray(seconds, dtype=np.float64) * 1e6).astype(np.int64)
+    return micro * 1000
+
+
+def empty_trades():
+    return np.empty(0, dtype=TRADE)
+
+
+def as_trades(trades):
+    if isinstance(trades, np.ndarray) and trades.dtype == TRADE:
+        return trades
+    if len(trades) == 0:
+        return empty_trades()
+
+    rows = np.asarray(trades, dtype=np.float64).reshape(-1, 3)
+    records = np.zeros(len(rows), dtype=TRADE)
+    records['price'] = rows[:, 0]
+    records['volume'] = rows[:, 1]
+    records['time'] = seconds_to_ns(rows[:, 2])
+    return records
+
+
+def upgrade_layout(records):
+    if records.dtype == TRADE:
+        return records
+    converted = np.zeros(len(records), dtype=TRADE)
+    converted['price'] = records['price']
+    converted['volume'] = records['volume']
+    converted['time'] = seconds_to_ns(records['time'])
+    return converted
+
+
+def layout_of(dtype):
+    for tag, layout in LAYOUTS.items():
+        if layout == dtype:
+            return tag
+    raise ValueError(f"unknown trade layout {dtype}")
+
+
+def parse_kraken(rows):
+    num = len(rows)
+    records = np.empty(num, dtype=TRADE)
+    records['price'] = np.fromiter(map(float, map(_PRICE, rows)), dtype=np.float64, count=num)
+    records['volume'] = np.fromiter(map(float, map(_VOLUME, rows)), dtype=np.float64, count=num)
+    records['time'] = seconds_to_ns(np.fromiter(map(_TIME, rows), dtype=np.float64, count=num))
+    records['side'] = np.fromiter(map(_SIDES.get, map(_SIDE, rows), repeat(0)), dtype=np.int8, count=num)
+    records['type'] = np.fromiter(map(_TYPES.get, map(_TYPE, rows), repeat(0)), dtype=np.int8, count=num)
+    return records
+
+
+_PRICE, _VOLUME, _TIME, _SIDE, _TYPE = (itemgetter(i) for i in range(5))
+_SIDES = dict(b=BUY, s=SELL)
+_TYPES = dict(m=MARKET, l=LIMIT)
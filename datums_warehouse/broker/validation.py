@@ -1,7 +1,9 @@
 from io import StringIO
 
-import numpy as np
-import pandas as pd
+from datums_warehouse.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
 def validate(datums, exclude_outliers=None, z_score_threshold=10):
@@ -11,7 +13,8 @@ def validate(datums, exclude_outliers=None, z_score_threshold=10):
 
     _check_elements(df, 'missing', df.isnull())
     _check_elements(df, 'outlier', _make_outlier_mask(df, exclude_outliers or [], z_score_threshold))
-    _check_index_interval(df, datums.interval)
+    if 'timestamp' in df.columns:
+        _check_index_interval(df, datums.interval)
     return datums
 
 
@@ -51,8 +54,22 @@ def _check_index_interval(df, interval):
     diff = df.timestamp.values[1:] - df.timestamp.values[:-1]
     lines = _indices_to_lines(np.where(diff != interval * 60)[0])
     if len(lines) > 0:
-        raise DataError(f"gap in the time series found at lines {', '.join(lines)}")
+        raise GapError(f"gap in the time series found at lines {', '.join(lines)}",
+                       find_gaps(df.timestamp.values, interval))
+
+
+def find_gaps(timestamps, interval):
+    step = interval * 60
+    timestamps = np.asarray(timestamps)
+    at = np.flatnonzero(timestamps[1:] - timestamps[:-1] > step)
+    return [(int(timestamps[i]) + step, int(timestamps[i + 1]) - step) for i in at]
 
 
 class DataError(ValueError):
     pass
+
+
+class GapError(DataError):
+    def __init__(self, message, gaps):
+        super().__init__(message)
+        self.gaps = gaps
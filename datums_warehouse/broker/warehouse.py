@@ -1,18 +1,26 @@
 from pathlib import Path
 
-from datums_warehouse.broker.source import KrakenSource
+from datums_warehouse.broker.datums import CsvDatums, floor_to_interval
+from datums_warehouse.broker.metrics import METRICS
 from datums_warehouse.broker.storage import Storage
+from datums_warehouse.lazy import lazy_import
+
+adapters = lazy_import('datums_warehouse.broker.adapters')
+exchanges = lazy_import('datums_warehouse.broker.exchanges')
+source = lazy_import('datums_warehouse.broker.source')
 
 
 def make_storage(storage, pair):  # pragma: no cover simple factory function
     return Storage(Path(storage) / pair)
 
 
-def make_source(storage, src_type, pair, interval):  # pragma: no cover simple factory function
-    if src_type == 'Kraken':
-        return KrakenSource(storage, pair, interval)
+def make_source(storage, src_type, pair, interval, options=None, shards=1):  # pragma: no cover simple factory function
+    exchange = exchanges.load_exchange(src_type)(pair, source.make_session(), **(options or {}))
+    return source.TradesSource(exchange, storage, interval, shards=shards)
+
 
-    raise NotImplementedError(type)
+def make_derived_source(storage, source_interval, interval):  # pragma: no cover simple factory function
+    return source.DerivedSource(storage, source_interval, interval)
 
 
 class Warehouse:
@@ -23,9 +31,14 @@ class Warehouse:
     _EXCLUDE_OUTLIERS_KEY = 'exclude_outliers'
     _Z_THRESHOLD_KEY = 'z_score_threshold'
     _START_KEY = 'start'
+    _DERIVE_FROM_KEY = 'derive_from'
+    _SOURCE_OPTION_PREFIX = 'source_'
+    _BACKFILL_SHARDS_KEY = 'backfill_shards'
 
     def __init__(self, config):
         self._config = config
+        self._sources = {}
+        self._storages = {}
 
     def get_exclude_outliers_for(self, pkt_id):
         return self._config[pkt_id].get(self._EXCLUDE_OUTLIERS_KEY, None)
@@ -33,12 +46,64 @@ class Warehouse:
     def get_z_score_threshold_for(self, pkt_id):
         return float(self._config[pkt_id].get(self._Z_THRESHOLD_KEY, 10))
 
-    def retrieve(self, pkt_id, since=None, until=None):
+    def retrieve(self, pkt_id, since=None, until=None, fields=None, resample=None, limit=None, after=None):
+        self._validate_packet(pkt_id)
+        interval = self._get_interval(self._config[pkt_id])
+        storage = self._storage_of(pkt_id)
+        if resample is None or resample == interval:
+            return storage.get(interval, _resumed(since, after, 1), until, fields, limit)
+
+        adapter = adapters.BarsAdapter(resample, interval)
+        step = resample * 60
+        columns = None if fields is None else adapter.inputs_of(fields)
+        since = _resumed(None if since is None else floor_to_interval(since, step), after, step)
+        rows = None if limit is None else (limit + 1) * (resample // interval)
+        with METRICS.time('query_seconds', stage='resample'):
+            csv = adapter(storage.get(interval, since, until, columns, rows).csv, fields)
+        return CsvDatums(resample, "\n".join(csv.split("\n")[:None if limit is None else limit + 1]) + "\n")
+
+    def retrieve_page(self, pkt_id, limit, since=None, until=None, fields=None, resample=None, after=None):
+        with_cursor = fields if fields is None or 'timestamp' in fields else ['timestamp'] + list(fields)
+        datums = self.retrieve(pkt_id, since, until, with_cursor, resample, limit + 1, after)
+        lines = datums.csv.rstrip("\n").split("\n")
+        cursor = None
+        if len(lines) > limit + 1:
+            cursor = int(lines[limit].split(',')[lines[0].split(',').index('timestamp')])
+            lines = lines[:limit + 1]
+        if with_cursor is not fields:
+            lines = [line.split(',', 1)[1] for line in lines]
+        return CsvDatums(datums.interval, "\n".join(lines) + "\n"), cursor
+
+    def stats(self, pkt_id, since, until):
+        self._validate_packet(pkt_id)
+        return self._storage_of(pkt_id).stats(self._get_interval(self._config[pkt_id]), since, until)
+
+    def _storage_of(self, pkt_id):
+        if pkt_id not in self._storages:
+            pkt_cfg = self._config[pkt_id]
+            self._storages[pkt_id] = make_storage(pkt_cfg[self._STORAGE_KEY], pkt_cfg[self._PAIR_KEY])
+        return self._storages[pkt_id]
+
+    def _source_of(self, pkt_id):
+        if pkt_id not in self._sources:
+            pkt_cfg = self._config[pkt_id]
+            self._sources[pkt_id] = self._make_source(pkt_cfg, pkt_cfg[self._PAIR_KEY], self._get_interval(pkt_cfg))
+        return self._sources[pkt_id]
+
+    def interval_of(self, pkt_id):
+        self._validate_packet(pkt_id)
+        return self._get_interval(self._config[pkt_id])
+
+    def lag_of(self, pkt_id, now):
         self._validate_packet(pkt_id)
         pkt_cfg = self._config[pkt_id]
-        storage = make_storage(pkt_cfg[self._STORAGE_KEY], pkt_cfg[self._PAIR_KEY])
-        datums = storage.get(self._get_interval(pkt_cfg), since, until)
-        return datums
+        interval = self._get_interval(pkt_cfg)
+        storage = self._storage_of(pkt_id)
+        if storage.exists(interval):
+            last = storage.last_time_of(interval)
+        else:
+            last = int(pkt_cfg.get(self._START_KEY, 0)) - interval * 60
+        return max(floor_to_interval(now, interval * 60) - interval * 60 - last, 0)
 
     def _get_interval(self, pkt_cfg):
         return int(pkt_cfg[self._INTERVAL_KEY])
@@ -50,17 +115,62 @@ class Warehouse:
     def all_packets(self):
         return set(self._config.keys())
 
-    def update(self, pkt_id):
+    def update(self, pkt_id, max_seconds=None):
         self._validate_packet(pkt_id)
         pkt_cfg = self._config[pkt_id]
         interval = self._get_interval(pkt_cfg)
-        pair = pkt_cfg[self._PAIR_KEY]
-        src = make_source(pkt_cfg[self._STORAGE_KEY], pkt_cfg[self._SOURCE_KEY], pair, interval)
-        storage = make_storage(pkt_cfg[self._STORAGE_KEY], pair)
+        src = self._source_of(pkt_id)
+        storage = self._storage_of(pkt_id)
         since = self._get_starting_point(interval, pkt_cfg, storage)
         outliers = self.get_exclude_outliers_for(pkt_id)
         z_threshold = self.get_z_score_threshold_for(pkt_id)
-        storage.store(src.query(since, outliers, z_threshold))
+        with METRICS.time('update_seconds', packet=pkt_id):
+            datums = src.query(since, outliers, z_threshold, max_seconds)
+            with METRICS.time('stage_seconds', stage='store'):
+                storage.store(datums)
+
+    def repair(self, pkt_id, gaps=None):
+        self._validate_packet(pkt_id)
+        interval = self._get_interval(self._config[pkt_id])
+        storage = self._storage_of(pkt_id)
+        if gaps is None:
+            gaps = storage.find_gaps(interval) if storage.exists(interval) else []
+        if not gaps:
+            return 0
+        with METRICS.time('repair_seconds', packet=pkt_id):
+            datums = self._source_of(pkt_id).repair(gaps)
+            if datums.csv.count("\n") == 0:
+                return 0
+            return storage.splice(datums)
+
+    def _make_source(self, pkt_cfg, pair, interval):
+        if self._DERIVE_FROM_KEY not in pkt_cfg:
+            return make_source(pkt_cfg[self._STORAGE_KEY], pkt_cfg[self._SOURCE_KEY], pair, interval,
+                               self._source_options(pkt_cfg), int(pkt_cfg.get(self._BACKFILL_SHARDS_KEY, 1)))
+
+        src_id = pkt_cfg[self._DERIVE_FROM_KEY]
+        self._validate_packet(src_id)
+        src_cfg = self._config[src_id]
+        src_storage = make_storage(src_cfg[self._STORAGE_KEY], src_cfg[self._PAIR_KEY])
+        return make_derived_source(src_storage, self._get_interval(src_cfg), interval)
+
+    def _source_options(self, pkt_cfg):
+        prefix = self._SOURCE_OPTION_PREFIX
+        return {k[len(prefix):]: v for k, v in pkt_cfg.items() if k.startswith(prefix)}
+
+    def update_stages(self, pkt_ids):
+        remaining = list(pkt_ids)
+        stages = []
+        while remaining:
+            stage = [p for p in remaining if self.derived_from(p) not in remaining]
+            if not stage:
+                raise adapters.InvalidDerivationError(f"packets have cyclic derivations: {', '.join(remaining)}")
+            stages.append(stage)
+            remaining = [p for p in remaining if p not in stage]
+        return stages
+
+    def derived_from(self, pkt_id):
+        return self._config.get(pkt_id, {}).get(self._DERIVE_FROM_KEY, None)
 
     def _get_starting_point(self, interval, pkt_cfg, storage):
         if storage.exists(interval):
@@ -70,5 +180,11 @@ class Warehouse:
         return since
 
 
+def _resumed(since, after, step):
+    if after is None:
+        return since
+    return max(since or 0, floor_to_interval(after, step) + step)
+
+
 class MissingPacketError(IOError):
     pass
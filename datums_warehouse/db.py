@@ -1,17 +1,18 @@
 import configparser
 
-from flask import current_app, g
-
 from datums_warehouse.broker.warehouse import Warehouse
+from datums_warehouse.lazy import lazy_import
+
+flask = lazy_import('flask')
 
 
 def get_warehouse():
-    if 'db' not in g:
+    if 'db' not in flask.g:
         cfg = configparser.ConfigParser()
-        cfg.read(current_app.config['WAREHOUSE'])
-        g.db = make_warehouse(cfg)
+        cfg.read(flask.current_app.config['WAREHOUSE'])
+        flask.g.db = make_warehouse(cfg)
 
-    return g.db
+    return flask.g.db
 
 
 def make_warehouse(cfg):
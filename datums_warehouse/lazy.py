@@ -0,0 +1,30 @@
+import importlib
+
+_LAZY_MODULES = {}
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__['_module'] is not None else "not loaded"
+        return f"LazyModule({self.__dict__['_name']}, {state})"
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return self.__dict__['_module']
+
+
+def lazy_import(name):
+    return _LAZY_MODULES.setdefault(name, LazyModule(name))
+
+
+def preload():
+    for module in list(_LAZY_MODULES.values()):
+        module.load()
@@ -0,0 +1,34 @@
+from flask import Blueprint, Response, current_app
+
+from datums_warehouse.broker.metrics import METRICS, MetricsFile, collect
+from datums_warehouse.query_csv import require_auth
+
+bp = Blueprint("metrics", __name__)
+
+
+@bp.after_app_request
+def flush_metrics(response):
+    if 'METRICS_DIR' in current_app.config:
+        _metrics_file().maybe_flush()
+    return response
+
+
+@bp.route("/metrics")
+def expose_metrics():
+    if current_app.config.get('METRICS_PUBLIC', False):
+        return _prometheus()
+    return require_auth(_prometheus)()
+
+
+def _prometheus():
+    if 'METRICS_DIR' not in current_app.config:
+        return Response(METRICS.prometheus(), mimetype="text/plain; version=0.0.4")
+    _metrics_file().flush()
+    return Response(collect(current_app.config['METRICS_DIR']).prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def _metrics_file():
+    if 'metrics_file' not in current_app.extensions:
+        current_app.extensions['metrics_file'] = MetricsFile(current_app.config['METRICS_DIR'], 'query',
+                                                                 per_process=True)
+    return current_app.extensions['metrics_file']
@@ -1,14 +1,31 @@
 import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from flask import Blueprint, current_app, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify, make_response
 from werkzeug.security import check_password_hash
 
+from datums_warehouse.batch import BATCH_MIMETYPE, encode_frame
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.profiling import profiled, profile_file
+from datums_warehouse.broker.storage import MissingDatumError, UnknownFieldError
 from datums_warehouse.broker.validation import DataError, validate
 from datums_warehouse.broker.warehouse import MissingPacketError
 from datums_warehouse.db import get_warehouse
+from datums_warehouse.lazy import lazy_import
+
+adapters = lazy_import('datums_warehouse.broker.adapters')
 
 bp = Blueprint("query_csv", __name__, url_prefix="/api/v1.0/csv/")
+PROFILE_HEADER = "X-Datums-Profile"
+PROFILE_FLAG = "profile"
+FIELDS_PARAM = "fields"
+RESAMPLE_PARAM = "resample"
+LIMIT_PARAM = "limit"
+AFTER_PARAM = "after"
+QUERY_MAX_ROWS = 100000
+BATCH_MAX_QUERIES = 100
+BATCH_WORKERS = 4
 
 
 def _invalid_auth():
@@ -57,16 +74,151 @@ def query_symbols_range(sym, interval, since, until):
     return _retrieve_symbols(sym, interval, since, until)
 
 
+@bp.route("batch", methods=["POST"])
+@require_auth
+def query_batch():
+    try:
+        queries = _parse_batch(request.get_json(silent=True),
+                               current_app.config.get('BATCH_MAX_QUERIES', BATCH_MAX_QUERIES))
+    except InvalidBatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    METRICS.inc('batch_requests_total')
+    METRICS.inc('batch_queries_total', len(queries))
+    workers = min(current_app.config.get('BATCH_WORKERS', BATCH_WORKERS), len(queries))
+    return Response(_stream_batch(get_warehouse(), queries, workers, _max_rows()), mimetype=BATCH_MIMETYPE)
+
+
+def _parse_batch(payload, max_queries):
+    queries = payload.get('queries') if isinstance(payload, dict) else None
+    if not isinstance(queries, list) or len(queries) == 0:
+        raise InvalidBatchError("expected a JSON object with a non empty list of queries")
+    if len(queries) > max_queries:
+        raise InvalidBatchError(f"a batch can contain at most {max_queries} queries, got {len(queries)}")
+    parsed = []
+    for q in queries:
+        if not isinstance(q, list) or not 2 <= len(q) <= 4:
+            raise InvalidBatchError(f"expected [sym, interval, since, until] with optional since and until, got {q}")
+        sym, interval, since, until = q + [None] * (4 - len(q))
+        times_valid = all(_is_int(t) or t is None for t in (since, until))
+        if not isinstance(sym, str) or not _is_int(interval) or not times_valid:
+            raise InvalidBatchError(f"expected a symbol and integer interval, since and until, got {q}")
+        parsed.append((sym, interval, since, until))
+    return parsed
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _stream_batch(warehouse, queries, workers, limit):
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+        futures = [pool.submit(_query, warehouse, f"{sym}/{interval}", since, until, limit)
+                   for sym, interval, since, until in queries]
+        try:
+            for (sym, interval, since, until), future in zip(queries, futures):
+                result = future.result()
+                csv = result.pop('csv') or ""
+                yield encode_frame(dict(sym=sym, interval=interval, since=since, until=until, **result), csv)
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 def _retrieve_symbols(sym, interval, since=None, until=None):
-    warehouse = get_warehouse()
-    pkt_id = f"{sym}/{interval}"
+    file = _requested_profile(sym, interval)
+    if file is None:
+        return _retrieve(sym, interval, since, until)
+
+    with profiled(file):
+        response = make_response(_retrieve(sym, interval, since, until))
+    response.headers[PROFILE_HEADER] = file.name
+    return response
+
+
+def _requested_profile(sym, interval):
+    directory = current_app.config.get('PROFILE_DIR')
+    if not directory:
+        return None
+    if not (_is_set(request.headers.get(PROFILE_HEADER)) or _is_set(request.args.get(PROFILE_FLAG))):
+        return None
+    if request.authorization.username not in _profile_admins():
+        return None
+    return profile_file(directory, 'query', sym, interval)
+
+
+def _is_set(flag):
+    return flag is not None and flag.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+def _profile_admins():
+    admins = current_app.config.get('PROFILE_ADMINS', [])
+    if isinstance(admins, str):
+        admins = admins.split(',')
+    return {a.strip() for a in admins}
+
+
+def _retrieve(sym, interval, since, until):
     try:
-        datums = warehouse.retrieve(pkt_id, since, until)
-    except MissingPacketError as e:
-        return jsonify({"csv": None, 'error': str(e)}), 200
+        fields, resample = _shape_of(request.args)
+        limit, after = _page_of(request.args)
+        result = _query(get_warehouse(), f"{sym}/{interval}", since, until, limit, fields, resample, after)
+        return jsonify(result), 200
+    except (InvalidQueryError, UnknownFieldError, adapters.InvalidDerivationError) as e:
+        return jsonify({'error': str(e)}), 400
 
+
+def _shape_of(args):
+    fields, resample = args.get(FIELDS_PARAM), args.get(RESAMPLE_PARAM)
+    if fields is not None and not all(f.strip() for f in fields.split(',')):
+        raise InvalidQueryError(f"expected a comma separated list of fields, got '{fields}'")
+    if resample is not None and not resample.isdigit():
+        raise InvalidQueryError(f"expected the resample interval in minutes, got '{resample}'")
+    return (None if fields is None else [f.strip() for f in fields.split(',')]), \
+           (None if resample is None else int(resample))
+
+
+def _page_of(args):
+    limit, after = args.get(LIMIT_PARAM), args.get(AFTER_PARAM)
+    if limit is not None and (not limit.isdigit() or int(limit) == 0):
+        raise InvalidQueryError(f"expected a positive number of rows as limit, got '{limit}'")
+    if after is not None and not after.isdigit():
+        raise InvalidQueryError(f"expected a timestamp as after cursor, got '{after}'")
+    return min(_max_rows(), _max_rows() if limit is None else int(limit)), (None if after is None else int(after))
+
+
+def _max_rows():
+    return int(current_app.config.get('QUERY_MAX_ROWS', QUERY_MAX_ROWS))
+
+
+def _query(warehouse, pkt_id, since, until, limit, fields=None, resample=None, after=None):
     try:
-        validate(datums, warehouse.get_exclude_outliers_for(pkt_id), warehouse.get_z_score_threshold_for(pkt_id))
+        with METRICS.time('query_seconds', stage='retrieve'):
+            datums, cursor = warehouse.retrieve_page(pkt_id, limit, since, until, fields, resample, after)
+    except (MissingPacketError, MissingDatumError) as e:
+        return {"csv": None, 'error': str(e)}
+
+    METRICS.inc('query_requests_total', packet=pkt_id)
+    METRICS.inc('query_bytes_total', len(datums.csv), packet=pkt_id)
+    if cursor is not None:
+        METRICS.inc('query_truncated_total', packet=pkt_id)
+    try:
+        with METRICS.time('query_seconds', stage='validate'):
+            validate(datums, warehouse.get_exclude_outliers_for(pkt_id), warehouse.get_z_score_threshold_for(pkt_id))
     except DataError as e:
-        return jsonify({"csv": datums.csv, "warning": str(e)}), 200
-    return jsonify({"csv": datums.csv}), 200
+        return _paged({"csv": datums.csv, "warning": str(e)}, cursor)
+    return _paged({"csv": datums.csv}, cursor)
+
+
+def _paged(result, cursor):
+    if cursor is not None:
+        result['next'] = cursor
+    return result
+
+
+class InvalidQueryError(ValueError):
+    pass
+
+
+class InvalidBatchError(ValueError):
+    pass
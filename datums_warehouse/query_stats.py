@@ -0,0 +1,27 @@
+from flask import Blueprint, jsonify
+
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.summary import NotSummarizableError
+from datums_warehouse.broker.warehouse import MissingPacketError
+from datums_warehouse.db import get_warehouse
+from datums_warehouse.query_csv import require_auth
+
+bp = Blueprint("query_stats", __name__, url_prefix="/api/v1.0/stats/")
+
+
+@bp.route("<string:sym>/<int:interval>/<int:since>/<int:until>")
+@require_auth
+def query_stats(sym, interval, since, until):
+    pkt_id = f"{sym}/{interval}"
+    try:
+        with METRICS.time('query_seconds', stage='stats'):
+            stats = get_warehouse().stats(pkt_id, since, until)
+    except MissingPacketError as e:
+        return jsonify({"stats": None, 'error': str(e)}), 200
+    except NotSummarizableError as e:
+        return jsonify({'error': str(e)}), 400
+
+    METRICS.inc('stats_requests_total', packet=pkt_id)
+    if stats is None:
+        return jsonify({"stats": None, 'warning': f"no bars found between {since} and {until}"}), 200
+    return jsonify({"stats": stats}), 200
@@ -0,0 +1,147 @@
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from datums_warehouse.broker.datums import floor_to_interval
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.profiling import profiled, profile_file
+
+BACKFILL_BARS = 3
+logger = logging.getLogger(__name__)
+
+
+class Schedule:
+    def __init__(self, intervals, delay=5, clock=time.time):
+        self._intervals = dict(intervals)
+        self._delay = delay
+        self._clock = clock
+        self._next = {key: 0 for key in self._intervals}
+
+    def due(self):
+        now = self._clock()
+        return [key for key, t in self._next.items() if t <= now]
+
+    def done(self, keys):
+        now = self._clock()
+        for key in keys:
+            itv = self._intervals[key] * 60
+            self._next[key] = floor_to_interval(now, itv) + itv + self._delay
+
+    def again(self, keys):
+        for key in keys:
+            self._next[key] = self._clock()
+
+    def seconds_until_next(self):
+        return max(min(self._next.values(), default=0) - self._clock(), 0)
+
+
+class UpdateDaemon:
+    def __init__(self, warehouses, delay=5, clock=time.time, profile_dir=None, workers=4, backfill_step=60,
+                 backfill_bars=BACKFILL_BARS, metrics_file=None):
+        self._warehouses = warehouses
+        self._metrics_file = metrics_file
+        self._clock = clock
+        self._profile_dir = profile_dir
+        self._workers = workers
+        self._backfill_step = backfill_step
+        self._backfill_bars = backfill_bars
+        self._intervals = {(i, p): wh.interval_of(p) for i, (wh, pkts) in enumerate(warehouses) for p in pkts}
+        self._schedule = Schedule(self._intervals, delay, clock)
+        self._stop = threading.Event()
+
+    def stop(self, *_):
+        logger.info("stopping update daemon after the current stage")
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def run(self):
+        logger.info("update daemon started")
+        while not self._stop.is_set():
+            self.run_due()
+            self._stop.wait(self._schedule.seconds_until_next())
+        logger.info("update daemon stopped")
+
+    def run_due(self):
+        due = self._schedule.due()
+        lags = self._lags()
+        fresh = [k for k in due if not self._is_backfill(k, lags[k])]
+        backfill = [k for k in due if self._is_backfill(k, lags[k])]
+        METRICS.set('update_queue_depth', len(fresh), kind='fresh')
+        METRICS.set('update_queue_depth', len(backfill), kind='backfill')
+        self._export_metrics()
+        self._run(fresh, lags, 'fresh', max_seconds=None)
+        self._run(backfill, lags, 'backfill', max_seconds=self._backfill_step)
+        self._export_metrics()
+
+    def _export_metrics(self, every_stage=False):
+        if self._metrics_file is None:
+            return
+        if every_stage:
+            self._metrics_file.maybe_flush()
+        else:
+            self._metrics_file.flush()
+
+    def _lags(self):
+        now = self._clock()
+        lags = {}
+        for key in self._intervals:
+            warehouse, pkt = self._warehouses[key[0]][0], key[1]
+            lags[key] = warehouse.lag_of(pkt, now)
+            METRICS.set('packet_lag_seconds', lags[key], packet=pkt)
+        return lags
+
+    def _is_backfill(self, key, lag):
+        return lag > self._backfill_bars * self._intervals[key] * 60
+
+    def _run(self, keys, lags, kind, max_seconds):
+        remaining = len(keys)
+        for i, (warehouse, _) in enumerate(self._warehouses):
+            packets = [p for w, p in keys if w == i]
+            for stage in warehouse.update_stages(packets) if packets else []:
+                if self._stop.is_set():
+                    return
+                stage = sorted(stage, key=lambda p: lags[(i, p)], reverse=True)
+                failed = self._update_stage(warehouse, stage, max_seconds)
+                self._reschedule(i, warehouse, stage, failed, lags)
+                remaining -= len(stage)
+                METRICS.set('update_queue_depth', remaining, kind=kind)
+                self._export_metrics(every_stage=True)
+
+    def _update_stage(self, warehouse, stage, max_seconds):
+        failed = set()
+        workers = 1 if self._profile_dir is not None else min(self._workers, len(stage))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update") as pool:
+            for pkt, future in [(p, pool.submit(self._update, warehouse, p, max_seconds)) for p in stage]:
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"updating packet {pkt} failed, retrying at its next interval")
+                    failed.add(pkt)
+        return failed
+
+    def _reschedule(self, i, warehouse, stage, failed, lags):
+        now = self._clock()
+        lagging = []
+        for key in [(i, p) for p in stage if p not in failed]:
+            lag = warehouse.lag_of(key[1], now)
+            if self._is_backfill(key, lag) and lag < lags[key]:
+                lagging.append(key)
+        self._schedule.again(lagging)
+        self._schedule.done([(i, p) for p in stage if (i, p) not in lagging])
+
+    def _update(self, warehouse, pkt, max_seconds):
+        if self._profile_dir is None:
+            warehouse.update(pkt, max_seconds)
+            return
+        with profiled(profile_file(self._profile_dir, 'update', pkt)):
+            warehouse.update(pkt, max_seconds)
+
+
+def handle_signals(daemon):  # pragma: no cover process wiring
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, daemon.stop)
@@ -0,0 +1,30 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def pid_lock(file):
+    file = Path(file)
+    with open(file, mode='a+') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.seek(0)
+            raise LockError(f"another process ({lock.read().strip() or 'unknown pid'}) is already updating the "
+                            f"warehouse, lock: {file}")
+        try:
+            lock.seek(0)
+            lock.truncate()
+            lock.write(str(os.getpid()))
+            lock.flush()
+            yield
+        finally:
+            lock.seek(0)
+            lock.truncate()
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class LockError(IOError):
+    pass
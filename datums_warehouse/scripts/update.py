@@ -1,17 +1,40 @@
+import logging
 from threading import Thread
 
+from datums_warehouse.broker.profiling import profiled, profile_file
 from datums_warehouse.db import make_warehouse
 
+logger = logging.getLogger(__name__)
 
-def update_pairs(cfg, pairs):
+
+def update_pairs(cfg, pairs, profile_dir=None):
     def update_pair(wh_cfg, pair):
         wh = make_warehouse(wh_cfg)
-        wh.update(pair)
+        if profile_dir is None:
+            wh.update(pair)
+            return
+        with profiled(profile_file(profile_dir, 'update', pair)):
+            wh.update(pair)
+
+    for stage in make_warehouse(cfg).update_stages(pairs):
+        if profile_dir is not None:
+            for pair in stage:
+                update_pair(cfg, pair)
+            continue
+
+        processes = [Thread(target=update_pair, name=f"process: {p}", args=(cfg, p)) for p in stage]
+
+        for prc in processes:
+            prc.start()
 
-    processes = [Thread(target=update_pair, name=f"process: {p}", args=(cfg, p)) for p in pairs]
+        for prc in processes:
+            prc.join()
 
-    for prc in processes:
-        prc.start()
 
-    for prc in processes:
-        prc.join()
+def repair_pairs(warehouse, pairs):
+    repaired = {}
+    for stage in warehouse.update_stages(pairs):
+        for pair in stage:
+            repaired[pair] = warehouse.repair(pair)
+            logger.info(f"repaired {repaired[pair]} bars of {pair}")
+    return repaired
@@ -0,0 +1,250 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+from datums_warehouse.broker.datums import floor_to_interval
+from datums_warehouse.broker.metrics import METRICS
+
+LEASE_SECONDS = 300
+logger = logging.getLogger(__name__)
+
+
+class SqliteQueue:
+    _SCHEMA = "CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, due REAL NOT NULL, after TEXT, " \
+              "owner TEXT, expires REAL)"
+
+    def __init__(self, file, lease_seconds=LEASE_SECONDS):
+        self._file = str(file)
+        self._lease_seconds = lease_seconds
+        with self._transaction() as db:
+            db.execute(self._SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with closing(sqlite3.connect(self._file, timeout=30, isolation_level=None)) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def enqueue(self, key, due, after=None):
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO jobs (key, due, after) VALUES (?, ?, ?)", (key, due, after))
+            db.execute("UPDATE jobs SET after = ? WHERE key = ?", (after, key))
+
+    def lease(self, worker, now, keys=None):
+        with self._transaction() as db:
+            jobs = db.execute("SELECT key, due, after, owner, expires FROM jobs").fetchall()
+            job = _next_job({k: (d, a, o, e) for k, d, a, o, e in jobs}, now, keys)
+            if job is None:
+                return None
+            db.execute("UPDATE jobs SET owner = ?, expires = ? WHERE key = ?", (worker, now + self._lease_seconds, job))
+            return job
+
+    def renew(self, key, worker, now):
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET expires = ? WHERE key = ? AND owner = ?",
+                              (now + self._lease_seconds, key, worker)).rowcount == 1
+
+    def complete(self, key, worker, next_due):
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET due = ?, owner = NULL, expires = NULL WHERE key = ? AND owner = ?",
+                              (next_due, key, worker)).rowcount == 1
+
+    def depth(self, now):
+        with self._transaction() as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE due <= ? AND (owner IS NULL OR expires <= ?)",
+                              (now, now)).fetchone()[0]
+
+
+class FileQueue:
+    def __init__(self, directory, lease_seconds=LEASE_SECONDS):
+        self._directory = Path(directory)
+        self._lease_seconds = lease_seconds
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with open(self._directory / "queue.lock", mode='a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _job_file(self, key):
+        return self._directory / f"{quote(key, safe='')}.job"
+
+    def _read(self, key):
+        file = self._job_file(key)
+        if not file.exists():
+            return None
+        return json.loads(file.read_text())
+
+    def _write(self, key, job):
+        tmp = self._job_file(key).with_suffix('.tmp')
+        tmp.write_text(json.dumps(job))
+        os.replace(tmp, self._job_file(key))
+
+    def _jobs(self):
+        return {unquote(f.stem): json.loads(f.read_text()) for f in self._directory.glob("*.job")}
+
+    def enqueue(self, key, due, after=None):
+        with self._locked():
+            job = self._read(key) or dict(due=due, owner=None, expires=None)
+            job['after'] = after
+            self._write(key, job)
+
+    def lease(self, worker, now, keys=None):
+        with self._locked():
+            jobs = self._jobs()
+            key = _next_job({k: (j['due'], j['after'], j['owner'], j['expires']) for k, j in jobs.items()}, now, keys)
+            if key is None:
+                return None
+            self._write(key, dict(jobs[key], owner=worker, expires=now + self._lease_seconds))
+            return key
+
+    def renew(self, key, worker, now):
+        with self._locked():
+            job = self._read(key)
+            if job is None or job['owner'] != worker:
+                return False
+            self._write(key, dict(job, expires=now + self._lease_seconds))
+            return True
+
+    def complete(self, key, worker, next_due):
+        with self._locked():
+            job = self._read(key)
+            if job is None or job['owner'] != worker:
+                return False
+            self._write(key, dict(job, due=next_due, owner=None, expires=None))
+            return True
+
+    def depth(self, now):
+        with self._locked():
+            return sum(j['due'] <= now and (j['owner'] is None or j['expires'] <= now) for j in self._jobs().values())
+
+
+def _next_job(jobs, now, keys=None):
+    def is_pending(key):
+        due, _, owner, expires = jobs[key]
+        return due <= now or (owner is not None and expires > now)
+
+    for key, (due, after, owner, expires) in sorted(jobs.items(), key=lambda j: (j[1][0], j[0])):
+        if due > now or (owner is not None and expires > now) or (keys is not None and key not in keys):
+            continue
+        if after in jobs and is_pending(after):
+            continue
+        if owner is not None:
+            logger.warning(f"lease of {owner} on {key} expired, taking it over")
+            METRICS.inc('queue_leases_expired_total')
+        return key
+    return None
+
+
+QUEUE_BACKENDS = {
+    'sqlite': SqliteQueue,
+    'file': FileQueue,
+}
+
+
+def open_queue(spec, lease_seconds=LEASE_SECONDS):
+    backend, sep, location = spec.partition(':')
+    if not sep or backend not in QUEUE_BACKENDS:
+        raise UnknownQueueError(f"unknown work queue {spec}, expected one of "
+                                f"{', '.join(f'{b}:<path>' for b in QUEUE_BACKENDS)}")
+    return QUEUE_BACKENDS[backend](location, lease_seconds)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class QueueWorker:
+    def __init__(self, queue, warehouses, worker_id=None, delay=5, clock=time.time, poll_seconds=1.0,
+                 lease_seconds=LEASE_SECONDS, metrics_file=None):
+        self._queue = queue
+        self._metrics_file = metrics_file
+        self._packets = {f"{name}/{p}": (name, wh, p) for name, wh, pkts in warehouses for p in pkts}
+        self._worker_id = worker_id or default_worker_id()
+        self._delay = delay
+        self._clock = clock
+        self._poll_seconds = poll_seconds
+        self._lease_seconds = lease_seconds
+        self._stop = threading.Event()
+
+    def enqueue_all(self):
+        for key, (name, warehouse, pkt) in self._packets.items():
+            src = warehouse.derived_from(pkt)
+            after = f"{name}/{src}" if src is not None else None
+            self._queue.enqueue(key, 0, after if after in self._packets else None)
+
+    def stop(self, *_):
+        logger.info(f"stopping queue worker {self._worker_id} after the current job")
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def run(self):
+        logger.info(f"queue worker {self._worker_id} started")
+        self.enqueue_all()
+        while not self._stop.is_set():
+            if not self.run_once():
+                self._stop.wait(self._poll_seconds)
+        logger.info(f"queue worker {self._worker_id} stopped")
+
+    def run_once(self):
+        now = self._clock()
+        METRICS.set('queue_depth', self._queue.depth(now))
+        if self._metrics_file is not None:
+            self._metrics_file.maybe_flush()
+        key = self._queue.lease(self._worker_id, now, self._packets.keys())
+        if key is None:
+            return False
+        _, warehouse, pkt = self._packets[key]
+        try:
+            with self._renewing(key):
+                warehouse.update(pkt)
+            METRICS.inc('queue_jobs_completed_total')
+        except Exception:
+            METRICS.inc('queue_jobs_failed_total')
+            logger.exception(f"updating packet {key} failed, retrying at its next interval")
+        finally:
+            itv = warehouse.interval_of(pkt) * 60
+            next_due = floor_to_interval(self._clock(), itv) + itv + self._delay
+            if not self._queue.complete(key, self._worker_id, next_due):
+                logger.warning(f"lease of {self._worker_id} on {key} was taken over before completing")
+        return True
+
+    @contextmanager
+    def _renewing(self, key):
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self._lease_seconds / 3):
+                self._queue.renew(key, self._worker_id, self._clock())
+
+        heartbeat = threading.Thread(target=renew, name=f"lease: {key}", daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            done.set()
+            heartbeat.join()
+
+
+class UnknownQueueError(NotImplementedError):
+    pass
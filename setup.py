@@ -21,7 +21,9 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=['flask', 'werkzeug', 'pandas', 'numpy', 'requests', 'click', 'uwsgi', 'wheel', 'more_itertools'],
-    extras_require={"test": ["pytest", "pytest-cov"]},
+    extras_require={"test": ["pytest", "pytest-cov"], "fast": ["zstandard", "lz4", "orjson"]},
     scripts=['scripts/update_warehouse'],
+    entry_points={'datums_warehouse.sources': ['Kraken = datums_warehouse.broker.kraken:KrakenExchange',
+                                               'Replay = datums_warehouse.broker.replay:ReplayExchange']},
     python_requires='>=3.6'
 )
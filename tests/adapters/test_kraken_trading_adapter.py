@@ -1,7 +1,9 @@
+import numpy as np
 import pytest
 
-from datums_warehouse.broker.adapters import KrakenAdapter
-from datums_warehouse.broker.source import get_trades
+from datums_warehouse.broker.adapters import KrakenAdapter, BarsAdapter, InvalidDerivationError, AggregationState
+from datums_warehouse.broker.kraken import get_trades
+from datums_warehouse.broker.trades import NANO_SECONDS, as_trades
 from datums_warehouse.broker.validation import DataError
 
 EXPECTED_OHLC = "timestamp,open,high,low,close,vwap,volume,count\n" \
@@ -91,3 +93,138 @@ def test_find_gaps_in_real_data(make_adapter):
     from datums_warehouse.broker.datums import CsvDatums
     with pytest.raises(DataError):
         validate(CsvDatums(30, adapter(get_trades(json.loads(FRAGMENTED_TRADES)))), z_score_threshold=20)
+
+
+@pytest.fixture
+def make_bars_adapter():
+    def adapter_fac(interval, source_interval=1):
+        return BarsAdapter(interval, source_interval)
+
+    return adapter_fac
+
+
+def bars(*lines):
+    return "timestamp,open,high,low,close,vwap,volume,count\n" + "\n".join(lines)
+
+
+@pytest.mark.parametrize("interval,source_interval", [(1, 1), (5, 30), (7, 5)])
+def test_bars_can_only_be_derived_from_finer_multiples(make_bars_adapter, interval, source_interval):
+    with pytest.raises(InvalidDerivationError):
+        make_bars_adapter(interval, source_interval)
+
+
+@pytest.mark.parametrize("csv", ["", bars()])
+def test_resample_empty_bars(make_bars_adapter, csv):
+    assert make_bars_adapter(interval=5)(csv) == "timestamp,open,high,low,close,vwap,volume,count"
+
+
+def test_resample_bars_to_coarser_interval(make_bars_adapter):
+    adapter = make_bars_adapter(interval=2)
+    assert adapter(bars("0,1.0,3.0,1.0,2.0,2.0,10.0,3",
+                        "60,2.0,4.0,0.5,3.0,4.0,30.0,2",
+                        "120,3.0,3.0,3.0,3.0,3.0,5.0,1",
+                        "180,3.0,5.0,2.0,4.0,4.0,5.0,4")) == \
+           "timestamp,open,high,low,close,vwap,volume,count\n" \
+           "0,1.0,4.0,0.5,3.0,3.5,40.0,5\n" \
+           "120,3.0,5.0,2.0,4.0,3.5,10.0,5"
+
+
+def test_resampled_vwap_is_truncated_like_trade_aggregation(make_bars_adapter):
+    adapter = make_bars_adapter(interval=2)
+    assert adapter(bars("0,1.0,1.0,1.0,1.0,1.0,2.0,1",
+                        "60,2.0,2.0,2.0,2.0,2.0,1.0,1")) == \
+           "timestamp,open,high,low,close,vwap,volume,count\n" \
+           "0,1.0,2.0,1.0,2.0,1.3,3.0,2"
+
+
+def test_resample_drops_incomplete_last_bucket(make_bars_adapter):
+    adapter = make_bars_adapter(interval=3)
+    assert adapter(bars("0,1.0,1.0,1.0,1.0,1.0,1.0,1",
+                        "180,2.0,2.0,2.0,2.0,2.0,1.0,1",
+                        "240,2.0,2.0,2.0,2.0,2.0,1.0,1")) == \
+           "timestamp,open,high,low,close,vwap,volume,count\n" \
+           "0,1.0,1.0,1.0,1.0,1.0,1.0,1"
+
+
+def test_resample_skips_gaps(make_bars_adapter):
+    adapter = make_bars_adapter(interval=60, source_interval=30)
+    assert adapter(bars("0,1.0,1.0,1.0,1.0,1.0,1.0,1",
+                        "7200,2.0,2.0,2.0,2.0,2.0,1.0,1",
+                        "9000,3.0,3.0,3.0,3.0,3.0,1.0,1")) == \
+           "timestamp,open,high,low,close,vwap,volume,count\n" \
+           "0,1.0,1.0,1.0,1.0,1.0,1.0,1\n" \
+           "7200,2.0,3.0,2.0,3.0,2.5,2.0,2"
+
+
+def test_resampling_fine_bars_equals_aggregating_trades(make_adapter, make_bars_adapter):
+    import json
+    fine = make_adapter(interval=1)(get_trades(json.loads(RAW_TRADES)))
+    coarse = make_adapter(interval=30)(get_trades(json.loads(RAW_TRADES)))
+    resampled = make_bars_adapter(interval=30)(fine)
+    assert _without_vwap(resampled) == _without_vwap(coarse)
+
+
+def _without_vwap(csv):
+    return [l.split(',')[:5] + l.split(',')[6:] for l in csv.split('\n')]
+
+
+def test_carry_open_bucket_between_calls(adapter):
+    state = AggregationState()
+    assert KrakenAdapter(1, state)(trades(trade(1, 10, 0), trade(3, 20, 1))) == \
+           "timestamp,open,high,low,close,vwap,volume,count"
+    assert KrakenAdapter(1, state)(trades(trade(2, 10, 2), trade(1, 10, 61))) == \
+           "timestamp,open,high,low,close,vwap,volume,count\n" \
+           "0,1.0,3.0,1.0,2.0,2.2,40.0,3"
+
+
+def test_state_tracks_consumed_trades_with_equal_timestamps():
+    state = AggregationState()
+    KrakenAdapter(1, state)(trades(trade(1, 1, 0), trade(2, 1, 1), trade(3, 1, 1)))
+    assert state.cursor == (NANO_SECONDS, 2)
+    KrakenAdapter(1, state)(trades(trade(4, 1, 1)))
+    assert state.cursor == (NANO_SECONDS, 3)
+    unseen = state.unseen(trades(trade(2, 1, 1), trade(3, 1, 1), trade(4, 1, 1), trade(5, 1, 1), trade(6, 1, 2)))
+    assert np.array_equal(unseen, as_trades(trades(trade(5, 1, 1), trade(6, 1, 2))))
+
+
+@pytest.mark.parametrize("since,continues", [(0, False), (1, True), (60, True), (61, False)])
+def test_state_continues_only_right_after_last_emitted_bar(since, continues):
+    state = AggregationState()
+    KrakenAdapter(1, state)(trades(trade(1, 1, 0), trade(2, 1, 61)))
+    assert state.continues(since) == continues
+
+
+def test_state_is_persistent(tmp_path):
+    state = AggregationState()
+    KrakenAdapter(1, state)(trades(trade(1, 10, 0), trade(3, 20, 61.5)))
+    state.save(tmp_path / "state")
+    loaded = AggregationState.load(tmp_path / "state")
+    assert loaded.cursor == (61.5 * NANO_SECONDS, 1) and loaded.last_emitted == 0
+    assert KrakenAdapter(1, loaded)(trades(trade(1, 10, 121))) == \
+           "timestamp,open,high,low,close,vwap,volume,count\n" \
+           "60,3.0,3.0,3.0,3.0,3.0,20.0,1"
+
+
+def test_load_missing_state(tmp_path):
+    assert not AggregationState.load(tmp_path / "state").continues(0)
+
+
+def test_resample_only_requested_fields(make_bars_adapter):
+    adapter = make_bars_adapter(interval=2)
+    assert adapter(bars("0,1.0,3.0,1.0,2.0,2.0,10.0,3",
+                        "60,2.0,4.0,0.5,3.0,4.0,30.0,2"), fields=['close', 'vwap', 'timestamp']) == \
+           "close,vwap,timestamp\n" \
+           "3.0,3.5,0"
+
+
+def test_resample_from_projected_bars(make_bars_adapter):
+    adapter = make_bars_adapter(interval=2)
+    assert adapter.inputs_of(['close', 'vwap']) == ['timestamp', 'close', 'vwap', 'volume']
+    assert adapter("timestamp,close,vwap,volume\n0,2.0,2.0,10.0\n60,3.0,4.0,30.0", fields=['close', 'vwap']) == \
+           "close,vwap\n3.0,3.5"
+
+
+@pytest.mark.parametrize("fields,csv", [(['median'], bars()), (None, "timestamp,c1\n0,1\n60,2")])
+def test_resampling_requires_known_bar_columns(make_bars_adapter, fields, csv):
+    with pytest.raises(InvalidDerivationError):
+        make_bars_adapter(interval=2)(csv, fields)
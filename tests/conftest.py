@@ -10,6 +10,8 @@ import pytest
 from werkzeug.security import generate_password_hash
 
 from datums_warehouse import create_app
+from datums_warehouse.broker.datums import CsvDatums
+from datums_warehouse.broker.storage import Storage
 
 TEST_USER = "user"
 TEST_PASSWORD = "pass"
@@ -78,6 +80,16 @@ def app(tmp_path, credentials, write_csv, warehouse_cfg, default_validation_cfg)
     yield create_app({'TESTING': True, 'CREDENTIALS': credentials, 'WAREHOUSE': cfg_file, 'SECRET_KEY': "dev"})
 
 
+@pytest.fixture
+def ohlc_packet(app, tmp_path):
+    with open(app.config['WAREHOUSE'], mode='a') as f:
+        f.write(f"[OHLC_SYM/1]\nstorage = {tmp_path / 'csv'}\ninterval = 1\npair = OHLC_SYM\n")
+    lines = [f"{t},{i}.0,{i + 2}.0,{i - 1}.0,{i + 1}.0,{i}.5,1.0,1" for i, t in enumerate(range(3600, 3600 * 4, 60))]
+    Storage(tmp_path / 'csv' / 'OHLC_SYM').store(CsvDatums(1, "timestamp,open,high,low,close,vwap,volume,count\n" +
+                                                             "\n".join(lines)))
+    return "OHLC_SYM", 1
+
+
 @pytest.fixture
 def client(app):
     with app.test_client() as c:
@@ -110,13 +122,13 @@ class Query:
         finally:
             self.default_auth()
 
-    def symbol(self, sym='TEST_SYM', interval=30, since=None, until=None):
+    def symbol(self, sym='TEST_SYM', interval=30, since=None, until=None, params=None):
         url = [f'/api/v1.0/csv/{sym}/{interval}']
         if since is not None:
             url.append(str(since))
         if until is not None:
             url.append(str(until))
-        return self._client.get("/".join(url), **self._auth_args)
+        return self._client.get("/".join(url), query_string=params, **self._auth_args)
 
 
 @pytest.fixture
@@ -1,13 +1,22 @@
+import json
 import logging
 import random
+import time
 from itertools import repeat
 
 import pytest
 
+import datums_warehouse.broker.kraken as kraken
 import datums_warehouse.broker.source as module_under_test
+from datums_warehouse.broker.adapters import AggregationState, KrakenAdapter
+from datums_warehouse.broker.cache import TradesCache
 from datums_warehouse.broker.datums import CsvDatums
-from datums_warehouse.broker.source import KrakenSource, to_nano_sec, LEDGER_FREQUENCY, KrakenServerTime, \
-    InvalidFormatError, ResponseError
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.kraken import KrakenExchange, KrakenServerTime, LEDGER_FREQUENCY, InvalidFormatError, \
+    ResponseError
+from datums_warehouse.broker.source import TradesSource, to_nano_sec, DerivedSource
+from datums_warehouse.broker.storage import Storage
+from datums_warehouse.broker.trades import NANO_SECONDS
 from datums_warehouse.broker.validation import DataError
 
 START_TIME_S = 1559347200
@@ -33,6 +42,10 @@ class GetResponse:
     def json(self):
         return self._json
 
+    @property
+    def content(self):
+        return json.dumps(self._json).encode()
+
 
 def make_default_json_response():
     return {'result': {'pair': [[0] * 6], 'last': str(to_nano_sec(START_TIME_S * 2))}, 'error': []}
@@ -40,7 +53,7 @@ def make_default_json_response():
 
 class AdaptedData:
     def __init__(self, trades, with_interval):
-        self.trades = trades
+        self.trades = as_rows(trades)
         self.interval = with_interval
 
     def __repr__(self):
@@ -50,6 +63,13 @@ class AdaptedData:
         return self.trades == other.trades and self.interval == other.interval
 
 
+def as_rows(trades):
+    if isinstance(trades, list):
+        return trades
+    return [[p, v, t / NANO_SECONDS] for t, p, v in zip(trades['time'].tolist(), trades['price'].tolist(),
+                                                         trades['volume'].tolist())]
+
+
 class RequestStub:
     def __init__(self):
         self.data_responses = [GetResponse()]
@@ -65,20 +85,26 @@ class RequestStub:
         self.response_iter = self.response_iter or iter(self.data_responses)
         return next(self.response_iter)
 
+    def Session(self):
+        return self
+
 
 class RequestsSpy(RequestStub):
     def __init__(self):
         super().__init__()
         self.received_get = None
+        self.num_gets = 0
 
     def get(self, url, params=None):
         self.received_get = GetRequest(url, params or {})
+        self.num_gets += 1
         return super().get(url, params)
 
 
 class AdapterStub:
-    def __init__(self, interval):
+    def __init__(self, interval, state=None):
         self._interval = interval
+        self.state = state or AggregationState()
 
     def __call__(self, data):
         return AdaptedData(data, self._interval)
@@ -87,13 +113,18 @@ class AdapterStub:
 class LocalTimeSpy:
     def __init__(self):
         self.received_sleeps = []
+        self.elapsed = 0
 
     def sleep(self, seconds):
         self.received_sleeps.append(seconds)
+        self.elapsed += seconds
 
     def time(self):
         return 0
 
+    def monotonic(self):
+        return self.elapsed
+
 
 class ServerTimeStub:
     def __init__(self):
@@ -143,8 +174,9 @@ def source_interval():
 
 
 @pytest.fixture
-def source(source_interval, tmp_path):
-    return KrakenSource(trades_storage=tmp_path, pair="xbtusd", interval=source_interval, max_results=10)
+def source(requests, source_interval, tmp_path):
+    exchange = KrakenExchange("xbtusd", module_under_test.make_session())
+    return TradesSource(exchange, trades_storage=tmp_path, interval=source_interval, max_results=10)
 
 
 @pytest.fixture(autouse=True)
@@ -170,7 +202,7 @@ def local_time(monkeypatch, source_interval):
 def server_time(monkeypatch, source_interval):
     s = ServerTimeStub()
     s.set_current_time(START_TIME_S + source_interval + 1)
-    monkeypatch.setattr(module_under_test, 'KrakenServerTime', lambda: s)
+    monkeypatch.setattr(kraken, 'KrakenServerTime', lambda http, url: s)
     return s
 
 
@@ -214,6 +246,12 @@ class TestKrakenSource:
         assert requests.received_get == make_get("https://api.kraken.com/0/public/Trades", pair="xbtusd",
                                                  since=START_TIME_NS)
 
+    def test_kraken_exchange_can_be_pointed_to_another_url(self, requests, tmp_path, source_interval):
+        exchange = KrakenExchange("xbtusd", module_under_test.make_session(), url="http://localhost:8042/")
+        TradesSource(exchange, trades_storage=tmp_path, interval=source_interval).query(since=START_TIME_S)
+        assert requests.received_get == make_get("http://localhost:8042/0/public/Trades", pair="xbtusd",
+                                                 since=START_TIME_NS)
+
     @pytest.mark.parametrize("invalid", [dict(), dict(result={'pair': []}), dict(error=[])])
     def test_invalid_kraken_api_format(self, requests, source, invalid):
         requests.set_get_response(json=invalid)
@@ -271,6 +309,17 @@ class TestKrakenSource:
             LEDGER_FREQUENCY + randomness.history[-1]
         ]
 
+    def test_queries_stop_fetching_once_their_time_budget_is_used_up(self, source, source_interval, requests,
+                                                                     server_time, make_json):
+        server_time.set_current_time(START_TIME_S + source_interval * 3 * 60 + 10)
+        requests.set_get_responses(
+            make_json({'pair': expand_to_trades(1)}, last=to_nano_sec(START_TIME_S + source_interval * 60)),
+            make_json({'pair': expand_to_trades(2)}, last=to_nano_sec(START_TIME_S + source_interval * 2 * 60)),
+        )
+
+        source.query(since=START_TIME_S, max_seconds=1)
+        assert requests.num_gets == 1
+
     def test_subsequent_queries_use_cache_instead_of_remote(self, source, source_interval, requests, server_time,
                                                             local_time, make_json):
         server_time.set_current_time(START_TIME_S + source_interval * 2 * 60 + 10)
@@ -337,6 +386,17 @@ class TestKrakenSource:
         assert source.query(since=START_TIME_S) == csv_datums_from(adapted)
         assert len(local_time.received_sleeps) == 3
 
+    def test_fetch_and_cache_metrics_are_recorded(self, source, requests, make_json, source_interval):
+        METRICS.reset()
+        requests.set_get_response(json=make_json({'pair': expand_to_trades(1, 2)}))
+        source.query(since=START_TIME_S)
+        source.query(since=START_TIME_S)
+        counters = METRICS.summary()['counters']
+        assert counters['pages_fetched_total'] == 1 and counters['trades_fetched_total'] == 2
+        assert counters['cache_misses_total'] == 1 and counters['cache_hits_total'] == 1
+        assert METRICS.summary()['timers']['stage_seconds{stage=aggregate}']['count'] == 2
+        METRICS.reset()
+
     def test_logs_warning_on_invalid_data(self, source, validation, caplog):
         caplog.set_level(logging.WARNING)
         validation.set_raises(DataError)
@@ -347,7 +407,7 @@ class TestKrakenSource:
 def test_kraken_server_time_queries_url_correctly(requests):
     requests.set_get_response(
         json={"error": [], "result": {"unixtime": 1572715612, "rfc1123": "Sat,  2 Nov 19 17:26:52 +0000"}})
-    time = KrakenServerTime()
+    time = KrakenServerTime(requests)
     time.now()
     assert requests.received_get == make_get("https://api.kraken.com/0/public/Time")
 
@@ -355,5 +415,146 @@ def test_kraken_server_time_queries_url_correctly(requests):
 def test_kraken_server_time_returns_unix_time(requests):
     requests.set_get_response(
         json={"error": [], "result": {"unixtime": 1572715612, "rfc1123": "Sat,  2 Nov 19 17:26:52 +0000"}})
-    time = KrakenServerTime()
+    time = KrakenServerTime(requests)
     assert time.now() == 1572715612
+
+
+class SlowCacheWrites:
+    def __init__(self, requests, monkeypatch, fail_with=None):
+        self.requests = requests
+        self.fail_with = fail_with
+        self.requests_while_writing = []
+        update = TradesCache.update
+
+        def slow_update(cache, trades, last):
+            if self.fail_with:
+                raise self.fail_with("disk full")
+            deadline = time.monotonic() + 1
+            while self.requests.num_gets < 2 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            self.requests_while_writing.append(self.requests.num_gets)
+            update(cache, trades, last)
+
+        monkeypatch.setattr(TradesCache, 'update', slow_update)
+
+
+@pytest.mark.usefixtures("server_time")
+class TestPrefetch:
+    @pytest.fixture
+    def two_pages(self, requests, server_time, make_json, source_interval):
+        server_time.set_current_time(START_TIME_S + source_interval * 3 * 60 + 10)
+        requests.set_get_responses(
+            make_json({'pair': expand_to_trades(1)}, last=to_nano_sec(START_TIME_S + source_interval * 60)),
+            make_json({'pair': expand_to_trades(2)}, last=to_nano_sec(START_TIME_S + source_interval * 3 * 60)),
+        )
+
+    def test_next_page_is_requested_while_current_page_is_written(self, source, requests, two_pages, monkeypatch):
+        writes = SlowCacheWrites(requests, monkeypatch)
+        source.query(since=START_TIME_S)
+        assert writes.requests_while_writing[0] == 2
+
+    def test_pages_before_a_failing_request_are_stored(self, source, requests, server_time, make_json, tmp_path,
+                                                       source_interval):
+        server_time.set_current_time(START_TIME_S + source_interval * 3 * 60 + 10)
+        requests.set_get_responses(
+            make_json({'pair': expand_to_trades(1)}, last=to_nano_sec(START_TIME_S + source_interval * 60)),
+            make_json({'pair': expand_to_trades(2)}, with_error=['some error']),
+        )
+        with pytest.raises(ResponseError):
+            source.query(since=START_TIME_S)
+        with TradesCache(tmp_path / "xbtusd" / "kraken_cache") as cache:
+            assert cache.last_timestamp() == to_nano_sec(START_TIME_S + source_interval * 60)
+
+    def test_failing_cache_writes_stop_fetching(self, source, requests, two_pages, monkeypatch):
+        SlowCacheWrites(requests, monkeypatch, fail_with=OSError)
+        with pytest.raises(OSError):
+            source.query(since=START_TIME_S)
+        assert requests.num_gets <= 1 + module_under_test.PREFETCH_PAGES
+
+
+@pytest.fixture
+def aggregating_adapter(monkeypatch):
+    monkeypatch.setattr(module_under_test, 'KrakenAdapter', KrakenAdapter)
+
+
+@pytest.mark.usefixtures("server_time", "aggregating_adapter")
+class TestIncrementalAggregation:
+    BUCKET = 30 * 60
+
+    @pytest.fixture
+    def first_update(self, source, requests, server_time, make_json):
+        server_time.set_current_time(START_TIME_S + 2 * self.BUCKET + 10)
+        requests.set_get_responses(
+            make_json({'pair': expand_to_trades(1, 2, ts_range=[START_TIME_S + 1, START_TIME_S + self.BUCKET + 1])},
+                      last=to_nano_sec(START_TIME_S + 2 * self.BUCKET)),
+            make_json({'pair': expand_to_trades(3, ts_range=[START_TIME_S + 2 * self.BUCKET + 1])},
+                      last=to_nano_sec(START_TIME_S + 3 * self.BUCKET)),
+        )
+        return source.query(since=START_TIME_S)
+
+    def test_open_bucket_is_not_emitted(self, first_update):
+        assert first_update.csv == "timestamp,open,high,low,close,vwap,volume,count\n" \
+                                   f"{START_TIME_S},1.0,1.0,1.0,1.0,1.0,1.0,1"
+
+    def test_continue_with_persisted_open_bucket(self, first_update, source, server_time):
+        server_time.set_current_time(START_TIME_S + 3 * self.BUCKET + 10)
+        assert source.query(since=START_TIME_S + 30).csv == "timestamp,open,high,low,close,vwap,volume,count\n" \
+                                                            f"{START_TIME_S + self.BUCKET},2.0,2.0,2.0,2.0,2.0,2.0,1"
+
+    def test_state_is_named_after_the_exchange_cache(self, first_update, tmp_path):
+        assert (tmp_path / "xbtusd" / "kraken_cache_aggregation_30").exists()
+        assert not (tmp_path / "xbtusd" / "aggregation_30").exists()
+
+    def test_continue_with_legacy_state_file(self, first_update, source, server_time, tmp_path):
+        (tmp_path / "xbtusd" / "kraken_cache_aggregation_30").rename(tmp_path / "xbtusd" / "aggregation_30")
+        server_time.set_current_time(START_TIME_S + 3 * self.BUCKET + 10)
+        assert source.query(since=START_TIME_S + 30).csv == "timestamp,open,high,low,close,vwap,volume,count\n" \
+                                                            f"{START_TIME_S + self.BUCKET},2.0,2.0,2.0,2.0,2.0,2.0,1"
+
+    def test_rebuild_when_query_does_not_continue_stored_state(self, first_update, source, server_time):
+        server_time.set_current_time(START_TIME_S + 3 * self.BUCKET + 10)
+        assert source.query(since=START_TIME_S).csv == "timestamp,open,high,low,close,vwap,volume,count\n" \
+                                                       f"{START_TIME_S},1.0,1.0,1.0,1.0,1.0,1.0,1\n" \
+                                                       f"{START_TIME_S + self.BUCKET},2.0,2.0,2.0,2.0,2.0,2.0,1"
+
+
+@pytest.fixture
+def fine_storage(tmp_path):
+    return Storage(tmp_path / "fine")
+
+
+@pytest.fixture
+def derived_source(fine_storage):
+    return DerivedSource(fine_storage, source_interval=1, interval=2)
+
+
+class TestDerivedSource:
+    def test_missing_source_packet_results_in_empty_datums(self, derived_source, validation):
+        expected = CsvDatums(2, "timestamp,open,high,low,close,vwap,volume,count")
+        assert derived_source.query(since=0) == expected
+        assert validation.data == expected
+
+    def test_derives_bars_from_stored_finer_packet(self, derived_source, fine_storage, validation):
+        fine_storage.store(CsvDatums(1, "timestamp,open,high,low,close,vwap,volume,count\n"
+                                        "0,1.0,1.0,1.0,1.0,1.0,1.0,1\n"
+                                        "60,2.0,2.0,2.0,2.0,2.0,1.0,1\n"
+                                        "120,3.0,3.0,3.0,3.0,3.0,1.0,1\n"))
+        expected = CsvDatums(2, "timestamp,open,high,low,close,vwap,volume,count\n"
+                                "0,1.0,2.0,1.0,2.0,1.5,2.0,2")
+        assert derived_source.query(since=0) == expected
+        assert validation.data == expected
+
+    def test_derives_from_start_of_bucket_containing_since(self, derived_source, fine_storage):
+        fine_storage.store(CsvDatums(1, "timestamp,open,high,low,close,vwap,volume,count\n"
+                                        "0,1.0,1.0,1.0,1.0,1.0,1.0,1\n"
+                                        "60,2.0,2.0,2.0,2.0,2.0,1.0,1\n"
+                                        "120,3.0,3.0,3.0,3.0,3.0,1.0,1\n"
+                                        "180,4.0,4.0,4.0,4.0,4.0,1.0,1\n"))
+        assert derived_source.query(since=122).csv == "timestamp,open,high,low,close,vwap,volume,count\n" \
+                                                      "120,3.0,4.0,3.0,4.0,3.5,2.0,2"
+
+    def test_logs_warning_on_invalid_data(self, derived_source, validation, caplog):
+        caplog.set_level(logging.WARNING)
+        validation.set_raises(DataError)
+        derived_source.query(since=0)
+        assert "mocked data error" in caplog.text
@@ -2,7 +2,9 @@ import logging
 
 import pytest
 
-from datums_warehouse.broker.storage import InvalidDatumError, Storage
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.storage import InvalidDatumError, Storage, SegmentCache, SEGMENT_CACHE, UnknownFieldError, \
+    SEGMENT_CACHE_BYTES
 
 
 @pytest.fixture
@@ -120,19 +122,28 @@ def test_query_last_time_stamp_of_interval(storage, make_csv_datums):
     assert storage.last_time_of(interval=1) == 5
 
 
-def test_get_last_stored_csv(storage, make_csv_datums):
+def test_last_time_stamp_stays_current_after_storing_more(storage, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n1,2,2\n"))
+    assert storage.last_time_of(interval=1) == 1
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n2,2,2\n3,1,1\n"))
+    assert storage.last_time_of(interval=1) == 3
+
+
+def test_get_all_stored_csv(storage, make_csv_datums):
     storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n1,2,2\n2,3,3\n"))
     storage.store(make_csv_datums(1, "timestamp,c1,c2\n4,2,2\n5,1,1\n"))
     storage.store(make_csv_datums(30, "timestamp,c1,c2\n9,2,2\n10,1,1\n"))
-    assert storage.get(interval=1) == make_csv_datums(1, "timestamp,c1,c2\n4,2,2\n5,1,1\n")
+    assert storage.get(interval=1) == make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n1,2,2\n2,3,3\n4,2,2\n5,1,1\n")
 
 
 @pytest.mark.parametrize('since,until,expected', [
-    (1, None, "timestamp,c1,c2\n8,3,3\n9,2,2\n10,1,1\n"),
-    (5, None, "timestamp,c1,c2\n8,3,3\n9,2,2\n10,1,1\n"),
+    (1, None, "timestamp,c1,c2\n1,2,2\n2,3,3\n4,2,2\n5,1,1\n6,3,3\n8,3,3\n9,2,2\n10,1,1\n"),
+    (5, None, "timestamp,c1,c2\n5,1,1\n6,3,3\n8,3,3\n9,2,2\n10,1,1\n"),
     (None, 2, "timestamp,c1,c2\n0,1,1\n1,2,2\n2,3,3\n"),
     (None, 1, "timestamp,c1,c2\n0,1,1\n1,2,2\n"),
-    (None, 5, "timestamp,c1,c2\n4,2,2\n5,1,1\n"),
+    (None, 5, "timestamp,c1,c2\n0,1,1\n1,2,2\n2,3,3\n4,2,2\n5,1,1\n"),
+    (3, 3, "timestamp,c1,c2\n"),
+    (7, 8, "timestamp,c1,c2\n8,3,3\n"),
     (5, 5, "timestamp,c1,c2\n5,1,1\n"),
 ])
 def test_get_stored_csv_with_range(storage, make_csv_datums, since, until, expected):
@@ -141,3 +152,144 @@ def test_get_stored_csv_with_range(storage, make_csv_datums, since, until, expec
     storage.store(make_csv_datums(1, "timestamp,c1,c2\n4,2,2\n5,1,1\n6,3,3\n"))
     storage.store(make_csv_datums(30, "timestamp,c1,c2\n9,2,2\n10,1,1\n"))
     assert storage.get(1, since, until) == make_csv_datums(1, expected)
+
+
+def test_find_gaps_within_and_between_stored_files(storage, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n240,3,3\n"))
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n600,2,2\n660,1,1\n"))
+    assert storage.find_gaps(1) == [(120, 180), (300, 540)]
+
+
+def test_find_gaps_ignores_segments_nested_in_others(storage, datum_path, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n300,1,1\n360,2,2\n"))
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n" + "".join(f"{t},1,1\n" for t in range(0, 1200, 60) if t != 360)))
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n1500,1,1\n"))
+    assert sorted(f.name for f in datum_path.glob("1__*.gz")) == ["1__0_1140.gz", "1__1500_1500.gz", "1__300_360.gz"]
+    assert storage.find_gaps(1) == [(1200, 1440)]
+
+
+def test_splice_bars_into_a_gap(storage, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n240,3,3\n"))
+    assert storage.splice(make_csv_datums(1, "timestamp,c1,c2\n120,4,4\n180,5,5\n")) == 2
+    assert storage.get(1) == make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n120,4,4\n180,5,5\n240,3,3\n")
+    assert storage.find_gaps(1) == []
+
+
+def test_splice_joins_the_files_around_a_gap(storage, datum_path, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n180,3,3\n240,4,4\n"))
+    storage.splice(make_csv_datums(1, "timestamp,c1,c2\n120,5,5\n"))
+    assert [f.name for f in datum_path.glob("1__*.gz")] == ["1__0_240.gz"]
+    assert storage.get(1, since=0) == make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n120,5,5\n180,3,3\n"
+                                                         "240,4,4\n")
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    SEGMENT_CACHE.clear()
+    yield METRICS
+    METRICS.reset()
+
+
+def test_repeated_reads_are_served_from_segment_cache(storage, make_csv_datums, metrics):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    storage.get(1)
+    storage.get(1, since=60)
+    counters = metrics.summary()['counters']
+    assert counters['segment_cache_misses_total'] == 1 and counters['segment_cache_hits_total'] == 1
+
+
+def test_rewritten_segments_are_not_served_stale(storage, make_csv_datums, metrics):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    storage.get(1)
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n60,3,3\n120,4,4\n"))
+    assert storage.get(1, since=0) == make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,3,3\n120,4,4\n")
+
+
+def test_segment_cache_evicts_least_recently_used(tmp_path, make_csv_datums):
+    storages = [Storage(tmp_path / name) for name in "ABC"]
+    for s in storages:
+        s.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    cache = SegmentCache()
+    files = [next((tmp_path / name).glob("*.gz")) for name in "ABC"]
+    one = int(cache.read(files[0]).memory_usage(index=True).sum())
+    cache.resize(2 * one)
+    cache.read(files[1])
+    cache.read(files[0])
+    cache.read(files[2])
+    assert cache.size == 2 * one
+    cache.read(files[0])
+    cache.resize(one)
+    assert cache.size == one
+
+
+def test_get_projected_fields(storage, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n120,3,3\n"))
+    assert storage.get(1, since=60, fields=['c2', 'timestamp']) == make_csv_datums(1, "c2,timestamp\n2,60\n3,120\n")
+    assert storage.get(1, fields=['c1']) == make_csv_datums(1, "c1\n1\n2\n3\n")
+
+
+def test_projecting_unknown_fields_raises_error(storage, make_csv_datums):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    with pytest.raises(UnknownFieldError):
+        storage.get(1, fields=['c3'])
+
+
+def test_projections_are_served_from_a_cached_full_segment(storage, make_csv_datums, metrics):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    storage.get(1)
+    assert storage.get(1, fields=['c1']) == make_csv_datums(1, "c1\n1\n2\n")
+    assert metrics.summary()['counters']['segment_cache_misses_total'] == 1
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    import datums_warehouse.broker.storage as mut
+    monkeypatch.setattr(mut, 'READ_CHUNK_ROWS', 2)
+
+
+@pytest.fixture
+def oversized_segments():
+    SEGMENT_CACHE.resize(1)
+    yield
+    SEGMENT_CACHE.resize(SEGMENT_CACHE_BYTES)
+
+
+def test_limited_reads_stop_scanning_once_enough_rows_are_found(storage, make_csv_datums, metrics, small_chunks,
+                                                                oversized_segments):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n" + "".join(f"{t * 60},{t},{t}\n" for t in range(10))))
+    assert storage.get(1, since=120, limit=3) == make_csv_datums(1, "timestamp,c1,c2\n120,2,2\n180,3,3\n240,4,4\n")
+    assert metrics.summary()['counters']['segment_chunks_read_total'] == 3
+    assert 'segment_cache_misses_total' not in metrics.summary()['counters']
+
+
+def test_limited_reads_stop_at_until(storage, make_csv_datums, metrics, small_chunks, oversized_segments):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n" + "".join(f"{t * 60},{t},{t}\n" for t in range(10))))
+    assert storage.get(1, until=120, limit=5, fields=['c1']) == make_csv_datums(1, "c1\n0\n1\n2\n")
+    assert metrics.summary()['counters']['segment_chunks_read_total'] == 2
+
+
+def test_limited_reads_slice_cached_segments(storage, make_csv_datums, metrics):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n120,3,3\n"))
+    storage.get(1)
+    assert storage.get(1, since=60, limit=1) == make_csv_datums(1, "timestamp,c1,c2\n60,2,2\n")
+    assert 'segment_chunks_read_total' not in metrics.summary()['counters']
+
+
+def test_limited_reads_fill_the_cache(storage, make_csv_datums, metrics):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n120,3,3\n"))
+    assert storage.get(1, limit=1) == make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n")
+    assert storage.get(1, since=60, limit=1) == make_csv_datums(1, "timestamp,c1,c2\n60,2,2\n")
+    counters = metrics.summary()['counters']
+    assert (counters['segment_cache_misses_total'], counters['segment_cache_hits_total']) == (1, 1)
+    assert 'segment_chunks_read_total' not in counters
+
+
+def test_segments_are_selected_without_reading_others(storage, make_csv_datums, metrics):
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    storage.store(make_csv_datums(1, "timestamp,c1,c2\n600,3,3\n660,4,4\n"))
+    SEGMENT_CACHE.clear()
+    metrics.reset()
+    assert storage.get(1, until=300) == make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n")
+    assert metrics.summary()['counters']['segment_cache_misses_total'] == 1
@@ -0,0 +1,129 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.storage import Storage, SEGMENT_CACHE
+from datums_warehouse.broker.summary import DAY_SECONDS, NotSummarizableError, combine, summarize_days
+
+HOUR = 60 * 60
+
+
+def make_bars(start, hours, seed=0):
+    rng = np.random.default_rng(seed)
+    close = (100 + rng.normal(0, 1, hours).cumsum()).round(1)
+    return pd.DataFrame({'timestamp': np.arange(start, start + hours * HOUR, HOUR), 'open': close - 0.5,
+                         'high': close + 1, 'low': close - 1, 'close': close, 'vwap': close,
+                         'volume': rng.integers(1, 10, hours).astype(float), 'count': rng.integers(1, 5, hours)})
+
+
+def expected_stats(bars):
+    return dict(first=int(bars.timestamp.iloc[0]), last=int(bars.timestamp.iloc[-1]), open=bars.open.iloc[0],
+                high=bars.high.max(), low=bars.low.min(), close=bars.close.iloc[-1],
+                vwap=(bars.vwap * bars.volume).sum() / bars.volume.sum(), volume=bars.volume.sum(),
+                count=int(bars['count'].sum()), bars=len(bars), mean=bars.close.mean(), std=bars.close.std(ddof=0))
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    SEGMENT_CACHE.clear()
+    yield METRICS
+    METRICS.reset()
+
+
+@pytest.fixture
+def bars():
+    return pd.concat([make_bars(DAY_SECONDS * 10, 24 * 4, seed=1), make_bars(DAY_SECONDS * 15 + 5 * HOUR, 24 * 3, seed=2)])
+
+
+@pytest.fixture
+def storage(tmp_path, bars, make_csv_datums):
+    s = Storage(tmp_path / "PAIR")
+    for _, segment in bars.groupby(bars.timestamp >= DAY_SECONDS * 15):
+        s.store(make_csv_datums(60, segment.to_csv(index=False)))
+    return s
+
+
+def test_summaries_are_written_next_to_segments(storage, tmp_path):
+    assert sorted(f.name for f in (tmp_path / "PAIR").glob("60__*")) == \
+           ['60__1314000_1569600.gz', '60__1314000_1569600.summary',
+            '60__864000_1206000.gz', '60__864000_1206000.summary']
+
+
+def test_summaries_follow_appended_segments(storage, tmp_path, bars, make_csv_datums):
+    storage.store(make_csv_datums(60, make_bars(1569600, 3).to_csv(index=False)))
+    summaries = sorted(f.name for f in (tmp_path / "PAIR").glob("*.summary"))
+    assert summaries == ['60__1314000_1576800.summary', '60__864000_1206000.summary']
+
+
+def test_stats_of_whole_days_come_from_summaries(storage, bars, metrics):
+    assert storage.stats(60, DAY_SECONDS * 11, DAY_SECONDS * 13 - 1) == \
+           pytest.approx(expected_stats(bars[(bars.timestamp >= DAY_SECONDS * 11) &
+                                             (bars.timestamp < DAY_SECONDS * 13)]))
+    counters = metrics.summary()['counters']
+    assert counters['summary_blocks_used_total'] == 2 and counters['summary_edge_bars_total'] == 0
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_stats_combine_summaries_with_partial_edges(storage, bars, seed):
+    rng = random.Random(seed)
+    since = rng.randrange(DAY_SECONDS * 9, DAY_SECONDS * 16)
+    until = rng.randrange(since + 2 * HOUR, DAY_SECONDS * 19)
+    selected = bars[(bars.timestamp >= since) & (bars.timestamp <= until)]
+    assert storage.stats(60, since, until) == pytest.approx(expected_stats(selected))
+
+
+def test_stats_are_empty_without_bars(storage):
+    assert storage.stats(60, 0, DAY_SECONDS) is None
+
+
+def test_stats_without_summaries_are_computed_but_not_written(storage, tmp_path, bars):
+    for summary in (tmp_path / "PAIR").glob("*.summary"):
+        summary.unlink()
+    assert storage.stats(60, 0, DAY_SECONDS * 20) == pytest.approx(expected_stats(bars))
+    assert list((tmp_path / "PAIR").glob("*.summary")) == []
+
+
+def test_stats_count_overlapping_segments_once(tmp_path, make_csv_datums):
+    s = Storage(tmp_path / "PAIR")
+    for ts in (range(600, 1141, 60), range(0, 841, 60)):
+        s.store(make_csv_datums(1, "timestamp,open,high,low,close,vwap,volume,count\n" +
+                                "".join(f"{t},1.0,1.0,1.0,1.0,1.0,1.0,1\n" for t in ts)))
+    assert sorted(f.name for f in (tmp_path / "PAIR").glob("*.gz")) == ["1__0_840.gz", "1__600_1140.gz"]
+    stats = s.stats(1, 0, DAY_SECONDS)
+    assert (stats['bars'], stats['volume'], stats['count']) == (20, 20.0, 20)
+
+
+@pytest.fixture
+def small_reads(monkeypatch):
+    import datums_warehouse.broker.segment_index as index
+    import datums_warehouse.broker.storage as storage
+    monkeypatch.setattr(index, 'INDEX_MARK_ROWS', 10)
+    monkeypatch.setattr(storage, 'READ_CHUNK_ROWS', 10)
+
+
+def test_edges_are_read_from_their_marks(tmp_path, make_csv_datums, small_reads, metrics):
+    bars = make_bars(DAY_SECONDS * 10, 24 * 4)
+    s = Storage(tmp_path / "PAIR")
+    s.store(make_csv_datums(60, bars.to_csv(index=False)))
+    since, until = DAY_SECONDS * 10 + 5 * HOUR, DAY_SECONDS * 13 + 3 * HOUR
+    assert s.stats(60, since, until) == \
+           pytest.approx(expected_stats(bars[(bars.timestamp >= since) & (bars.timestamp <= until)]))
+    assert metrics.summary()['counters']['segment_chunks_read_total'] == 4
+
+
+def test_only_bars_can_be_summarized(tmp_path, make_csv_datums):
+    s = Storage(tmp_path / "PAIR")
+    s.store(make_csv_datums(1, "timestamp,c1,c2\n0,1,1\n60,2,2\n"))
+    assert list((tmp_path / "PAIR").glob("*.summary")) == []
+    with pytest.raises(NotSummarizableError):
+        s.stats(1, 0, DAY_SECONDS)
+    with pytest.raises(NotSummarizableError):
+        summarize_days(pd.DataFrame({'timestamp': [0]}))
+
+
+def test_combining_nothing_gives_no_stats():
+    assert combine([]) is None
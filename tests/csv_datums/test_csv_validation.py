@@ -3,7 +3,7 @@ from io import StringIO
 
 import pytest
 
-from datums_warehouse.broker.validation import DataError, validate
+from datums_warehouse.broker.validation import DataError, GapError, validate, find_gaps
 
 
 @pytest.fixture
@@ -92,6 +92,20 @@ def test_gap_in_series(make_datums):
     assert "2, 4" in exception_msg(e)
 
 
+def test_gap_errors_report_the_missing_bar_ranges(make_datums):
+    with pytest.raises(GapError) as e:
+        validate(make_datums(make_csv([["timestamp", "c1", "c2", "c3"],
+                                       ["0", "1", "2", "3"],
+                                       ["120", "2", "3", "4"],
+                                       ["180", "3", "4", "5"],
+                                       ["420", "4", "5", "6"]]), interval=1))
+    assert e.value.gaps == [(60, 60), (240, 360)]
+
+
+def test_find_gaps_ignores_contiguous_series():
+    assert find_gaps([0, 300, 600], interval=5) == []
+
+
 def test_z_score_threshold_can_be_configured(make_datums):
     loc = [(2, 1)]
     with pytest.raises(DataError) as e:
@@ -2,6 +2,7 @@ from pathlib import Path
 
 import pytest
 
+from datums_warehouse.broker.adapters import InvalidDerivationError
 from datums_warehouse.broker.warehouse import Warehouse, MissingPacketError
 
 
@@ -36,7 +37,7 @@ class StorageStub:
         def exists(self, interval):
             return self.owner.exists
 
-        def get(self, interval, since=None, until=None):
+        def get(self, interval, since=None, until=None, fields=None, limit=None):
             directory = Path(self.storage) / self.pair
             return Data(from_dir=directory, with_interval=interval, with_since=since, with_until=until)
 
@@ -89,24 +90,32 @@ class SourceSpy:
         def __init__(self, owner):
             self.owner = owner
 
-        def query(self, since, exclude_outliers=None, z_score_threshold=10):
+        def query(self, since, exclude_outliers=None, z_score_threshold=10, max_seconds=None):
             self.owner.received_query_since = since
+            self.owner.received_max_seconds = max_seconds
             self.owner.received_validation_cfg = dict(exclude_outliers=exclude_outliers,
                                                       z_score_threshold=z_score_threshold)
             self.owner.returned_datums = Data(from_dir='remote_source', with_interval=30, with_since=since)
             return self.owner.returned_datums
 
     def __init__(self):
+        self.created = 0
         self.trades_storage = None
         self.type_created = None
         self.with_interval = None
         self.with_pair = None
+        self.with_options = None
+        self.with_shards = None
         self.received_query_since = None
+        self.received_max_seconds = None
         self.received_validation_cfg = None
         self.returned_datums = None
 
-    def __call__(self, trades_storage, source_type, pair, interval):
+    def __call__(self, trades_storage, source_type, pair, interval, options=None, shards=1):
+        self.created += 1
+        self.with_shards = shards
         self.trades_storage = trades_storage
+        self.with_options = options
         self.type_created = source_type
         self.with_interval = interval
         self.with_pair = pair
@@ -177,6 +186,56 @@ def test_warehouse_invokes_configured_query(source):
     assert source.updated_from('some_source', with_interval=30, with_pair="SMNPAR", with_storage="some/directory")
 
 
+def test_warehouse_passes_prefixed_source_options_to_source(source):
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR',
+                                         'source': "Replay", 'source_file': "trades.csv", 'source_page_size': "10"}})
+    warehouse.update('packet_id')
+    assert source.with_options == dict(file="trades.csv", page_size="10")
+
+
+def test_warehouse_reuses_sources_across_updates(source):
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR',
+                                         'source': "some_source"}})
+    warehouse.update('packet_id')
+    warehouse.update('packet_id')
+    assert source.created == 1
+
+
+def test_warehouse_passes_fetch_budget_to_source(source):
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR',
+                                         'source': "some_source"}})
+    warehouse.update('packet_id', max_seconds=60)
+    assert source.received_max_seconds == 60
+
+
+@pytest.mark.parametrize('last,now,lag', [(1800, 5400, 1800), (3600, 5400, 0), (3600, 7199, 0), (3600, 7200, 1800)])
+def test_warehouse_reports_packet_lag_behind_newest_closed_bar(storage, last, now, lag):
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR'}})
+    storage.last_time_of("some/directory", interval=30, pair='SMNPAR').set(last)
+    assert warehouse.lag_of('packet_id', now) == lag
+
+
+def test_warehouse_reports_lag_of_new_packets_from_their_start(storage):
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR',
+                                         'start': 1800}})
+    storage.set_not_existent()
+    assert warehouse.lag_of('packet_id', 5400) == 3600
+
+
+def test_warehouse_reports_packet_interval():
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': '30', 'pair': 'SMNPAR'}})
+    assert warehouse.interval_of('packet_id') == 30
+    with pytest.raises(MissingPacketError):
+        warehouse.interval_of('unknown')
+
+
+def test_warehouse_passes_configured_backfill_shards_to_source(source):
+    warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR',
+                                         'source': "some_source", 'backfill_shards': "4"}})
+    warehouse.update('packet_id')
+    assert source.with_shards == 4 and source.with_options == {}
+
+
 def test_warehouse_passes_validation_config_along_to_query(source):
     warehouse = Warehouse({'packet_id': {'storage': "some/directory", 'interval': 30, 'pair': 'SMNPAR',
                                          'source': "some_source", 'exclude_outliers': ['vwap'],
@@ -221,3 +280,68 @@ def test_warehouse_updates_source_from_specified_start_time_if_they_do_not_exist
     storage.set_not_existent()
     warehouse.update('packet_id')
     assert source.received_query_since == 1000
+
+
+class DerivedSourceSpy:
+    class SourceAPI(SourceSpy.SourceAPI):
+        pass
+
+    def __init__(self):
+        self.source_storage = None
+        self.source_interval = None
+        self.with_interval = None
+        self.received_query_since = None
+        self.received_validation_cfg = None
+        self.returned_datums = None
+
+    def __call__(self, storage, source_interval, interval):
+        self.source_storage = storage
+        self.source_interval = source_interval
+        self.with_interval = interval
+        return self.SourceAPI(self)
+
+
+@pytest.fixture
+def derived_source(monkeypatch):
+    import datums_warehouse.broker.warehouse as module_under_test
+    s = DerivedSourceSpy()
+    monkeypatch.setattr(module_under_test, 'make_derived_source', s)
+    return s
+
+
+@pytest.fixture
+def derived_cfg():
+    return {'fine': {'storage': "some/directory", 'interval': 1, 'pair': 'SMNPAR', 'source': "some_source"},
+            'coarse': {'storage': "other/directory", 'interval': 60, 'pair': 'SMNPAR', 'derive_from': 'fine'},
+            'coarser': {'storage': "other/directory", 'interval': 1440, 'pair': 'SMNPAR', 'derive_from': 'coarse'}}
+
+
+def test_warehouse_derives_packet_from_configured_source_packet(source, derived_source, storage, derived_cfg):
+    warehouse = Warehouse(derived_cfg)
+    storage.last_time_of("other/directory", interval=60, pair='SMNPAR').set(15000)
+    warehouse.update('coarse')
+    assert source.type_created is None
+    assert derived_source.source_storage.storage == "some/directory"
+    assert derived_source.source_storage.pair == "SMNPAR"
+    assert derived_source.source_interval == 1 and derived_source.with_interval == 60
+    assert derived_source.received_query_since == 15000 + 60
+    assert storage.stored(derived_source.returned_datums)
+
+
+def test_warehouse_raises_error_when_deriving_from_missing_packet(derived_source):
+    warehouse = Warehouse({'coarse': {'storage': "some/directory", 'interval': 60, 'pair': 'SMNPAR',
+                                      'derive_from': 'missing'}})
+    with pytest.raises(MissingPacketError):
+        warehouse.update('coarse')
+
+
+def test_warehouse_orders_updates_of_derived_packets_after_their_sources(derived_cfg):
+    warehouse = Warehouse(derived_cfg)
+    assert warehouse.update_stages(['coarser', 'coarse', 'fine']) == [['fine'], ['coarse'], ['coarser']]
+    assert warehouse.update_stages(['coarser', 'fine']) == [['coarser', 'fine']]
+
+
+def test_warehouse_detects_cyclic_derivations():
+    warehouse = Warehouse({'a': {'derive_from': 'b'}, 'b': {'derive_from': 'a'}})
+    with pytest.raises(InvalidDerivationError):
+        warehouse.update_stages(['a', 'b'])
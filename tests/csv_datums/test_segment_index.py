@@ -0,0 +1,155 @@
+import gzip
+import json
+
+import pytest
+
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.broker.segment_index import INDEX_FILE, Segments, entry_of, rows_between
+from datums_warehouse.broker.storage import Storage, SEGMENT_CACHE, MissingDatumError
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    SEGMENT_CACHE.clear()
+    yield METRICS
+    METRICS.reset()
+
+
+@pytest.fixture
+def datum_path(tmp_path):
+    return tmp_path / "DTN_NME"
+
+
+@pytest.fixture
+def storage(datum_path, make_csv_datums):
+    s = Storage(datum_path)
+    s.store(make_csv_datums(1, "timestamp,c1\n0,0\n1,1\n2,2\n"))
+    s.store(make_csv_datums(1, "timestamp,c1\n4,4\n5,5\n6,6\n"))
+    s.store(make_csv_datums(1, "timestamp,c1\n8,8\n9,9\n"))
+    return s
+
+
+@pytest.fixture
+def small_marks(monkeypatch):
+    import datums_warehouse.broker.segment_index as index
+    import datums_warehouse.broker.storage as storage
+    monkeypatch.setattr(index, 'INDEX_MARK_ROWS', 2)
+    monkeypatch.setattr(storage, 'READ_CHUNK_ROWS', 2)
+    SEGMENT_CACHE.resize(1)
+    yield
+    SEGMENT_CACHE.resize(storage.SEGMENT_CACHE_BYTES)
+
+
+def entry(first, last, name=None):
+    return dict(file=name or f"1__{first}_{last}.gz", first=first, last=last, rows=last - first + 1, marks=[first])
+
+
+def test_store_persists_sorted_segment_boundaries(storage, datum_path):
+    index = json.loads((datum_path / INDEX_FILE).read_text())
+    assert [(e['file'], e['first'], e['last'], e['rows']) for e in index['segments']] == \
+           [("1__0_2.gz", 0, 2, 3), ("1__4_6.gz", 4, 6, 3), ("1__8_9.gz", 8, 9, 2)]
+
+
+def test_fresh_storages_resolve_segments_from_the_index(storage, datum_path, make_csv_datums, metrics):
+    fresh = Storage(datum_path)
+    assert fresh.get(1, 5, 8) == make_csv_datums(1, "timestamp,c1\n5,5\n6,6\n8,8\n")
+    assert fresh.last_time_of(1) == 9
+    counters = metrics.summary()['counters']
+    assert 'segments_indexed_total' not in counters and counters['segment_cache_misses_total'] == 2
+
+
+def test_segments_changed_behind_the_index_are_reconciled(storage, datum_path, make_csv_datums, metrics):
+    (datum_path / "1__8_9.gz").unlink()
+    with gzip.open(datum_path / "1__20_21.gz", 'wb') as f:
+        f.write(b"timestamp,c1\n20,20\n21,21\n")
+    fresh = Storage(datum_path)
+    assert fresh.get(1, since=5) == make_csv_datums(1, "timestamp,c1\n5,5\n6,6\n20,20\n21,21\n")
+    assert metrics.summary()['counters']['segments_indexed_total'] == 1
+    assert storage.last_time_of(1) == 21
+
+
+def test_missing_datums_raise_error(datum_path):
+    with pytest.raises(MissingDatumError):
+        Storage(datum_path).get(1)
+    with pytest.raises(MissingDatumError):
+        Storage(datum_path).last_time_of(1)
+
+
+@pytest.mark.parametrize('since,until,expected', [
+    (None, None, [(0, 2), (4, 6), (8, 9)]),
+    (3, None, [(4, 6), (8, 9)]),
+    (None, 4, [(0, 2), (4, 6)]),
+    (3, 3, []),
+    (10, None, []),
+    (2, 8, [(0, 2), (4, 6), (8, 9)]),
+])
+def test_segments_between_a_range(since, until, expected):
+    segments = Segments([entry(8, 9), entry(0, 2), entry(4, 6)])
+    assert [(e['first'], e['last']) for e in segments.between(since, until)] == expected
+
+
+def test_segments_contained_in_earlier_ones_are_found():
+    segments = Segments([entry(0, 10), entry(2, 3), entry(5, 12)])
+    assert [(e['first'], e['last']) for e in segments.between(4, 6)] == [(0, 10), (5, 12)]
+    assert segments.last == 12
+
+
+def test_row_offsets_of_a_range(small_marks):
+    e = entry_of("1__0_9.gz", list(range(0, 20, 2)))
+    assert e['marks'] == [0, 4, 8, 12, 16]
+    assert rows_between(e, None, None) == (0, 10)
+    assert rows_between(e, 9, 13) == (4, 8)
+    assert rows_between(e, 8, 8) == (4, 6)
+
+
+def test_limited_reads_skip_to_the_nearest_mark(datum_path, make_csv_datums, metrics, small_marks):
+    s = Storage(datum_path)
+    s.store(make_csv_datums(1, "timestamp,c1\n" + "".join(f"{t},{t}\n" for t in range(10))))
+    SEGMENT_CACHE.clear()
+    assert s.get(1, since=6, limit=2) == make_csv_datums(1, "timestamp,c1\n6,6\n7,7\n")
+    assert metrics.summary()['counters']['segment_chunks_read_total'] == 1
+
+
+def test_limited_reads_continue_in_the_next_segment(storage, make_csv_datums):
+    assert storage.get(1, since=5, limit=4) == make_csv_datums(1, "timestamp,c1\n5,5\n6,6\n8,8\n9,9\n")
+    assert storage.get(1, since=1, until=8, limit=3) == make_csv_datums(1, "timestamp,c1\n1,1\n2,2\n4,4\n")
+
+
+def test_overlapping_segments_are_stitched_with_the_broader_one_winning(datum_path, make_csv_datums):
+    s = Storage(datum_path)
+    s.store(make_csv_datums(1, "timestamp,c1\n2,0\n3,0\n"))
+    s.store(make_csv_datums(1, "timestamp,c1\n0,1\n1,1\n2,1\n3,1\n4,1\n"))
+    assert sorted(f.name for f in datum_path.glob("*.gz")) == ["1__0_4.gz", "1__2_3.gz"]
+    assert s.get(1, since=1, limit=3) == make_csv_datums(1, "timestamp,c1\n1,1\n2,1\n3,1\n")
+
+
+def test_splicing_updates_the_index(storage, datum_path):
+    from datums_warehouse.broker.datums import CsvDatums
+    storage.splice(CsvDatums(1, "timestamp,c1\n3,3\n"))
+    index = json.loads((datum_path / INDEX_FILE).read_text())
+    assert [(e['file'], e['rows']) for e in index['segments']] == [("1__0_9.gz", 9)]
+
+
+def test_concurrent_stores_of_different_intervals_keep_all_entries(datum_path, make_csv_datums):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def store(interval):
+        Storage(datum_path).store(make_csv_datums(interval, "timestamp,c1\n0,0\n60,1\n"))
+
+    datum_path.mkdir()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(store, [1, 5, 30, 60] * 3))
+    index = json.loads((datum_path / INDEX_FILE).read_text())
+    assert sorted(e['file'] for e in index['segments']) == ["1__0_60.gz", "30__0_60.gz", "5__0_60.gz", "60__0_60.gz"]
+    assert [f.name for f in datum_path.glob("*.tmp")] == []
+
+
+def test_reading_never_writes_the_index(storage, datum_path, make_csv_datums):
+    (datum_path / INDEX_FILE).unlink()
+    datum_path.chmod(0o555)
+    try:
+        assert Storage(datum_path).get(1, since=8) == make_csv_datums(1, "timestamp,c1\n8,8\n9,9\n")
+    finally:
+        datum_path.chmod(0o755)
+    assert not (datum_path / INDEX_FILE).exists()
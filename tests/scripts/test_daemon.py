@@ -0,0 +1,176 @@
+import threading
+
+import pytest
+
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.scripts.daemon import Schedule, UpdateDaemon
+from datums_warehouse.scripts.lock import pid_lock, LockError
+
+
+class Clock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class WarehouseSpy:
+    def __init__(self, intervals, stages=None, failing=(), lags=None, catch_up=0):
+        self.intervals = intervals
+        self.stages = stages
+        self.failing = set(failing)
+        self.lags = lags or {}
+        self.catch_up = catch_up
+        self.updated = []
+        self.budgets = {}
+
+    def interval_of(self, pkt):
+        return self.intervals[pkt]
+
+    def lag_of(self, pkt, now):
+        return self.lags.get(pkt, 0)
+
+    def update_stages(self, pairs):
+        if self.stages is None:
+            return [list(pairs)]
+        return [[p for p in s if p in pairs] for s in self.stages if any(p in pairs for p in s)]
+
+    def update(self, pkt, max_seconds=None):
+        if pkt in self.failing:
+            raise ValueError("update failed")
+        self.updated.append(pkt)
+        self.budgets[pkt] = max_seconds
+        if pkt in self.lags:
+            self.lags[pkt] = max(self.lags[pkt] - self.catch_up, 0)
+
+
+@pytest.fixture
+def clock():
+    return Clock(now=1000)
+
+
+def test_schedule_has_all_packets_due_at_start(clock):
+    assert Schedule({'A': 1, 'B': 5}, delay=5, clock=clock).due() == ['A', 'B']
+
+
+def test_schedule_packets_shortly_after_their_next_bar_closes(clock):
+    schedule = Schedule({'A': 1, 'B': 5}, delay=5, clock=clock)
+    schedule.done(['A', 'B'])
+    assert schedule.due() == []
+    assert schedule.seconds_until_next() == 1020 + 5 - 1000
+    clock.now = 1025
+    assert schedule.due() == ['A']
+    clock.now = 1205
+    assert schedule.due() == ['A', 'B']
+
+
+def test_daemon_updates_due_packets_in_stage_order(clock):
+    warehouse = WarehouseSpy({'A': 1, 'B': 1, 'C': 5}, stages=[['A', 'B'], ['C']])
+    UpdateDaemon([(warehouse, ['A', 'B', 'C'])], clock=clock).run_due()
+    assert set(warehouse.updated[:2]) == {'A', 'B'} and warehouse.updated[2:] == ['C']
+
+
+def test_daemon_only_updates_packets_again_once_they_are_due(clock):
+    warehouse = WarehouseSpy({'A': 1, 'C': 5})
+    daemon = UpdateDaemon([(warehouse, ['A', 'C'])], delay=5, clock=clock)
+    daemon.run_due()
+    clock.now = 1025
+    daemon.run_due()
+    assert warehouse.updated == ['A', 'C', 'A']
+
+
+def test_daemon_keeps_updating_other_packets_when_one_fails(clock):
+    warehouse = WarehouseSpy({'A': 1, 'B': 1}, failing=['A'])
+    daemon = UpdateDaemon([(warehouse, ['A', 'B'])], clock=clock)
+    daemon.run_due()
+    assert warehouse.updated == ['B']
+    assert daemon.run_due() is None and warehouse.updated == ['B']
+
+
+def test_daemon_serves_fresh_packets_before_lagging_ones(clock):
+    warehouse = WarehouseSpy({'A': 1, 'B': 1, 'C': 1}, lags={'A': 7200, 'B': 0, 'C': 60})
+    UpdateDaemon([(warehouse, ['A', 'B', 'C'])], clock=clock, workers=1).run_due()
+    assert warehouse.updated == ['C', 'B', 'A']
+
+
+def test_profiled_daemon_updates_packets_one_after_another(clock, tmp_path):
+    warehouse = WarehouseSpy({'A': 1, 'B': 1, 'C': 1}, lags={'A': 0, 'B': 60, 'C': 120})
+    UpdateDaemon([(warehouse, ['A', 'B', 'C'])], clock=clock, profile_dir=tmp_path, workers=4).run_due()
+    assert warehouse.updated == ['C', 'B', 'A']
+    assert sorted(p.name.split('_')[1] for p in tmp_path.iterdir()) == ['A', 'B', 'C']
+
+
+class MetricsFileSpy:
+    def __init__(self):
+        self.gauges = []
+
+    def flush(self):
+        self.gauges.append(METRICS.summary()['gauges'])
+
+    maybe_flush = flush
+
+
+def test_daemon_exports_lag_and_queue_depth_while_running(clock):
+    METRICS.reset()
+    metrics_file = MetricsFileSpy()
+    warehouse = WarehouseSpy({'A': 1, 'B': 1}, lags={'A': 7200, 'B': 0})
+    UpdateDaemon([(warehouse, ['A', 'B'])], clock=clock, metrics_file=metrics_file).run_due()
+    assert metrics_file.gauges[0] == {'packet_lag_seconds{packet=A}': 7200, 'packet_lag_seconds{packet=B}': 0,
+                                      'update_queue_depth{kind=backfill}': 1, 'update_queue_depth{kind=fresh}': 1}
+    assert metrics_file.gauges[-1]['update_queue_depth{kind=backfill}'] == 0
+    METRICS.reset()
+
+
+def test_daemon_caps_the_fetch_time_of_backfill_steps_only(clock):
+    warehouse = WarehouseSpy({'A': 1, 'B': 1}, lags={'A': 7200})
+    UpdateDaemon([(warehouse, ['A', 'B'])], clock=clock, backfill_step=30).run_due()
+    assert warehouse.budgets == {'A': 30, 'B': None}
+
+
+def test_daemon_continues_backfill_in_the_next_cycle_while_catching_up(clock):
+    warehouse = WarehouseSpy({'A': 1, 'B': 1}, lags={'A': 7200}, catch_up=3600)
+    daemon = UpdateDaemon([(warehouse, ['A', 'B'])], clock=clock)
+    daemon.run_due()
+    daemon.run_due()
+    daemon.run_due()
+    assert warehouse.updated == ['B', 'A', 'A']
+
+
+def test_daemon_waits_for_the_next_interval_when_backfill_makes_no_progress(clock):
+    warehouse = WarehouseSpy({'A': 1}, lags={'A': 7200})
+    daemon = UpdateDaemon([(warehouse, ['A'])], clock=clock)
+    daemon.run_due()
+    daemon.run_due()
+    assert warehouse.updated == ['A']
+
+
+def test_daemon_exposes_lag_and_queue_depth(clock):
+    METRICS.reset()
+    warehouse = WarehouseSpy({'A': 1, 'B': 1}, lags={'A': 7200, 'B': 60})
+    UpdateDaemon([(warehouse, ['A', 'B'])], clock=clock).run_due()
+    assert METRICS.summary()['gauges'] == {'packet_lag_seconds{packet=A}': 7200, 'packet_lag_seconds{packet=B}': 60,
+                                           'update_queue_depth{kind=backfill}': 0,
+                                           'update_queue_depth{kind=fresh}': 0}
+
+
+def test_daemon_stops_when_requested():
+    warehouse = WarehouseSpy({'A': 1})
+    daemon = UpdateDaemon([(warehouse, ['A'])])
+    runner = threading.Thread(target=daemon.run)
+    runner.start()
+    daemon.stop()
+    runner.join(timeout=5)
+    assert not runner.is_alive() and daemon.stopped
+
+
+def test_lock_writes_pid_and_rejects_concurrent_holders(tmp_path):
+    import os
+    file = tmp_path / "update.lock"
+    with pid_lock(file):
+        assert file.read_text() == str(os.getpid())
+        with pytest.raises(LockError):
+            with pid_lock(file):
+                pass
+    with pid_lock(file):
+        pass
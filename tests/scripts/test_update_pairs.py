@@ -1,11 +1,19 @@
 import pytest
 
-from datums_warehouse.scripts.update import update_pairs
+from datums_warehouse.scripts.update import update_pairs, repair_pairs
 
 
 class WarehouseSpy:
     def __init__(self):
         self.received_pairs = []
+        self.stages = None
+
+    def update_stages(self, pairs):
+        return self.stages or [list(pairs)]
+
+    def repair(self, pair):
+        self.received_pairs.append(pair)
+        return len(pair)
 
     def update(self, pair):
         import time
@@ -34,3 +42,28 @@ def test_update_single_pair(warehouse):
 def test_update_multiple_pairs(warehouse):
     update_pairs(warehouse, ['A', 'B'])
     assert {'A', 'B'} == set(warehouse.received_pairs)
+
+
+def test_update_stages_in_order(warehouse):
+    warehouse.stages = [['A', 'B'], ['C'], ['D']]
+    update_pairs(warehouse, ['A', 'B', 'C', 'D'])
+    assert set(warehouse.received_pairs[:2]) == {'A', 'B'} and warehouse.received_pairs[2:] == ['C', 'D']
+
+
+def test_update_writes_one_profile_per_packet(warehouse, tmp_path):
+    import pstats
+    update_pairs(warehouse, ['A', 'B'], profile_dir=tmp_path / "profiles")
+    profiles = sorted(p.name for p in (tmp_path / "profiles").iterdir())
+    assert [p.split('_')[:2] for p in profiles] == [['update', 'A'], ['update', 'B']]
+    assert pstats.Stats(str(tmp_path / "profiles" / profiles[0])).total_calls > 0
+
+
+def test_profiled_packets_are_updated_one_after_another(warehouse, tmp_path):
+    update_pairs(warehouse, ['A', 'B', 'C'], profile_dir=tmp_path / "profiles")
+    assert warehouse.received_pairs == ['A', 'B', 'C']
+
+
+def test_repair_pairs_in_stage_order(warehouse):
+    warehouse.stages = [['A', 'BB'], ['CCC']]
+    assert repair_pairs(warehouse, ['A', 'BB', 'CCC']) == {'A': 1, 'BB': 2, 'CCC': 3}
+    assert warehouse.received_pairs == ['A', 'BB', 'CCC']
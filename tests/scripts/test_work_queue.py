@@ -0,0 +1,202 @@
+import threading
+
+import pytest
+
+from datums_warehouse.broker.metrics import METRICS
+from datums_warehouse.scripts.work_queue import SqliteQueue, FileQueue, QueueWorker, open_queue, UnknownQueueError
+
+
+@pytest.fixture(params=['sqlite', 'file'])
+def queue(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteQueue(tmp_path / "queue.db", lease_seconds=10)
+    return FileQueue(tmp_path / "queue", lease_seconds=10)
+
+
+class Clock:
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class WarehouseSpy:
+    def __init__(self, intervals, derived=None, failing=()):
+        self.intervals = intervals
+        self.derived = derived or {}
+        self.failing = set(failing)
+        self.updated = []
+
+    def interval_of(self, pkt):
+        return self.intervals[pkt]
+
+    def derived_from(self, pkt):
+        return self.derived.get(pkt)
+
+    def update(self, pkt):
+        if pkt in self.failing:
+            raise ValueError("update failed")
+        self.updated.append(pkt)
+
+
+def test_due_jobs_are_leased_once(queue):
+    queue.enqueue('A', 0)
+    assert queue.lease('w1', 100) == 'A'
+    assert queue.lease('w2', 100) is None
+
+
+def test_jobs_are_leased_in_order_of_due_time(queue):
+    queue.enqueue('A', 50)
+    queue.enqueue('B', 10)
+    queue.enqueue('C', 200)
+    assert [queue.lease('w', 100), queue.lease('w', 100), queue.lease('w', 100)] == ['B', 'A', None]
+
+
+def test_enqueueing_keeps_existing_jobs(queue):
+    queue.enqueue('A', 0)
+    queue.lease('w1', 100)
+    queue.enqueue('A', 0)
+    assert queue.lease('w2', 100) is None
+
+
+def test_completed_jobs_are_due_again_at_their_next_time(queue):
+    queue.enqueue('A', 0)
+    queue.lease('w1', 100)
+    assert queue.complete('A', 'w1', 160)
+    assert queue.lease('w1', 159) is None
+    assert queue.lease('w1', 160) == 'A'
+
+
+def test_only_the_lease_owner_completes_a_job(queue):
+    queue.enqueue('A', 0)
+    queue.lease('w1', 100)
+    assert not queue.complete('A', 'w2', 160)
+    assert queue.lease('w2', 105) is None
+
+
+def test_expired_leases_are_taken_over(queue):
+    queue.enqueue('A', 0)
+    queue.lease('w1', 100)
+    assert queue.lease('w2', 109) is None
+    assert queue.lease('w2', 110) == 'A'
+    assert not queue.complete('A', 'w1', 160)
+    assert not queue.renew('A', 'w1', 111)
+
+
+def test_renewed_leases_do_not_expire(queue):
+    queue.enqueue('A', 0)
+    queue.lease('w1', 100)
+    assert queue.renew('A', 'w1', 108)
+    assert queue.lease('w2', 110) is None
+
+
+def test_jobs_wait_for_the_job_they_derive_from(queue):
+    queue.enqueue('derived', 0, after='source')
+    queue.enqueue('source', 0)
+    assert queue.lease('w1', 100) == 'source'
+    assert queue.lease('w2', 100) is None
+    queue.complete('source', 'w1', 160)
+    assert queue.lease('w2', 100) == 'derived'
+
+
+def test_workers_only_lease_their_own_jobs(queue):
+    queue.enqueue('A', 0)
+    queue.enqueue('B', 0)
+    assert queue.lease('w1', 100, keys={'B'}) == 'B'
+    assert queue.lease('w1', 100, keys={'B'}) is None
+
+
+def test_queue_depth_counts_due_and_unleased_jobs(queue):
+    queue.enqueue('A', 0)
+    queue.enqueue('B', 0)
+    queue.enqueue('C', 500)
+    queue.lease('w1', 100)
+    assert queue.depth(100) == 1
+
+
+def test_concurrent_workers_lease_each_job_exactly_once(queue):
+    keys = [f"pkt{i}" for i in range(20)]
+    for k in keys:
+        queue.enqueue(k, 0)
+    leased = []
+
+    def work(worker):
+        key = queue.lease(worker, 100)
+        while key is not None:
+            leased.append(key)
+            key = queue.lease(worker, 100)
+
+    workers = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert sorted(leased) == sorted(keys)
+
+
+def test_open_queue_by_spec(tmp_path):
+    assert isinstance(open_queue(f"sqlite:{tmp_path / 'queue.db'}"), SqliteQueue)
+    assert isinstance(open_queue(f"file:{tmp_path / 'queue'}"), FileQueue)
+    with pytest.raises(UnknownQueueError):
+        open_queue(f"redis:{tmp_path}")
+
+
+def test_worker_updates_leased_packets_and_schedules_their_next_bar(queue):
+    clock = Clock(1000)
+    warehouse = WarehouseSpy({'A': 1})
+    worker = QueueWorker(queue, [('wh', warehouse, ['A'])], 'w1', delay=5, clock=clock)
+    worker.enqueue_all()
+    assert worker.run_once() and not worker.run_once()
+    clock.now = 1025
+    assert worker.run_once()
+    assert warehouse.updated == ['A', 'A']
+
+
+def test_workers_share_packets_and_respect_derivations(queue):
+    warehouse = WarehouseSpy({'src': 1, 'der': 5}, derived={'der': 'src'})
+    workers = [QueueWorker(queue, [('wh', warehouse, ['src', 'der'])], w, clock=Clock(1000)) for w in ('w1', 'w2')]
+    workers[0].enqueue_all()
+    workers[1].enqueue_all()
+    while any([w.run_once() for w in workers]):
+        pass
+    assert warehouse.updated == ['src', 'der']
+
+
+def test_derived_packets_wait_for_their_source_packet_id(queue):
+    warehouse = WarehouseSpy({'SYM/1': 1, 'SYM/60': 60}, derived={'SYM/60': 'SYM/1'})
+    QueueWorker(queue, [('Kraken', warehouse, ['SYM/1', 'SYM/60'])], 'w1', clock=Clock(1000)).enqueue_all()
+    assert queue.lease('w1', 1000) == 'Kraken/SYM/1'
+    assert queue.lease('w2', 1000) is None
+
+
+def test_worker_completes_failing_packets_and_counts_them(queue):
+    METRICS.reset()
+    warehouse = WarehouseSpy({'A': 1, 'B': 1}, failing=['A'])
+    worker = QueueWorker(queue, [('wh', warehouse, ['A', 'B'])], 'w1', clock=Clock(1000))
+    worker.enqueue_all()
+    while worker.run_once():
+        pass
+    counters = METRICS.summary()['counters']
+    assert warehouse.updated == ['B']
+    assert counters['queue_jobs_failed_total'] == 1 and counters['queue_jobs_completed_total'] == 1
+
+
+def test_worker_exports_the_queue_depth_while_running(queue, tmp_path):
+    from datums_warehouse.broker.metrics import MetricsFile, collect
+    METRICS.reset()
+    worker = QueueWorker(queue, [('wh', WarehouseSpy({'A': 1, 'B': 1}), ['A', 'B'])], 'w1', clock=Clock(1000),
+                         metrics_file=MetricsFile(tmp_path / "metrics", 'queue-w1'))
+    worker.enqueue_all()
+    worker.run_once()
+    assert collect(tmp_path / "metrics").summary()['gauges'] == {'queue_depth': 2}
+    METRICS.reset()
+
+
+def test_worker_stops_when_requested(queue):
+    worker = QueueWorker(queue, [('wh', WarehouseSpy({'A': 1}), ['A'])], 'w1', poll_seconds=0.01)
+    runner = threading.Thread(target=worker.run)
+    runner.start()
+    worker.stop()
+    runner.join(timeout=5)
+    assert not runner.is_alive() and worker.stopped
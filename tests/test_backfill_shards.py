@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from datums_warehouse.broker.replay import ReplayExchange, write_replay
+from datums_warehouse.broker.source import ExchangeTrades
+from datums_warehouse.broker.trades import TRADE, NANO_SECONDS
+
+START_NS = 1559347200 * NANO_SECONDS
+DAY_NS = 24 * 60 * 60 * NANO_SECONDS
+
+
+def make_trades(times):
+    trades = np.zeros(len(times), dtype=TRADE)
+    trades['time'] = times
+    trades['price'] = np.arange(1, len(times) + 1)
+    trades['volume'] = 0.5
+    return trades
+
+
+class FailingExchange(ReplayExchange):
+    def __init__(self, pair, file, page_size, failing):
+        super().__init__(pair, None, file, page_size)
+        self.failing = failing
+        self.pages = 0
+
+    def page(self, since):
+        self.pages += 1
+        if self.failing is not None and self.failing[0] <= since < self.failing[1]:
+            raise ConnectionError("exchange unavailable")
+        return super().page(since)
+
+
+@pytest.fixture
+def trades():
+    return make_trades(np.sort(np.random.default_rng(42).integers(START_NS, START_NS + 4 * DAY_NS, 500)))
+
+
+@pytest.fixture
+def replay_file(tmp_path, trades):
+    file = tmp_path / "xbtusd.npy"
+    write_replay(file, trades)
+    return file
+
+
+def make_exchange(replay_file, failing=None):
+    return FailingExchange("xbtusd", replay_file, page_size=7, failing=failing)
+
+
+def test_sharded_backfill_fetches_the_same_trades_as_sequential_paging(tmp_path, replay_file, trades):
+    sequential = ExchangeTrades(make_exchange(replay_file), tmp_path / "sequential", max_results=1e6)
+    sharded = ExchangeTrades(make_exchange(replay_file), tmp_path / "sharded", max_results=1e6, shards=3)
+    until = START_NS + 4 * DAY_NS
+    assert sharded.get(START_NS, until).tolist() == sequential.get(START_NS, until).tolist() == trades.tolist()
+
+
+def test_sharded_backfill_removes_its_segments_after_stitching(tmp_path, replay_file):
+    ExchangeTrades(make_exchange(replay_file), tmp_path, max_results=1e6, shards=3).get(START_NS, START_NS + 4 * DAY_NS)
+    assert list((tmp_path / "xbtusd" / "replay_cache_segments").iterdir()) == []
+
+
+def test_short_ranges_are_not_sharded(tmp_path, replay_file):
+    ExchangeTrades(make_exchange(replay_file), tmp_path, max_results=1e6, shards=3).get(START_NS, START_NS + DAY_NS)
+    assert not (tmp_path / "xbtusd" / "replay_cache_segments").exists()
+
+
+def test_trades_at_shard_edges_are_not_duplicated(tmp_path):
+    edge = START_NS + 2 * DAY_NS
+    trades = make_trades([START_NS, edge - 1, edge, edge, edge + 1, START_NS + 4 * DAY_NS - 1])
+    trades['price'][3] = trades['price'][2]
+    write_replay(tmp_path / "xbtusd.npy", trades)
+    exchange = ReplayExchange("xbtusd", None, tmp_path / "xbtusd.npy", page_size=4)
+    fetched = ExchangeTrades(exchange, tmp_path, max_results=1e6, shards=2).get(START_NS, START_NS + 4 * DAY_NS)
+    assert fetched.tolist() == trades.tolist()
+
+
+def test_failed_shards_are_resumed_from_their_segments(tmp_path, replay_file, trades):
+    until = START_NS + 4 * DAY_NS
+    failing = make_exchange(replay_file, failing=(START_NS + 2 * DAY_NS, START_NS + 5 * DAY_NS // 2))
+    with pytest.raises(ConnectionError):
+        ExchangeTrades(failing, tmp_path, max_results=1e6, shards=3).get(START_NS, until)
+    remaining = sorted(d.name for d in (tmp_path / "xbtusd" / "replay_cache_segments").iterdir())
+    assert remaining == [f"{START_NS + 8 * DAY_NS // 3}_{until}"]
+
+    exchange = make_exchange(replay_file)
+    assert ExchangeTrades(exchange, tmp_path, max_results=1e6, shards=3).get(START_NS, until).tolist() == \
+           trades.tolist()
+    assert exchange.pages < len(trades[trades['time'] >= START_NS + 2 * DAY_NS]) / 7 / 2
@@ -0,0 +1,91 @@
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from datums_warehouse.broker.cache import TradesCache
+from datums_warehouse.broker.codecs import available_codecs, get_codec, shuffle, unshuffle, MissingCodecError, \
+    default_codec
+from datums_warehouse.broker.trades import TRADE, LEGACY_TRADE, NANO_SECONDS, BUY, SELL, seconds_to_ns
+
+
+@pytest.fixture
+def raw_trades():
+    rng = np.random.default_rng(7)
+    trades = np.zeros(500, dtype=TRADE)
+    trades['time'] = seconds_to_ns(1500000000.0 + np.cumsum(rng.exponential(2.0, 500)).round(4))
+    trades['price'] = (7500 + np.cumsum(rng.normal(0, 1, 500))).round(1)
+    trades['volume'] = rng.lognormal(-3, 1.5, 500).round(8)
+    trades['side'] = rng.choice([BUY, SELL], 500)
+    return trades
+
+
+@pytest.fixture
+def legacy_trades(raw_trades):
+    trades = np.zeros(len(raw_trades), dtype=LEGACY_TRADE)
+    for name in LEGACY_TRADE.names:
+        trades[name] = raw_trades[name]
+    trades['time'] /= NANO_SECONDS
+    return trades
+
+
+def test_shuffle_is_lossless(raw_trades, legacy_trades):
+    assert np.array_equal(unshuffle(shuffle(raw_trades), TRADE), raw_trades)
+    assert np.array_equal(unshuffle(shuffle(legacy_trades), LEGACY_TRADE), legacy_trades)
+
+
+@pytest.mark.parametrize('name', available_codecs())
+def test_codec_round_trip(name, raw_trades):
+    codec = get_codec(name)
+    assert np.array_equal(codec.decompress(codec.compress(raw_trades), TRADE), raw_trades)
+
+
+def test_shuffled_trades_compress_better(raw_trades):
+    assert len(get_codec('shuffle-zlib').compress(raw_trades)) < len(get_codec('zlib').compress(raw_trades))
+
+
+def test_unknown_codec():
+    with pytest.raises(MissingCodecError):
+        get_codec('unknown')
+
+
+def test_default_codec_is_available():
+    assert default_codec().name in available_codecs()
+
+
+def test_blocks_with_different_codecs_are_readable(tmp_path):
+    file = tmp_path / 'cache'
+    expected = []
+    for i, name in enumerate(available_codecs()):
+        trades = [[10.0 + i, 0.1, 1500000000.0 + i]]
+        with TradesCache(file, codec=get_codec(name)) as cache:
+            cache.update(trades, int((1500000001 + i) * 1e9))
+        expected += trades
+    with TradesCache(file) as cache:
+        assert cache.get(0, int(1600000000e9))[['price', 'volume']].tolist() == [(p, v) for p, v, _ in expected]
+
+
+def test_checksummed_zlib_blocks_remain_readable(tmp_path):
+    file = tmp_path / 'cache'
+    raw = zlib.compress(struct.pack('<3d', 10.0, 0.1, 1500000000.0))
+    file.write_bytes(struct.pack('<4sIIQI', b'DWB1', len(raw), 1500000000, int(1500000001e9), zlib.crc32(raw)) + raw)
+    with TradesCache(file) as cache:
+        cache.update([[11.0, 0.2, 1500000001.3]], int(1500000002e9))
+    with TradesCache(file) as cache:
+        trades = cache.get(0, int(1500000004e9))
+        assert trades['price'].tolist() == [10.0, 11.0]
+        assert trades['time'].tolist() == [1500000000 * NANO_SECONDS, 1500000001300000000]
+
+
+def test_codec_tagged_float_blocks_remain_readable(tmp_path, legacy_trades):
+    file = tmp_path / 'cache'
+    codec = get_codec('shuffle-zlib')
+    raw = codec.compress(legacy_trades)
+    last = int(np.ceil(legacy_trades['time'][-1]))
+    file.write_bytes(struct.pack('<4sIIQIB', b'DWB2', len(raw), last, last * NANO_SECONDS, zlib.crc32(raw), codec.tag)
+                     + raw)
+    with TradesCache(file) as cache:
+        trades = cache.get(0, last * NANO_SECONDS)
+        assert trades['time'].tolist() == seconds_to_ns(legacy_trades['time']).tolist()
+        assert trades['price'].tolist() == legacy_trades['price'].tolist()
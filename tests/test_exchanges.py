@@ -0,0 +1,45 @@
+import pytest
+
+import datums_warehouse.broker.exchanges as module_under_test
+from datums_warehouse.broker.exchanges import load_exchange, available_exchanges, UnknownExchangeError
+from datums_warehouse.broker.kraken import KrakenExchange
+from datums_warehouse.broker.replay import ReplayExchange
+
+
+class EntryPointStub:
+    def __init__(self, name, plugin):
+        self.name = name
+        self.plugin = plugin
+
+    def load(self):
+        return self.plugin
+
+
+class PluginStub:
+    name = 'Stub'
+    frequency = 0
+
+
+@pytest.fixture
+def plugins(monkeypatch):
+    registered = {}
+    monkeypatch.setattr(module_under_test, '_discover', lambda: registered)
+    return registered
+
+
+@pytest.mark.parametrize('name, exchange', [('Kraken', KrakenExchange), ('Replay', ReplayExchange)])
+def test_builtin_exchanges_are_available_without_installed_entry_points(plugins, name, exchange):
+    assert load_exchange(name) is exchange
+
+
+def test_exchanges_are_discovered_through_entry_points(plugins):
+    plugins['Stub'] = EntryPointStub('Stub', PluginStub)
+    assert load_exchange('Stub') is PluginStub
+    assert available_exchanges() == ['Kraken', 'Replay', 'Stub']
+
+
+def test_unknown_exchanges_are_not_implemented(plugins):
+    with pytest.raises(NotImplementedError):
+        load_exchange('Unknown')
+    with pytest.raises(UnknownExchangeError):
+        load_exchange('Unknown')
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datums_warehouse.broker.replay import ReplayExchange, write_replay
+from datums_warehouse.broker.storage import Storage
+from datums_warehouse.broker.trades import TRADE, NANO_SECONDS
+from datums_warehouse.broker.warehouse import Warehouse
+
+START_S = 1559347200
+HOURS = 48
+
+
+class CountingReplay(ReplayExchange):
+    pages = 0
+
+    def page(self, since):
+        CountingReplay.pages += 1
+        return super().page(since)
+
+
+@pytest.fixture(autouse=True)
+def counting_replay(monkeypatch):
+    import datums_warehouse.broker.exchanges as exchanges
+    monkeypatch.setitem(exchanges._BUILTIN, 'Replay', 'tests.test_gap_repair:CountingReplay')
+    CountingReplay.pages = 0
+
+
+@pytest.fixture
+def replay_file(tmp_path):
+    rng = np.random.default_rng(7)
+    trades = np.zeros(HOURS * 60 * 4, dtype=TRADE)
+    trades['time'] = (START_S + np.arange(len(trades)) * 15 + rng.integers(0, 15, len(trades))) * NANO_SECONDS
+    trades['price'] = rng.uniform(100, 200, len(trades)).round(1)
+    trades['volume'] = rng.uniform(0.1, 1, len(trades)).round(8)
+    file = tmp_path / "xbtusd.npy"
+    write_replay(file, trades)
+    return file
+
+
+@pytest.fixture
+def warehouse(tmp_path, replay_file):
+    return Warehouse({
+        'xbtusd_1': {'storage': str(tmp_path / "storage"), 'interval': '1', 'pair': 'xbtusd', 'start': str(START_S),
+                     'source': 'Replay', 'source_file': str(replay_file), 'source_page_size': '50'},
+        'xbtusd_30': {'storage': str(tmp_path / "storage"), 'interval': '30', 'pair': 'xbtusd',
+                      'derive_from': 'xbtusd_1'},
+    })
+
+
+def stored_file(tmp_path, interval):
+    return next((tmp_path / "storage" / "xbtusd").glob(f"{interval}__*.gz"))
+
+
+def cut_out(tmp_path, interval, since, until):
+    file = stored_file(tmp_path, interval)
+    df = pd.read_csv(file)
+    df[(df.timestamp < since) | (df.timestamp > until)].to_csv(file, index=False, compression="infer")
+
+
+def test_repair_restores_missing_bars_from_the_trades_cache(tmp_path, warehouse):
+    warehouse.update('xbtusd_1')
+    complete = pd.read_csv(stored_file(tmp_path, 1))
+    cut_out(tmp_path, 1, START_S + 3600, START_S + 7200)
+    pages = CountingReplay.pages
+
+    assert warehouse.repair('xbtusd_1') == 61
+    assert CountingReplay.pages == pages
+    pd.testing.assert_frame_equal(pd.read_csv(stored_file(tmp_path, 1)), complete)
+
+
+def test_repair_refetches_only_the_missing_windows(tmp_path, warehouse):
+    warehouse.update('xbtusd_1')
+    complete = pd.read_csv(stored_file(tmp_path, 1))
+    full_pages = CountingReplay.pages
+    cut_out(tmp_path, 1, START_S + 3600, START_S + 7200)
+    for f in (tmp_path / "storage" / "xbtusd").glob("replay_cache*"):
+        f.unlink()
+
+    warehouse.repair('xbtusd_1')
+    assert CountingReplay.pages - full_pages < full_pages / 10
+    pd.testing.assert_frame_equal(pd.read_csv(stored_file(tmp_path, 1)), complete)
+
+
+def test_repair_fetches_nearby_gaps_in_one_window(tmp_path, warehouse):
+    warehouse.update('xbtusd_1')
+    cut_out(tmp_path, 1, START_S + 3600, START_S + 3720)
+    cut_out(tmp_path, 1, START_S + 4200, START_S + 4320)
+    for f in (tmp_path / "storage" / "xbtusd").glob("replay_cache*"):
+        f.unlink()
+    pages = CountingReplay.pages
+
+    assert warehouse.repair('xbtusd_1') == 6
+    assert CountingReplay.pages - pages == 2
+
+
+def test_repair_of_derived_packets_resamples_their_source(tmp_path, warehouse):
+    warehouse.update('xbtusd_1')
+    warehouse.update('xbtusd_30')
+    complete = pd.read_csv(stored_file(tmp_path, 30))
+    cut_out(tmp_path, 30, START_S + 3600, START_S + 5400)
+
+    assert warehouse.repair('xbtusd_30') == 2
+    pd.testing.assert_frame_equal(pd.read_csv(stored_file(tmp_path, 30)), complete)
+
+
+def test_repair_of_complete_packets_does_nothing(warehouse):
+    warehouse.update('xbtusd_1')
+    assert warehouse.repair('xbtusd_1') == 0
+
+
+def test_repair_takes_gaps_found_by_validation(tmp_path, warehouse):
+    from datums_warehouse.broker.validation import validate, GapError
+    warehouse.update('xbtusd_1')
+    cut_out(tmp_path, 1, START_S + 600, START_S + 660)
+    with pytest.raises(GapError) as e:
+        validate(Storage(tmp_path / "storage" / "xbtusd").get(1))
+    assert warehouse.repair('xbtusd_1', e.value.gaps) == 2
@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from datums_warehouse.lazy import LazyModule
+
+HEAVY_MODULES = ['numpy', 'pandas', 'requests']
+
+
+def import_in_fresh_interpreter(code):
+    script = f"import json, sys\n{code}\nprint(json.dumps(dict(modules=sorted(sys.modules))))"
+    out = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def test_app_startup_does_not_import_heavy_modules():
+    result = import_in_fresh_interpreter("from datums_warehouse import create_app\ncreate_app({'TESTING': True})")
+    assert [m for m in HEAVY_MODULES if m in result['modules']] == []
+
+
+def test_update_cli_imports_neither_flask_nor_heavy_modules():
+    result = import_in_fresh_interpreter("import datums_warehouse.db\nimport datums_warehouse.scripts.update")
+    assert [m for m in HEAVY_MODULES + ['flask'] if m in result['modules']] == []
+
+
+def test_preload_warms_heavy_modules_before_fork():
+    result = import_in_fresh_interpreter("from datums_warehouse import create_app\n"
+                                         "create_app({'TESTING': True, 'PRELOAD': True})")
+    assert [m for m in HEAVY_MODULES if m in result['modules']] == HEAVY_MODULES
+
+
+def test_lazy_module_is_imported_on_first_attribute_access():
+    module = LazyModule('json')
+    assert 'not loaded' in repr(module)
+    assert module.dumps([1]) == "[1]"
+    assert 'loaded' in repr(module) and 'not' not in repr(module)
+
+
+def test_lazy_module_raises_import_errors_on_use():
+    module = LazyModule('datums_warehouse_does_not_exist')
+    with pytest.raises(ImportError):
+        module.anything
@@ -1,6 +1,10 @@
+import time
+
+import numpy as np
 import pytest
 
-from datums_warehouse.broker.cache import TradesCache
+from datums_warehouse.broker.cache import TradesCache, CorruptedCacheError
+from datums_warehouse.broker.trades import TRADE, NANO_SECONDS, seconds_to_ns as to_ns
 
 
 @pytest.fixture
@@ -15,17 +19,22 @@ def cache(cache_file):
 
 
 def seconds_to_ns(sec):
-    return int(sec * 1e9)
+    return int(to_ns(sec))
+
+
+def rows(trades):
+    return [[p, v, t / NANO_SECONDS] for t, p, v in zip(trades['time'].tolist(), trades['price'].tolist(),
+                                                         trades['volume'].tolist())]
 
 
 def test_cache_does_not_exist_yet(cache):
-    assert cache.get(0, 1) == []
+    assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1))) == []
     assert cache.last_timestamp() == 0
 
 
 def test_update_with_empty_data(cache):
     cache.update([], seconds_to_ns(1500000002))
-    assert cache.get(0, 1) == []
+    assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1))) == []
     assert cache.last_timestamp() == seconds_to_ns(1500000002)
 
 
@@ -34,7 +43,8 @@ def test_update_and_query(cache):
         [10.0, 0.1, 1500000000.0],
         [10.0, 0.1, 1500000001.3],
     ], seconds_to_ns(1500000002))
-    assert cache.get(0, 1500000003.0) == [[10.0, 0.1, 1500000000.0], [10.0, 0.1, 1500000001.3]]
+    assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000003.0))) == \
+           [[10.0, 0.1, 1500000000.0], [10.0, 0.1, 1500000001.3]]
 
 
 @pytest.mark.parametrize('since, until, expected', [
@@ -50,7 +60,7 @@ def test_select_query(cache, since, until, expected):
         [12.0, 0.3, 1500000002.5],
         [13.0, 0.4, 1500000003.5],
     ], seconds_to_ns(1500000004))
-    assert cache.get(since, until) == expected
+    assert rows(cache.get(seconds_to_ns(since), seconds_to_ns(until))) == expected
 
 
 def test_update_last_timestamp(cache):
@@ -68,8 +78,9 @@ def test_the_cache_is_persistent(cache_file):
         cache.update([[12.0, 0.3, 1500000002.5], [13.0, 0.4, 1500000003.5]], seconds_to_ns(1500000004))
     with TradesCache(cache_file) as cache:
         assert cache.last_timestamp() == seconds_to_ns(1500000004)
-        assert cache.get(0, 1500000004) == [[10.0, 0.1, 1500000000.0], [11.0, 0.2, 1500000001.3],
-                                            [12.0, 0.3, 1500000002.5], [13.0, 0.4, 1500000003.5]]
+        assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004))) == \
+               [[10.0, 0.1, 1500000000.0], [11.0, 0.2, 1500000001.3],
+                [12.0, 0.3, 1500000002.5], [13.0, 0.4, 1500000003.5]]
 
 
 def test_cache_skips_buffers_up_to_since(cache):
@@ -81,5 +92,175 @@ def test_cache_skips_buffers_up_to_since(cache):
         [12.0, 0.3, 1500000002.5],
         [13.0, 0.4, 1500000003.5],
     ], seconds_to_ns(1500000004))
-    assert cache.get(1500000002.5, 1500000003.5) == [[12.0, 0.3, 1500000002.5], [13.0, 0.4, 1500000003.5]]
-    assert cache.get(1500000003.5, 1500000004) == [[13.0, 0.4, 1500000003.5]]
+    assert rows(cache.get(seconds_to_ns(1500000002.5), seconds_to_ns(1500000003.5))) == \
+           [[12.0, 0.3, 1500000002.5], [13.0, 0.4, 1500000003.5]]
+    assert rows(cache.get(seconds_to_ns(1500000003.5), seconds_to_ns(1500000004))) == [[13.0, 0.4, 1500000003.5]]
+
+
+def test_cache_truncates_partially_written_trailing_block(cache_file):
+    with TradesCache(cache_file) as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+    intact = cache_file.stat().st_size
+    with TradesCache(cache_file) as cache:
+        cache.update([[11.0, 0.2, 1500000001.3]], seconds_to_ns(1500000002))
+    with open(cache_file, mode='r+b') as f:
+        f.truncate(cache_file.stat().st_size - 3)
+
+    with TradesCache(cache_file) as cache:
+        assert cache_file.stat().st_size == intact
+        assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004))) == [[10.0, 0.1, 1500000000.0]]
+        cache.update([[12.0, 0.3, 1500000002.5]], seconds_to_ns(1500000003))
+        assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004))) == \
+               [[10.0, 0.1, 1500000000.0], [12.0, 0.3, 1500000002.5]]
+
+
+def test_cache_truncates_trailing_block_with_invalid_checksum(cache_file):
+    with TradesCache(cache_file) as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+        cache.update([[11.0, 0.2, 1500000001.3]], seconds_to_ns(1500000002))
+    with open(cache_file, mode='r+b') as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    with TradesCache(cache_file) as cache:
+        assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004))) == [[10.0, 0.1, 1500000000.0]]
+
+
+def test_cache_raises_on_corrupted_block_inside_file(cache_file):
+    with TradesCache(cache_file) as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+        cache.update([[11.0, 0.2, 1500000001.3]], seconds_to_ns(1500000002))
+        with open(cache_file, mode='r+b') as f:
+            f.seek(30)
+            f.write(b'\x00\x00')
+        with pytest.raises(CorruptedCacheError):
+            rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004)))
+
+
+def test_cursor_is_recovered_from_last_block_when_cursor_file_is_behind(cache_file):
+    with TradesCache(cache_file) as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+    last = (cache_file.parent / 'cache_last').read_text()
+    with TradesCache(cache_file) as cache:
+        cache.update([[11.0, 0.2, 1500000001.3]], seconds_to_ns(1500000002))
+    (cache_file.parent / 'cache_last').write_text(last)
+
+    with TradesCache(cache_file) as cache:
+        assert cache.last_timestamp() == seconds_to_ns(1500000002)
+
+
+def test_cursor_file_is_replaced_atomically(cache_file, cache):
+    cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+    assert [p.name for p in cache_file.parent.iterdir() if p.name.endswith('.tmp')] == []
+
+
+def test_cursor_is_held_in_memory_while_open(cache_file):
+    with TradesCache(cache_file) as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+        (cache_file.parent / 'cache_last').write_text(str(seconds_to_ns(1)))
+        assert cache.last_timestamp() == seconds_to_ns(1500000001)
+
+
+def test_cursor_file_is_flushed_on_exit(cache_file):
+    with TradesCache(cache_file) as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+        cache.update([[11.0, 0.2, 1500000001.3]], seconds_to_ns(1500000002))
+    assert (cache_file.parent / 'cache_last').read_text() == str(seconds_to_ns(1500000002))
+
+
+def test_caches_of_different_exchanges_keep_separate_cursors(tmp_path):
+    with TradesCache(tmp_path / 'kraken_cache') as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+    with TradesCache(tmp_path / 'replay_cache') as cache:
+        assert cache.last_timestamp() == 0
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name.endswith('_last')) == ['kraken_cache_last']
+
+
+def test_kraken_cache_falls_back_to_legacy_cursor_file(tmp_path):
+    with TradesCache(tmp_path / 'kraken_cache') as cache:
+        cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+    (tmp_path / 'kraken_cache_last').unlink()
+    (tmp_path / 'cache_last').write_text(str(seconds_to_ns(1500000005)))
+
+    with TradesCache(tmp_path / 'kraken_cache') as cache:
+        assert cache.last_timestamp() == seconds_to_ns(1500000005)
+
+
+def test_reads_see_blocks_appended_after_previous_read(cache):
+    cache.update([[10.0, 0.1, 1500000000.0]], seconds_to_ns(1500000001))
+    assert rows(cache.get(0, seconds_to_ns(1500000004))) == [[10.0, 0.1, 1500000000.0]]
+    cache.update([[11.0, 0.2, 1500000001.3]], seconds_to_ns(1500000002))
+    assert rows(cache.get(0, seconds_to_ns(1500000004))) == [[10.0, 0.1, 1500000000.0], [11.0, 0.2, 1500000001.3]]
+
+
+def test_legacy_blocks_remain_readable(cache_file):
+    import math
+    import struct
+    import zlib
+    raw = zlib.compress(struct.pack('<6d', 10.0, 0.1, 1500000000.0, 11.0, 0.2, 1500000001.3))
+    cache_file.write_bytes(struct.pack('<II', len(raw), int(math.ceil(1500000001.3))) + raw)
+
+    with TradesCache(cache_file) as cache:
+        cache.update([[12.0, 0.3, 1500000002.5]], seconds_to_ns(1500000003))
+    with TradesCache(cache_file) as cache:
+        assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004))) == \
+               [[10.0, 0.1, 1500000000.0], [11.0, 0.2, 1500000001.3], [12.0, 0.3, 1500000002.5]]
+
+
+def test_concurrent_writers_are_serialized(cache_file):
+    import threading
+    entered = threading.Event()
+    order = []
+
+    def write(value):
+        with TradesCache(cache_file) as cache:
+            entered.set()
+            order.append(('enter', value))
+            time.sleep(0.05)
+            cache.update([[value, 0.1, 1500000000.0 + value]], seconds_to_ns(1500000000 + value + 1))
+            order.append(('exit', value))
+
+    first = threading.Thread(target=write, args=(1.0,))
+    first.start()
+    entered.wait()
+    second = threading.Thread(target=write, args=(2.0,))
+    second.start()
+    first.join()
+    second.join()
+
+    assert order == [('enter', 1.0), ('exit', 1.0), ('enter', 2.0), ('exit', 2.0)]
+    with TradesCache(cache_file) as cache:
+        assert rows(cache.get(seconds_to_ns(0), seconds_to_ns(1500000004))) == \
+               [[1.0, 0.1, 1500000001.0], [2.0, 0.1, 1500000002.0]]
+
+
+@pytest.fixture
+def many_blocks(cache):
+    for b in range(20):
+        trades = [[float(b), 0.1, 1500000000.0 + b * 10 + i] for i in range(10)]
+        cache.update(trades, seconds_to_ns(1500000010 + b * 10))
+    return cache
+
+
+@pytest.mark.parametrize('workers,read_ahead', [(1, 1), (4, 2), (8, 32)])
+def test_stream_delivers_decoded_blocks_in_order(many_blocks, workers, read_ahead):
+    since, until = seconds_to_ns(1500000015), seconds_to_ns(1500000154)
+    arrays = list(many_blocks.stream(since, until, workers=workers, read_ahead=read_ahead))
+    assert all(isinstance(a, np.ndarray) and a.dtype == TRADE for a in arrays)
+    times = np.concatenate(arrays)['time']
+    assert times.tolist() == [seconds_to_ns(1500000000 + t) for t in range(15, 155)]
+
+
+def test_stream_stops_reading_after_until(many_blocks, monkeypatch):
+    decoded = []
+    decode = many_blocks._decode
+
+    def spy(block, *args):
+        decoded.append(block)
+        return decode(block, *args)
+
+    monkeypatch.setattr(many_blocks, '_decode', spy)
+    assert len(list(many_blocks.stream(0, seconds_to_ns(1500000025), workers=1, read_ahead=1))) == 3
+    assert len(decoded) <= 4
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+import datums_warehouse.broker.metrics as module_under_test
+from datums_warehouse.broker.metrics import Metrics, MetricsFile, collect
+
+
+class ClockStub:
+    def __init__(self, *times):
+        self.times = list(times)
+
+    def perf_counter(self):
+        return self.times.pop(0)
+
+
+@pytest.fixture
+def metrics():
+    return Metrics()
+
+
+def test_counters_accumulate_per_label_set(metrics):
+    metrics.inc('trades_total', 3, stage='fetch')
+    metrics.inc('trades_total', 2, stage='fetch')
+    metrics.inc('trades_total', stage='read')
+    assert metrics.summary()['counters'] == {'trades_total{stage=fetch}': 5, 'trades_total{stage=read}': 1}
+
+
+def test_gauges_keep_the_latest_value(metrics):
+    metrics.set('packet_lag_seconds', 120, packet='A')
+    metrics.set('packet_lag_seconds', 60, packet='A')
+    assert metrics.summary()['gauges'] == {'packet_lag_seconds{packet=A}': 60}
+    assert '# TYPE datums_packet_lag_seconds gauge\ndatums_packet_lag_seconds{packet="A"} 60\n' in metrics.prometheus()
+
+
+def test_timers_record_count_and_seconds(metrics, monkeypatch):
+    monkeypatch.setattr(module_under_test, 'time', ClockStub(1.0, 1.5, 2.0, 2.25))
+    with metrics.time('stage_seconds', stage='fetch'):
+        pass
+    with metrics.time('stage_seconds', stage='fetch'):
+        pass
+    assert metrics.summary()['timers'] == {'stage_seconds{stage=fetch}': dict(count=2, seconds=0.75)}
+
+
+def test_timers_record_failing_stages(metrics):
+    with pytest.raises(ValueError):
+        with metrics.time('stage_seconds', stage='validate'):
+            raise ValueError()
+    assert metrics.summary()['timers']['stage_seconds{stage=validate}']['count'] == 1
+
+
+def test_prometheus_text_format(metrics):
+    metrics.inc('cache_hits_total')
+    metrics.inc('bars_written_total', 10, interval=30)
+    metrics.observe('stage_seconds', 0.5, stage='store')
+    assert metrics.prometheus() == '# TYPE datums_bars_written_total counter\n' \
+                                   'datums_bars_written_total{interval="30"} 10\n' \
+                                   '# TYPE datums_cache_hits_total counter\n' \
+                                   'datums_cache_hits_total 1\n' \
+                                   '# TYPE datums_stage_seconds summary\n' \
+                                   'datums_stage_seconds_count{stage="store"} 1\n' \
+                                   'datums_stage_seconds_sum{stage="store"} 0.5\n'
+
+
+def test_prometheus_label_values_are_escaped(metrics):
+    metrics.inc('query_requests_total', packet='a"b\\c')
+    assert 'datums_query_requests_total{packet="a\\"b\\\\c"} 1' in metrics.prometheus()
+
+
+def test_reset_clears_all_metrics(metrics):
+    metrics.inc('cache_hits_total')
+    metrics.set('update_queue_depth', 3, kind='backfill')
+    metrics.observe('stage_seconds', 0.5, stage='store')
+    metrics.reset()
+    assert metrics.summary() == dict(counters={}, gauges={}, timers={})
+
+
+def test_snapshots_merge_into_another_registry(metrics):
+    metrics.inc('trades_total', 3, stage='fetch')
+    metrics.observe('stage_seconds', 0.5, stage='store')
+    metrics.set('update_queue_depth', 2, kind='fresh')
+    merged = Metrics()
+    merged.inc('trades_total', 1, stage='fetch')
+    merged.merge(metrics.snapshot())
+    assert merged.summary() == dict(counters={'trades_total{stage=fetch}': 4},
+                                    gauges={'update_queue_depth{kind=fresh}': 2},
+                                    timers={'stage_seconds{stage=store}': dict(count=1, seconds=0.5)})
+
+
+def test_collect_sums_counters_of_all_processes(tmp_path):
+    first, second = Metrics(), Metrics()
+    first.inc('query_requests_total', 2)
+    second.inc('query_requests_total', 3)
+    MetricsFile(tmp_path, 'query-1', metrics=first).flush()
+    MetricsFile(tmp_path, 'query-2', metrics=second).flush()
+    assert collect(tmp_path).summary()['counters'] == {'query_requests_total': 5}
+
+
+def test_metrics_files_are_per_process_when_asked(tmp_path):
+    import os
+    assert MetricsFile(tmp_path, 'update').file.name == "update.json"
+    assert MetricsFile(tmp_path, 'query', per_process=True).file.name == f"query-{os.getpid()}.json"
+
+
+def test_metrics_files_flush_at_most_every_period(tmp_path, metrics):
+    clock = iter([0.0, 1.0, 6.0, 6.0])
+    exporter = MetricsFile(tmp_path, 'update', metrics=metrics, every=5.0, clock=lambda: next(clock))
+    exporter.maybe_flush()
+    metrics.inc('bars_written_total')
+    exporter.maybe_flush()
+    assert json.loads(exporter.file.read_text())['counters'] == []
+    exporter.maybe_flush()
+    assert json.loads(exporter.file.read_text())['counters'] == [['bars_written_total', [], 1]]
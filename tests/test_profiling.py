@@ -0,0 +1,107 @@
+import pstats
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def profile_dir(app, tmp_path):
+    directory = tmp_path / "profiles"
+    app.config.update(PROFILE_DIR=str(directory), PROFILE_ADMINS="other_user, user")
+    return directory
+
+
+def test_admins_can_profile_a_query_with_a_header(query, profile_dir, make_auth_header):
+    with query.authentication(headers={**make_auth_header('user', 'pass'), 'X-Datums-Profile': '1'}):
+        res = query.symbol()
+    assert res.status_code == 200 and res.json['csv'] is not None
+    file = profile_dir / res.headers['X-Datums-Profile']
+    assert pstats.Stats(str(file)).total_calls > 0
+
+
+def test_admins_can_profile_a_query_with_a_flag(query, profile_dir):
+    res = query.symbol(params=dict(profile=1))
+    assert (profile_dir / res.headers['X-Datums-Profile']).exists()
+
+
+@pytest.mark.parametrize('flag', ['0', 'false', ''])
+def test_disabled_flags_do_not_profile(query, profile_dir, flag):
+    assert 'X-Datums-Profile' not in query.symbol(params=dict(profile=flag)).headers
+    assert not profile_dir.exists()
+
+
+def test_non_admins_are_not_profiled(app, query, profile_dir):
+    app.config.update(PROFILE_ADMINS=["other_user"])
+    res = query.symbol(params=dict(profile=1))
+    assert res.status_code == 200 and 'X-Datums-Profile' not in res.headers
+    assert not profile_dir.exists()
+
+
+def test_profiling_is_off_without_profile_dir(query):
+    assert 'X-Datums-Profile' not in query.symbol(params=dict(profile=1)).headers
+
+
+def _worker_task():
+    return sum(range(1000))
+
+
+def test_profiles_cover_threads_started_while_profiling(tmp_path):
+    import threading
+    from datums_warehouse.broker.profiling import profiled
+    with profiled(tmp_path / "worker.prof"):
+        worker = threading.Thread(target=_worker_task)
+        worker.start()
+        worker.join()
+    assert '_worker_task' in {name for _, _, name in pstats.Stats(str(tmp_path / "worker.prof")).stats}
+
+
+def _unrelated_task(profiles):
+    profiles.append(sys.getprofile())
+    return sum(range(1000))
+
+
+def test_profiles_skip_threads_started_by_other_callers(tmp_path):
+    import threading
+    from datums_warehouse.broker.profiling import profiled
+    profiles, started = [], threading.Event()
+    release = threading.Event()
+
+    def other_request():
+        release.wait()
+        worker = threading.Thread(target=_unrelated_task, args=(profiles,))
+        worker.start()
+        worker.join()
+        started.set()
+
+    other = threading.Thread(target=other_request)
+    other.start()
+    with profiled(tmp_path / "request.prof"):
+        release.set()
+        started.wait(timeout=5)
+        _worker_task()
+    other.join()
+    assert profiles == [None]
+    assert '_unrelated_task' not in {name for _, _, name in pstats.Stats(str(tmp_path / "request.prof")).stats}
+
+
+def test_thread_profilers_stop_with_their_thread(tmp_path):
+    import threading
+    from datums_warehouse.broker.profiling import profiled
+    profiles, start = [], threading.Thread.start
+    with profiled(tmp_path / "worker.prof"):
+        worker = threading.Thread(target=_unrelated_task, args=(profiles,))
+        worker.start()
+        worker.join()
+    assert profiles[0] is not None and threading.Thread.start is start
+    after = threading.Thread(target=_unrelated_task, args=(profiles,))
+    after.start()
+    after.join()
+    assert profiles[1] is None
+
+
+def test_only_one_profile_is_taken_at_a_time(tmp_path):
+    from datums_warehouse.broker.profiling import profiled
+    with profiled(tmp_path / "outer.prof"):
+        with profiled(tmp_path / "inner.prof"):
+            _worker_task()
+    assert (tmp_path / "outer.prof").exists() and not (tmp_path / "inner.prof").exists()
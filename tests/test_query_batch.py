@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+from datums_warehouse.batch import BATCH_MIMETYPE, iter_frames, encode_frame, TruncatedBatchError
+
+
+@pytest.fixture
+def batch(client, make_auth_header):
+    def post(payload, auth=("user", "pass")):
+        headers = make_auth_header(*auth) if auth else {}
+        return client.post("/api/v1.0/csv/batch", json=payload, headers=headers)
+
+    return post
+
+
+def frames_of(res):
+    assert res.status_code == 200 and res.mimetype == BATCH_MIMETYPE
+    return list(iter_frames(io.BytesIO(res.data)))
+
+
+def test_batch_returns_one_frame_per_query_in_order(batch, query, valid_datums, fragmented_datums):
+    frames = frames_of(batch({'queries': [["TEST_SYM", 30], ["unknown", 5], ["INVALID_SYM", 5]]}))
+    assert [h['sym'] for h, _ in frames] == ["TEST_SYM", "unknown", "INVALID_SYM"]
+    (ok, csv), (missing, empty), (fragmented, warned) = frames
+    assert csv == valid_datums[0]['csv'] and 'error' not in ok and 'warning' not in ok
+    assert "unknown" in missing['error'] and empty == ""
+    assert "gap" in fragmented['warning'] and warned == fragmented_datums[0]['csv']
+
+
+def test_batch_queries_match_single_queries(batch, query, valid_datums):
+    since, until = valid_datums[0]['range'].min + 1800, valid_datums[0]['range'].min + 3600
+    (header, csv), = frames_of(batch({'queries': [["TEST_SYM", 30, since, until]]}))
+    assert header == dict(sym="TEST_SYM", interval=30, since=since, until=until)
+    assert csv == query.symbol("TEST_SYM", 30, since, until).json['csv']
+
+
+def test_batch_requires_authentication(batch):
+    assert batch({'queries': [["TEST_SYM", 30]]}, auth=None).status_code == 401
+    assert batch({'queries': [["TEST_SYM", 30]]}, auth=("user", "wrong")).status_code == 401
+
+
+@pytest.mark.parametrize('payload', [None, [], {'queries': []}, {'queries': [["TEST_SYM"]]},
+                                     {'queries': [["TEST_SYM", "30"]]}, {'queries': [[30, 30]]},
+                                     {'queries': [["TEST_SYM", 30, 1.5]]}, {'queries': [["TEST_SYM", 30, 0, 1, 2]]}])
+def test_invalid_batches_are_rejected(batch, payload):
+    res = batch(payload)
+    assert res.status_code == 400 and 'error' in res.json
+
+
+def test_batch_size_is_limited(app, batch):
+    app.config['BATCH_MAX_QUERIES'] = 2
+    res = batch({'queries': [["TEST_SYM", 30]] * 3})
+    assert res.status_code == 400 and "at most 2" in res.json['error']
+
+
+def test_truncated_batch_frames_are_detected():
+    data = encode_frame(dict(sym="A"), "timestamp\n1\n")
+    assert list(iter_frames(io.BytesIO(data))) == [(dict(sym="A"), "timestamp\n1\n")]
+    with pytest.raises(TruncatedBatchError):
+        list(iter_frames(io.BytesIO(data[:-1])))
+    with pytest.raises(TruncatedBatchError):
+        list(iter_frames(io.BytesIO(data[:3])))
+
+
+def test_batch_responses_are_limited_in_rows(app, batch, valid_datums):
+    app.config['QUERY_MAX_ROWS'] = 1
+    (header, csv), = frames_of(batch({'queries': [["TEST_SYM", 30]]}))
+    assert header['next'] == valid_datums[0]['range'].min and csv.count("\n") == 2
@@ -83,3 +83,116 @@ def test_validate_with_configures_parameters(query, fragmented_datums, default_v
         default_validation_cfg['exclude_outliers'].split(','),
         default_validation_cfg['z_score_threshold']
     )
+
+
+@pytest.fixture
+def metrics():
+    from datums_warehouse.broker.metrics import METRICS
+    METRICS.reset()
+    yield METRICS
+    METRICS.reset()
+
+
+def test_metrics_are_exposed_in_prometheus_format(query, client, fst_datum, metrics, make_auth_header):
+    query.symbol(*parameters(fst_datum))
+    res = client.get('/metrics', headers=make_auth_header('user', 'pass'))
+    assert res.mimetype == 'text/plain'
+    assert f'datums_query_requests_total{{packet="TEST_SYM/30"}} 1' in res.data.decode()
+    assert 'datums_query_seconds_count{stage="retrieve"} 1' in res.data.decode()
+
+
+def test_metrics_require_auth_unless_public(app, client, metrics):
+    assert client.get('/metrics').status_code == 401
+    app.config.update(METRICS_PUBLIC=True)
+    assert client.get('/metrics').status_code == 200
+
+
+def test_metrics_of_other_processes_are_collected_from_the_metrics_dir(app, query, client, fst_datum, metrics,
+                                                                       tmp_path):
+    from datums_warehouse.broker.metrics import Metrics, MetricsFile
+    app.config.update(METRICS_DIR=str(tmp_path / "metrics"), METRICS_PUBLIC=True)
+    update = Metrics()
+    update.observe('stage_seconds', 0.5, stage='fetch')
+    update.set('packet_lag_seconds', 60, packet='TEST_SYM/30')
+    MetricsFile(tmp_path / "metrics", 'update', metrics=update).flush()
+    query.symbol(*parameters(fst_datum))
+    text = client.get('/metrics').data.decode()
+    assert 'datums_query_requests_total{packet="TEST_SYM/30"} 1' in text
+    assert 'datums_stage_seconds_count{stage="fetch"} 1' in text
+    assert 'datums_packet_lag_seconds{packet="TEST_SYM/30"} 60' in text
+
+
+def test_unknown_packets_are_not_counted(query, metrics):
+    query.symbol("unknown")
+    assert 'query_requests_total' not in metrics.prometheus()
+
+
+def test_request_projected_fields(query, fst_datum, fst_range):
+    csv = query.symbol(*parameters(fst_datum), params={'fields': "timestamp,c2"}).json['csv']
+    assert csv == "timestamp,c2\n" + "\n".join(l.rsplit(',', 2)[0] + "," + l.rsplit(',', 1)[1]
+                                              for l in fst_datum['csv'].split()[1:]) + "\n"
+
+
+def test_request_resampled_bars(query, ohlc_packet):
+    res = query.symbol(*ohlc_packet, since=3600 * 2, params={'resample': "60", 'fields': "timestamp,close,volume"})
+    assert res.json['csv'] == "timestamp,close,volume\n7200,120.0,60.0\n10800,180.0,60.0\n"
+    assert 'warning' not in res.json
+
+
+def test_resample_starts_at_the_bucket_containing_since(query, ohlc_packet):
+    res = query.symbol(*ohlc_packet, since=3600 * 3 + 60, params={'resample': "60", 'fields': "timestamp,open"})
+    assert res.json['csv'] == "timestamp,open\n10800,120.0\n"
+
+
+@pytest.mark.parametrize('params', [{'fields': "timestamp,unknown"}, {'fields': "timestamp,,c1"},
+                                    {'resample': "hour"}, {'resample': "7"}, {'resample': "60"}])
+def test_invalid_query_shapes_are_rejected(query, fst_datum, params):
+    res = query.symbol(*parameters(fst_datum), params=params)
+    assert res.status_code == 400 and 'error' in res.json
+
+
+def walk_pages(query, packet, **params):
+    pages, after = [], None
+    while True:
+        res = query.symbol(*packet, params=dict(params, **({} if after is None else {'after': after}))).json
+        pages.append(res['csv'])
+        if 'next' not in res:
+            return pages
+        after = res['next']
+
+
+def test_paginate_through_a_packet(query, ohlc_packet):
+    full = query.symbol(*ohlc_packet).json['csv']
+    pages = walk_pages(query, ohlc_packet, limit=50)
+    assert [p.count("\n") - 1 for p in pages] == [50, 50, 50, 30]
+    assert pages[0] + "".join(p.split("\n", 1)[1] for p in pages[1:]) == full
+
+
+def test_paginate_projection_without_timestamps(query, ohlc_packet):
+    pages = walk_pages(query, ohlc_packet, limit=100, fields="close")
+    assert [p.split("\n", 1)[0] for p in pages] == ["close", "close"]
+    assert "".join(p.split("\n", 1)[1] for p in pages).split() == [f"{i + 1}.0" for i in range(180)]
+
+
+def test_paginate_resampled_bars(query, ohlc_packet):
+    assert walk_pages(query, ohlc_packet, limit=2, resample=60, fields="timestamp,open") == \
+           ["timestamp,open\n3600,0.0\n7200,60.0\n", "timestamp,open\n10800,120.0\n"]
+
+
+def test_server_limits_rows_per_response(app, query, ohlc_packet):
+    app.config['QUERY_MAX_ROWS'] = 100
+    res = query.symbol(*ohlc_packet, params={'limit': 1000}).json
+    assert res['csv'].count("\n") == 101 and res['next'] == 3600 + 99 * 60
+
+
+@pytest.mark.parametrize('params', [{'limit': "0"}, {'limit': "-1"}, {'limit': "many"}, {'after': "yesterday"}])
+def test_invalid_pages_are_rejected(query, fst_datum, params):
+    res = query.symbol(*parameters(fst_datum), params=params)
+    assert res.status_code == 400 and 'error' in res.json
+
+
+def test_requesting_a_configured_packet_without_data(app, query, tmp_path):
+    with open(app.config['WAREHOUSE'], mode='a') as f:
+        f.write(f"[EMPTY_SYM/1]\nstorage = {tmp_path / 'csv'}\ninterval = 1\npair = EMPTY_SYM\n")
+    res = query.symbol("EMPTY_SYM", 1)
+    assert res.status_code == 200 and res.json['csv'] is None and 'no datums' in res.json['error']
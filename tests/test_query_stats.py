@@ -0,0 +1,36 @@
+import pytest
+
+
+@pytest.fixture
+def stats(client, make_auth_header):
+    def get(sym, interval, since, until, auth=("user", "pass")):
+        headers = make_auth_header(*auth) if auth else {}
+        return client.get(f"/api/v1.0/stats/{sym}/{interval}/{since}/{until}", headers=headers)
+
+    return get
+
+
+def test_stats_of_a_bar_packet(stats, ohlc_packet):
+    res = stats(*ohlc_packet, 3600, 3600 + 59 * 60)
+    assert res.status_code == 200
+    assert res.json['stats'] == dict(first=3600, last=3600 + 59 * 60, open=0.0, high=61.0, low=-1.0, close=60.0,
+                                     vwap=30.0, volume=60.0, count=60, bars=60, mean=30.5,
+                                     std=pytest.approx(17.318102282486574))
+
+
+def test_stats_of_an_empty_range(stats, ohlc_packet):
+    res = stats(*ohlc_packet, 0, 60)
+    assert res.json['stats'] is None and 'no bars' in res.json['warning']
+
+
+def test_stats_of_unknown_packets(stats):
+    assert "unknown" in stats("unknown", 1, 0, 60).json['error']
+
+
+def test_stats_need_bar_packets(stats, valid_datums):
+    res = stats("TEST_SYM", 30, 0, 2000000000)
+    assert res.status_code == 400 and 'error' in res.json
+
+
+def test_stats_require_authentication(stats, ohlc_packet):
+    assert stats(*ohlc_packet, 0, 60, auth=None).status_code == 401
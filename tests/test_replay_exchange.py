@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+import datums_warehouse.broker.replay as module_under_test
+
+from datums_warehouse.broker.replay import ReplayExchange, InvalidReplayError, write_replay
+from datums_warehouse.broker.source import TradesSource
+from datums_warehouse.broker.trades import TRADE, NANO_SECONDS, BUY, MARKET
+
+START_TIME_S = 1559347200
+
+
+def make_trades(*seconds):
+    trades = np.zeros(len(seconds), dtype=TRADE)
+    trades['time'] = [int(s * NANO_SECONDS) for s in seconds]
+    trades['price'] = np.arange(1, len(seconds) + 1)
+    trades['volume'] = 0.5
+    trades['side'] = BUY
+    trades['type'] = MARKET
+    return trades
+
+
+@pytest.fixture
+def replay_file(tmp_path):
+    file = tmp_path / "xbtusd.csv"
+    write_replay(file, make_trades(START_TIME_S, START_TIME_S + 1, START_TIME_S + 1, START_TIME_S + 61,
+                                   START_TIME_S + 121))
+    return file
+
+
+@pytest.fixture
+def exchange(replay_file):
+    return ReplayExchange("xbtusd", http=None, file=replay_file, page_size=2)
+
+
+def test_replay_pages_trades_from_cursor(exchange):
+    trades, cursor = exchange.page(0)
+    assert trades['time'].tolist() == [START_TIME_S * NANO_SECONDS, (START_TIME_S + 1) * NANO_SECONDS,
+                                       (START_TIME_S + 1) * NANO_SECONDS]
+    trades, cursor = exchange.page(cursor)
+    assert trades['time'].tolist() == [(START_TIME_S + 61) * NANO_SECONDS, (START_TIME_S + 121) * NANO_SECONDS]
+    trades, _ = exchange.page(cursor)
+    assert len(trades) == 0
+
+
+def test_replay_preserves_trade_fields(exchange):
+    trades, _ = exchange.page(0)
+    assert trades.dtype == TRADE
+    assert trades['side'].tolist() == [BUY] * 3 and trades['type'].tolist() == [MARKET] * 3
+
+
+def test_replay_time_is_just_after_the_last_trade(exchange):
+    assert exchange.now() == START_TIME_S + 122
+
+
+def test_replay_reads_numpy_record_files(tmp_path):
+    file = tmp_path / "xbtusd.npy"
+    write_replay(file, make_trades(START_TIME_S, START_TIME_S + 1))
+    trades, _ = ReplayExchange("xbtusd", http=None, file=file).page(0)
+    assert trades.tolist() == make_trades(START_TIME_S, START_TIME_S + 1).tolist()
+
+
+class SleepSpy:
+    def __init__(self):
+        self.received_sleeps = []
+
+    def sleep(self, seconds):
+        self.received_sleeps.append(seconds)
+
+
+def test_replay_pages_take_the_configured_latency(replay_file, monkeypatch):
+    spy = SleepSpy()
+    monkeypatch.setattr(module_under_test, 'time', spy)
+    ReplayExchange("xbtusd", http=None, file=replay_file, latency="0.25").page(0)
+    assert spy.received_sleeps == [0.25]
+
+
+def test_replay_file_requires_time_price_and_volume(tmp_path):
+    file = tmp_path / "broken.csv"
+    file.write_text("time,price\n1,2\n")
+    with pytest.raises(InvalidReplayError):
+        ReplayExchange("xbtusd", http=None, file=file).now()
+
+
+def test_replayed_trades_are_aggregated_offline(exchange, tmp_path):
+    source = TradesSource(exchange, trades_storage=tmp_path / "trades", interval=1)
+    assert source.query(since=START_TIME_S).csv == "timestamp,open,high,low,close,vwap,volume,count\n" \
+                                                   f"{START_TIME_S},1.0,3.0,1.0,3.0,2.0,1.5,3"
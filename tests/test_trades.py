@@ -0,0 +1,29 @@
+import numpy as np
+
+from datums_warehouse.broker.trades import parse_kraken, as_trades, seconds_to_ns, TRADE, BUY, SELL, MARKET, LIMIT
+
+
+def test_parse_kraken_rows_into_columns():
+    trades = parse_kraken([["7537.30000", "0.10393000", 1571122808.1487, "s", "l", ""],
+                           ["7538.90000", "0.02840000", 1571122831.9393, "b", "m", ""]])
+    assert trades.dtype == TRADE
+    assert trades['time'].tolist() == [1571122808148700000, 1571122831939300000]
+    assert trades['price'].tolist() == [7537.3, 7538.9]
+    assert trades['volume'].tolist() == [0.10393, 0.0284]
+    assert trades['side'].tolist() == [SELL, BUY]
+    assert trades['type'].tolist() == [LIMIT, MARKET]
+
+
+def test_parse_empty_kraken_rows():
+    assert len(parse_kraken([])) == 0
+
+
+def test_seconds_are_converted_exactly_to_micro_second_resolution():
+    assert seconds_to_ns(1500000001.3) == 1500000001300000000
+    assert seconds_to_ns(np.array([0.0001, 1571122808.1487])).tolist() == [100000, 1571122808148700000]
+
+
+def test_convert_price_volume_time_rows():
+    trades = as_trades([[10.0, 0.1, 1500000000.5]])
+    assert trades[['price', 'volume', 'time']].tolist() == [(10.0, 0.1, 1500000000500000000)]
+    assert as_trades(trades) is trades